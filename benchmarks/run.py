@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""
+Benchmark the client against a local stand-in Refine server.
+
+    python -m benchmarks.run [--rows 20000] [--repeat 5] [--json] [scenario ...]
+
+Each scenario runs in a fresh child process so its peak RSS is its own; the
+stand-in server runs in this process. For each scenario the time of every
+call is recorded, giving throughput (calls and rows per second) and latency
+percentiles.
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import csv
+import itertools
+import json
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import standin
+from google.refine import facet
+from google.refine import refine
+
+PAGE_SIZE = 100
+
+
+# Scenarios take (server, project_id, rows, repeat) and return a list of
+# (seconds, rows processed) for each call timed.
+
+def _timed(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        count = func()
+        timings.append((time.time() - start, count))
+    return timings
+
+
+def get_rows(server, project_id, rows, repeat):
+    project = refine.RefineProject(server, project_id)
+    pages = max(rows // PAGE_SIZE, 1)
+    starts = itertools.count(0, 97)    # spread over the project
+
+    def page():
+        start = next(starts) % pages * PAGE_SIZE
+        return len(project.get_rows(start=start, limit=PAGE_SIZE).rows)
+    return _timed(page, repeat * 10)
+
+
+def iter_rows(server, project_id, rows, repeat):
+    project = refine.RefineProject(server, project_id)
+    return _timed(lambda: sum(1 for _ in project.iter_rows()), repeat)
+
+
+def compute_facets(server, project_id, rows, repeat):
+    project = refine.RefineProject(server, project_id)
+    group = facet.TextFacet('group')
+    project.engine.set_facets(group)
+
+    def compute():
+        return len(project.compute_facets().facets[0].choices)
+    return _timed(compute, repeat * 10)
+
+
+def export_rows(server, project_id, rows, repeat):
+    project = refine.RefineProject(server, project_id)
+    return _timed(lambda: sum(1 for _ in project.export_rows()) - 1, repeat)
+
+
+def new_project(server, project_id, rows, repeat):
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(standin.COLUMNS)
+            writer.writerows(standin.synthetic_rows(rows))
+        r = refine.Refine(server)
+
+        def create():
+            r.new_project(project_file=path, project_name='bench').delete()
+            return rows
+        return _timed(create, repeat)
+    finally:
+        os.remove(path)
+
+
+def apply_operations(server, project_id, rows, repeat):
+    project = refine.RefineProject(server, project_id)
+    operations = [{'op': 'core/text-transform', 'columnName': 'name',
+                   'expression': 'value.trim()', 'onError': 'keep-original',
+                   'repeat': False, 'repeatCount': 10,
+                   'engineConfig': {'facets': [], 'mode': 'row-based'}}]
+    fd, path = tempfile.mkstemp(suffix='.json')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            json.dump(operations * 20, fp)
+
+        def apply():
+            project.apply_operations(path)
+            return 0
+        return _timed(apply, repeat * 10)
+    finally:
+        os.remove(path)
+
+
+SCENARIOS = [get_rows, iter_rows, compute_facets, export_rows, new_project,
+             apply_operations]
+
+
+def percentile(sorted_values, fraction):
+    """Return the value fraction of the way through sorted_values."""
+    if not sorted_values:
+        return 0.0
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def max_rss_kb():
+    """Return this process's peak resident set size in KB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def summarize(name, timings):
+    seconds = sorted(t for t, _ in timings)
+    total = sum(seconds)
+    rows = sum(count for _, count in timings)
+    return {
+        'scenario': name,
+        'calls': len(timings),
+        'seconds': total,
+        'calls_per_second': len(timings) / total if total else 0.0,
+        'rows_per_second': rows / total if total else 0.0,
+        'p50_ms': percentile(seconds, 0.5) * 1000,
+        'p90_ms': percentile(seconds, 0.9) * 1000,
+        'p99_ms': percentile(seconds, 0.99) * 1000,
+        'max_rss_kb': max_rss_kb(),
+    }
+
+
+def run_child(name, server, project_id, rows, repeat):
+    scenario = dict((s.__name__, s) for s in SCENARIOS)[name]
+    timings = scenario(server, project_id, rows, repeat)
+    print(json.dumps(summarize(name, timings)))
+
+
+def run(names, rows, repeat, gzip=True):
+    """Run scenarios, each in a child process, returning their summaries."""
+    server = standin.serve(gzip=gzip)
+    project_id = server.app.add_synthetic_project(rows)
+    results = []
+    try:
+        for name in names:
+            output = subprocess.check_output([
+                sys.executable, '-m', 'benchmarks.run', '--child', name,
+                '--server', server.url, '--project', project_id,
+                '--rows', str(rows), '--repeat', str(repeat)])
+            results.append(json.loads(output.splitlines()[-1]))
+    finally:
+        server.shutdown()
+    return results
+
+
+def print_table(results):
+    columns = [('scenario', '%-17s'), ('calls', '%6d'),
+               ('calls_per_second', '%9.1f'), ('rows_per_second', '%11.0f'),
+               ('p50_ms', '%8.2f'), ('p90_ms', '%8.2f'), ('p99_ms', '%8.2f'),
+               ('max_rss_kb', '%10d')]
+    print(' '.join('%*s' % (len(fmt % 0) if name != 'scenario' else -17,
+                            name.replace('_per_second', '/s'))
+                   for name, fmt in columns))
+    for result in results:
+        print(' '.join(fmt % result[name] for name, fmt in columns))
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage='usage: %prog [options] [scenario ...]',
+        description='Scenarios: ' + ', '.join(s.__name__ for s in SCENARIOS))
+    parser.add_option('--rows', type='int', default=20000,
+                      help='rows in the synthetic project')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='repetitions of each scenario')
+    parser.add_option('--no-gzip', dest='gzip', action='store_false',
+                      default=True, help="don't gzip responses")
+    parser.add_option('--json', action='store_true',
+                      help='print results as JSON')
+    parser.add_option('--child', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--server', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--project', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+    if options.child:
+        run_child(options.child, options.server, options.project,
+                  options.rows, options.repeat)
+        return
+    names = args or [s.__name__ for s in SCENARIOS]
+    unknown = set(names) - set(s.__name__ for s in SCENARIOS)
+    if unknown:
+        parser.error('Unknown scenario(s): ' + ', '.join(sorted(unknown)))
+    results = run(names, options.rows, options.repeat, options.gzip)
+    if options.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""
+A stand-in for an OpenRefine server, for benchmarking the client.
+
+StandInRefine is a WSGI application answering the /command/core/* commands
+the client uses from synthetic in-memory projects. serve() runs it on a
+threaded HTTP/1.1 server with keep-alive, chunked request bodies and
+gzipped responses, as OpenRefine's Jetty does.
+
+Facets are only evaluated for list facets on a column's value; anything
+else is echoed back without counts. Operations are accepted and ignored.
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import BaseHTTPServer
+import cgi
+import collections
+import csv
+import gzip
+import itertools
+import json
+import SocketServer
+import StringIO
+import threading
+import time
+import traceback
+import urlparse
+
+COLUMNS = ['id', 'name', 'group', 'amount']
+
+
+class ProjectNotFound(Exception):
+    """Raised for a request about a project that doesn't exist."""
+
+
+def synthetic_rows(count, groups=10):
+    """Yield count rows of COLUMNS."""
+    for i in xrange(count):
+        yield [str(i), 'Name %d' % i, 'group %d' % (i % groups),
+               '%.2f' % (i * 1.5)]
+
+
+class Project(object):
+    def __init__(self, name, columns, rows):
+        self.name = name
+        self.columns = columns
+        self.rows = rows
+        self.history = []
+
+    def selected(self, engine):
+        """Return the indexes of rows selected by an engine's list facets."""
+        rows = self.rows
+        selected = xrange(len(rows))
+        for f in engine.get('facets', []):
+            if f.get('type') != 'list' or f.get('expression') != 'value':
+                continue
+            values = set(s['v']['v'] for s in f.get('selection', []))
+            if not values and not f.get('selectBlank'):
+                continue
+            if f.get('selectBlank'):
+                values.add('')
+            index = self.columns.index(f['columnName'])
+            invert = f.get('invert', False)
+            selected = [i for i in selected
+                        if (rows[i][index] in values) != invert]
+        return selected
+
+
+class StandInRefine(object):
+    """WSGI application imitating the OpenRefine commands the client uses."""
+
+    def __init__(self, first_id=None):
+        self.projects = {}
+        if first_id is None:
+            first_id = int(time.time() * 1000)
+        self._ids = itertools.count(first_id)
+        self._lock = threading.Lock()
+
+    def add_project(self, name, columns, rows):
+        """Add a project, returning its id."""
+        with self._lock:
+            project_id = str(next(self._ids))
+            self.projects[project_id] = Project(name, columns, list(rows))
+        return project_id
+
+    def add_synthetic_project(self, row_count, name='synthetic'):
+        return self.add_project(name, COLUMNS, synthetic_rows(row_count))
+
+    def __call__(self, environ, start_response):
+        path = environ['PATH_INFO']
+        if path == '/project':
+            start_response('200 OK', [('Content-Type', 'text/html')])
+            return ['<html></html>']
+        if not path.startswith('/command/core/'):
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['Not found']
+        command = path[len('/command/core/'):].split('/')[0]
+        form = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ,
+                                keep_blank_values=True)
+        params = dict((key, form[key] if form[key].filename is not None
+                       else form.getfirst(key))
+                      for key in form.keys()) if form.list else {}
+        if command == 'export-rows':
+            return self.export_rows(params, start_response)
+        if command == 'create-project-from-upload':
+            project_id = self.create_project(params)
+            start_response('302 Found', [
+                ('Location', '/project?project=' + project_id)])
+            return ['']
+        method = getattr(self, command.replace('-', '_'), None)
+        if method is None:
+            response = {'code': 'error', 'message': 'No command ' + command}
+        else:
+            try:
+                response = method(params)
+            except ProjectNotFound:
+                # as OpenRefine's Command.getProject() reports it
+                response = {'code': 'error', 'message':
+                            "Can't find project: missing or bad URL "
+                            "parameter"}
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps(response)]
+
+    def _project(self, params):
+        try:
+            return self.projects[params['project']]
+        except KeyError:
+            raise ProjectNotFound(params.get('project'))
+
+    def get_version(self, params):
+        return {'version': '2.5', 'revision': 'standin',
+                'full_version': '2.5 [standin]',
+                'full_name': 'OpenRefine stand-in 2.5'}
+
+    def get_all_project_metadata(self, params):
+        return {'projects': dict((project_id, {'name': project.name})
+                                 for project_id, project
+                                 in self.projects.items())}
+
+    def get_project_metadata(self, params):
+        return {'name': self._project(params).name}
+
+    def get_models(self, params):
+        project = self._project(params)
+        return {
+            'columnModel': {
+                'columns': [{'name': name, 'cellIndex': i}
+                            for i, name in enumerate(project.columns)],
+                'keyColumnName': project.columns[0],
+            },
+            'recordModel': {'hasRecords': False},
+        }
+
+    def get_rows(self, params):
+        project = self._project(params)
+        selected = project.selected(json.loads(params.get('engine', '{}')))
+        start, limit = int(params['start']), int(params['limit'])
+        rows = [{'i': i, 'starred': False, 'flagged': False,
+                 'cells': [{'v': v} for v in project.rows[i]]}
+                for i in (selected[j] for j in xrange(
+                    start, min(start + limit, len(selected))))]
+        return {'mode': 'row-based', 'rows': rows, 'start': start,
+                'limit': limit, 'filtered': len(selected),
+                'total': len(project.rows)}
+
+    def compute_facets(self, params):
+        project = self._project(params)
+        engine = json.loads(params.get('engine', '{}'))
+        selected = project.selected(engine)
+        facets = []
+        for f in engine.get('facets', []):
+            response = {'name': f.get('name'),
+                        'columnName': f.get('columnName'),
+                        'expression': f.get('expression')}
+            if f.get('type') == 'list' and f.get('expression') == 'value':
+                index = project.columns.index(f['columnName'])
+                chosen = set(s['v']['v'] for s in f.get('selection', []))
+                counts = collections.Counter(project.rows[i][index]
+                                             for i in selected)
+                blank = counts.pop('', 0)
+                response['choices'] = [
+                    {'v': {'v': v, 'l': v}, 'c': c, 's': v in chosen}
+                    for v, c in counts.items()]
+                response['blankChoice'] = {'s': bool(f.get('selectBlank')),
+                                           'c': blank}
+            facets.append(response)
+        return {'mode': engine.get('mode', 'row-based'), 'facets': facets}
+
+    def apply_operations(self, params):
+        project = self._project(params)
+        project.history.extend(json.loads(params['operations']))
+        return {'code': 'ok'}
+
+    def get_processes(self, params):
+        self._project(params)
+        return {'processes': []}
+
+    def delete_project(self, params):
+        with self._lock:
+            self.projects.pop(params['project'], None)
+        return {'code': 'ok'}
+
+    def create_project(self, params):
+        upload = params['project-file']
+        if upload.filename.endswith('.gz'):
+            fp = gzip.GzipFile(fileobj=upload.file)
+        else:
+            fp = upload.file
+        separator = params.get('separator') or ','
+        reader = csv.reader(fp, delimiter=separator)
+        columns = next(reader)
+        return self.add_project(params.get('project-name', 'upload'),
+                                columns, reader)
+
+    def export_rows(self, params, start_response):
+        project = self._project(params)
+        separator = ',' if params.get('format') == 'csv' else '\t'
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+
+        def lines():
+            yield separator.join(project.columns) + '\n'
+            for row in project.rows:
+                yield separator.join(row) + '\n'
+        return lines()
+
+
+class WSGIRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Runs the server's WSGI app over keep-alive HTTP/1.1."""
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1               # one write per response, avoiding Nagle stalls
+    disable_nagle_algorithm = True
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if not size:
+                    return ''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def run_app(self):
+        body = self.read_body()
+        path, _, query = self.path.partition('?')
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'PATH_INFO': urlparse.unquote(path),
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': self.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO.StringIO(body),
+            'wsgi.url_scheme': 'http',
+        }
+        response = {}
+
+        def start_response(status, headers):
+            response['status'] = status
+            response['headers'] = headers
+
+        try:
+            data = ''.join(self.server.app(environ, start_response))
+        except Exception:
+            start_response('500 Internal Server Error',
+                           [('Content-Type', 'text/plain')])
+            data = traceback.format_exc()
+        code, _, message = response['status'].partition(' ')
+        self.send_response(int(code), message)
+        for name, value in response['headers']:
+            self.send_header(name, value)
+        if (self.server.gzip and len(data) > 1024 and
+                'gzip' in self.headers.get('Accept-Encoding', '')):
+            buf = StringIO.StringIO()
+            gzip_fp = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=1)
+            gzip_fp.write(data)
+            gzip_fp.close()
+            data = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = run_app
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, app, port=0, gzip=True):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           WSGIRequestHandler)
+        self.app = app
+        self.gzip = gzip
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        pass    # clients hanging up is expected
+
+
+def serve(app=None, port=0, gzip=True):
+    """Serve app on a background thread, returning the StandInServer."""
+    server = StandInServer(app or StandInRefine(), port, gzip)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
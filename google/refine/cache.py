@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""
+Cache of read-only command responses keyed by project history state.
+
+While a project stays at the same history entry the results of e.g.
+compute-facets for the same engine can't change, so they can be served
+locally. A ResponseCache is opt-in: give one to a RefineServer.
+
+    server = refine.RefineServer(
+        response_cache=cache.ResponseCache(directory='~/.refine-cache'))
+
+Responses are kept in memory, least recently used dropped first, and if a
+directory is given also on disk, the least recently used files being removed
+when it exceeds max_disk_bytes. The disk tier survives between processes,
+e.g. notebook re-runs.
+
+N.B. the cache assumes edits are made through this client; changes made by
+someone else in the OpenRefine UI aren't noticed.
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+# commands whose response depends only on the project's state & the request
+CACHEABLE_COMMANDS = ('compute-clusters', 'compute-facets', 'get-models',
+                      'get-rows')
+# commands that don't change the project's state
+READ_ONLY_COMMANDS = CACHEABLE_COMMANDS + ('get-history', 'get-processes')
+
+
+def _canonical(value):
+    """Parse JSON encoded POST values so key order doesn't matter."""
+    if isinstance(value, basestring) and value[:1] in ('{', '['):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+
+def cache_key(server, project_id, state, command, data=None):
+    """Return a cache key for a command's request at a history state."""
+    params = dict((k, _canonical(v)) for k, v in (data or {}).items())
+    key = json.dumps([server, str(project_id), state, command, params],
+                     sort_keys=True)
+    return hashlib.sha1(key).hexdigest()
+
+
+class ResponseCache(object):
+    """Thread safe two tier cache of JSON responses.
+
+    maxsize: number of responses kept in memory
+    directory: where to keep responses on disk, or None for memory only
+    max_disk_bytes: total size of the files kept in directory"""
+
+    def __init__(self, maxsize=256, directory=None,
+                 max_disk_bytes=256 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.max_disk_bytes = max_disk_bytes
+        self.directory = directory
+        if directory is not None:
+            self.directory = os.path.expanduser(directory)
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+        self.hits = 0
+        self.misses = 0
+        self._memory = collections.OrderedDict()   # key: JSON, oldest first
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """Return a dict of cache counters."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'memory': len(self._memory),
+                    'disk_bytes': self._disk_bytes()}
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def _disk_files(self):
+        """Return [(access time, size, path), ...] of the cached files."""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:     # removed by another process
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _disk_bytes(self):
+        if self.directory is None:
+            return 0
+        return sum(size for _, size, _ in self._disk_files())
+
+    def _remember(self, key, text):
+        self._memory[key] = text
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Return the cached response for key, or None."""
+        with self._lock:
+            text = self._memory.pop(key, None)
+            if text is None and self.directory is not None:
+                path = self._path(key)
+                try:
+                    with open(path, 'rb') as fp:
+                        text = fp.read()
+                    os.utime(path, None)    # mtime records last use
+                except (IOError, OSError):
+                    pass
+            if text is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, text)
+        return json.loads(text)
+
+    def put(self, key, response):
+        """Cache a response."""
+        text = json.dumps(response)
+        with self._lock:
+            self._remember(key, text)
+            if self.directory is None:
+                return
+            # write then rename so readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(text)
+            os.rename(tmp_path, self._path(key))
+            self._evict()
+
+    def _evict(self):
+        files = sorted(self._disk_files())
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Forget every cached response."""
+        with self._lock:
+            self._memory.clear()
+            if self.directory is not None:
+                for _, _, path in self._disk_files():
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
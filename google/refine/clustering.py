@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+"""
+Cluster a column's values locally, as OpenRefine's compute-clusters does.
+
+For columns with too many distinct values for the server to cluster in
+time. Values come from an exported column, and the work is spread over
+worker processes:
+
+    names = project.export_columns()['Candidate Name']
+    clusters = clustering.compute_clusters(names, 'knn', workers=8)
+
+Clusters are returned as by RefineProject.compute_clusters(), a list of
+lists of {'value': ..., 'count': ...}.
+
+Binning keyers are fingerprint, ngram-fingerprint and metaphone, a classic
+Metaphone standing in for OpenRefine's metaphone3. kNN uses levenshtein
+distance, comparing only values that share an n-gram ("blocking").
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import collections
+import multiprocessing
+import re
+import unicodedata
+
+from google.refine import columnar
+
+# Java's \p{Punct} and control characters, as stripped by OpenRefine
+PUNCTUATION_CONTROL = re.compile(
+    u'[!"#$%&\'()*+,\\-./:;<=>?@\\[\\\\\\]^_`{|}~\x00-\x08\x0a-\x1f\x7f]')
+WHITESPACE = re.compile(r'\s+', re.UNICODE)
+
+
+def _unicode(value):
+    if isinstance(value, unicode):
+        return value
+    return str(value).decode('utf-8', 'replace')
+
+
+def asciify(s):
+    """Strip accents, e.g. u'Caf\\xe9' to u'Cafe'."""
+    return u''.join(c for c in unicodedata.normalize('NFKD', s)
+                    if not unicodedata.combining(c))
+
+
+def fingerprint(value):
+    """Return value's sorted, unique, lower case, unpunctuated words."""
+    s = asciify(_unicode(value).strip().lower())
+    s = PUNCTUATION_CONTROL.sub(u'', s)
+    return u' '.join(sorted(set(s.split())))
+
+
+def ngrams(s, size):
+    """Return the set of s's substrings of length size, or {s} if shorter."""
+    if len(s) <= size:
+        return set([s])
+    return set(s[i:i + size] for i in range(len(s) - size + 1))
+
+
+def ngram_fingerprint(value, size=2):
+    """Return value's sorted, unique n-grams, ignoring case, punctuation
+    and whitespace."""
+    s = asciify(_unicode(value).lower())
+    s = WHITESPACE.sub(u'', PUNCTUATION_CONTROL.sub(u'', s))
+    return u''.join(sorted(ngrams(s, size)))
+
+
+VOWELS = 'AEIOU'
+FRONT_VOWELS = 'EIY'
+
+
+def _among(c, letters):
+    return c != '' and c in letters
+
+
+def metaphone(value):
+    """Return Lawrence Philips' original Metaphone code for value."""
+    word = ''.join(c for c in asciify(_unicode(value)).upper()
+                   if 'A' <= c <= 'Z')
+    if not word:
+        return u''
+    for prefix in ('AE', 'GN', 'KN', 'PN', 'WR'):
+        if word.startswith(prefix):
+            word = word[1:]
+            break
+    if word[0] == 'X':
+        word = 'S' + word[1:]
+    elif word.startswith('WH'):
+        word = 'W' + word[2:]
+    code = []
+    last = len(word) - 1
+    for i, c in enumerate(word):
+        prev = word[i - 1] if i > 0 else ''
+        next_ = word[i + 1] if i < last else ''
+        after = word[i + 2] if i + 1 < last else ''
+        if c == prev and c != 'C':
+            continue
+        if c in VOWELS:
+            if i == 0:
+                code.append(c)
+        elif c == 'B':
+            if not (prev == 'M' and i == last):
+                code.append('B')
+        elif c == 'C':
+            if next_ == 'I' and after == 'A':
+                code.append('X')
+            elif next_ == 'H':
+                code.append('K' if prev == 'S' else 'X')
+            elif _among(next_, FRONT_VOWELS):
+                if prev != 'S':
+                    code.append('S')
+            else:
+                code.append('K')
+        elif c == 'D':
+            if next_ == 'G' and _among(after, FRONT_VOWELS):
+                code.append('J')
+            else:
+                code.append('T')
+        elif c == 'G':
+            if next_ == 'H' and not (i + 1 == last or _among(after, VOWELS)):
+                continue
+            if next_ == 'N' and (i + 1 == last or
+                                 word[i + 1:] == 'NED'):
+                continue
+            if prev == 'D' and _among(next_, FRONT_VOWELS):
+                continue
+            if _among(next_, FRONT_VOWELS) and prev != 'G':
+                code.append('J')
+            else:
+                code.append('K')
+        elif c == 'H':
+            if _among(prev, 'CGPST'):
+                continue
+            if _among(prev, VOWELS) and not _among(next_, VOWELS):
+                continue
+            code.append('H')
+        elif c == 'K':
+            if prev != 'C':
+                code.append('K')
+        elif c == 'P':
+            code.append('F' if next_ == 'H' else 'P')
+        elif c == 'Q':
+            code.append('K')
+        elif c == 'S':
+            if next_ == 'H' or (next_ == 'I' and after in ('O', 'A')):
+                code.append('X')
+            else:
+                code.append('S')
+        elif c == 'T':
+            if next_ == 'I' and after in ('O', 'A'):
+                code.append('X')
+            elif next_ == 'H':
+                code.append('0')
+            elif not (next_ == 'C' and after == 'H'):
+                code.append('T')
+        elif c == 'V':
+            code.append('F')
+        elif c in 'WY':
+            if _among(next_, VOWELS):
+                code.append(c)
+        elif c == 'X':
+            code.append('KS')
+        elif c == 'Z':
+            code.append('S')
+        else:
+            code.append(c)
+    return u''.join(code)
+
+
+KEYERS = {
+    'fingerprint': fingerprint,
+    'ngram-fingerprint': ngram_fingerprint,
+    'metaphone': metaphone,
+    'metaphone3': metaphone,
+}
+
+
+def levenshtein(a, b, limit=None):
+    """Return the edit distance between a and b.
+
+    With a limit, stop early returning limit + 1 once it's exceeded."""
+    if len(a) < len(b):
+        a, b = b, a
+    if limit is not None and len(a) - len(b) > limit:
+        return limit + 1
+    previous = range(len(b) + 1)
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (ca != cb)))
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+DISTANCES = {
+    'levenshtein': levenshtein,
+}
+
+
+# Worker functions take one tuple argument so they can be Pool.map()ed
+
+def _keys(args):
+    keyer, params, values = args
+    keyer = KEYERS[keyer]
+    return [keyer(value, **params) for value in values]
+
+
+def _neighbours(args):
+    distance, radius, blocks = args
+    distance = DISTANCES[distance]
+    pairs = set()
+    for block in blocks:
+        for i, a in enumerate(block):
+            for b in block[i + 1:]:
+                if (a, b) not in pairs and distance(
+                        _unicode(a), _unicode(b), radius) <= radius:
+                    pairs.add((a, b))
+    return pairs
+
+
+def _chunks(items, count):
+    """Split items into count lists of about equal length."""
+    return [items[i::count] for i in range(count)]
+
+
+def _count_values(values):
+    """Count the non-blank values of a column as strings."""
+    counts = collections.Counter()
+    for value in values:
+        if isinstance(value, float):
+            if value != value:  # NaN, i.e. blank
+                continue
+            value = columnar.format_number(value)
+        if value is None or value == '':
+            continue
+        counts[value] += 1
+    return counts
+
+
+def _sorted_clusters(clusters, counts):
+    """Return clusters as lists of {value, count}, biggest first."""
+    result = []
+    for cluster in clusters:
+        choices = sorted(cluster, key=lambda value: (-counts[value], value))
+        result.append([{'value': value, 'count': counts[value]}
+                       for value in choices])
+    result.sort(key=lambda cluster: (-len(cluster),
+                                     -sum(c['count'] for c in cluster),
+                                     cluster[0]['value']))
+    return result
+
+
+def compute_clusters(values, clusterer_type='binning', function=None,
+                     params=None, workers=None):
+    """Cluster a column's values as RefineProject.compute_clusters() would.
+
+    values: an iterable of the column's values, e.g. from export_columns()
+    clusterer_type: 'binning' or 'knn'
+    function: the keyer or distance function, as for the server
+    params: e.g. {'ngram-size': 2} for ngram-fingerprint, or
+            {'radius': 1, 'blocking-ngram-size': 6} for knn
+    workers: number of processes, by default one per CPU"""
+    counts = _count_values(values)
+    distinct = sorted(counts)
+    params = dict(params or {})
+    if workers is None:
+        # not worth starting processes for a few values
+        workers = min(multiprocessing.cpu_count(), len(distinct) // 1000 + 1)
+    if clusterer_type == 'binning':
+        function = function or 'fingerprint'
+        if function not in KEYERS:
+            raise ValueError('Unknown keyer %r' % function)
+        keyer_params = {}
+        if function == 'ngram-fingerprint':
+            keyer_params['size'] = params.get('ngram-size', 2)
+        jobs = [(function, keyer_params, chunk)
+                for chunk in _chunks(distinct, workers)]
+        bins = collections.defaultdict(list)
+        for chunk, keys in zip([job[2] for job in jobs],
+                               _run(_keys, jobs, workers)):
+            for value, key in zip(chunk, keys):
+                bins[key].append(value)
+        clusters = [cluster for cluster in bins.values() if len(cluster) > 1]
+    elif clusterer_type == 'knn':
+        function = function or 'levenshtein'
+        if function not in DISTANCES:
+            raise ValueError('Unknown distance %r' % function)
+        radius = params.get('radius', 1)
+        size = params.get('blocking-ngram-size', 6)
+        blocks = collections.defaultdict(list)
+        for value in distinct:
+            for ngram in ngrams(_unicode(value), size):
+                blocks[ngram].append(value)
+        blocks = [block for block in blocks.values() if len(block) > 1]
+        jobs = [(function, radius, chunk)
+                for chunk in _chunks(blocks, workers)]
+        neighbours = collections.defaultdict(set)
+        for pairs in _run(_neighbours, jobs, workers):
+            for a, b in pairs:
+                neighbours[a].add(b)
+                neighbours[b].add(a)
+        clusters = set(frozenset([value]) | frozenset(others)
+                       for value, others in neighbours.items())
+    else:
+        raise ValueError('Unknown clusterer type %r' % clusterer_type)
+    return _sorted_clusters(clusters, counts)
+
+
+def _run(func, jobs, workers):
+    """Map func over jobs, in worker processes if more than one."""
+    if workers == 1:
+        return [func(job) for job in jobs]
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(func, jobs)
+    finally:
+        pool.terminate()
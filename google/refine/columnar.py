@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Column-wise storage of exported project data.
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import array
+import collections
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NAN = float('nan')
+
+
+def format_number(number):
+    """Format a float the way it most likely appeared in an export."""
+    if number.is_integer() and abs(number) < 2 ** 53:
+        return '%d' % number
+    return repr(number)
+
+
+class ColumnBuilder(object):
+    """Accumulates one column's values, as numbers while it can.
+
+    While every value is a number or blank the column is kept as an array of
+    doubles, blanks being NaN. Values that wouldn't format back to the same
+    string (e.g. '007') are remembered so that if a non-numeric value turns
+    up later the column can be turned back into its original strings.
+    Strings are interned so repeated values share storage."""
+
+    def __init__(self):
+        self.numbers = array.array('d')
+        self.exceptions = {}    # map of index to original string
+        self.strings = None     # list of strings once non-numeric
+        self.interned = {}
+
+    def append(self, value):
+        if self.strings is None:
+            if value == '':
+                self.numbers.append(NAN)
+                return
+            try:
+                number = float(value)
+            except ValueError:
+                number = NAN
+            if not (math.isnan(number) or math.isinf(number)):
+                if format_number(number) != value:
+                    self.exceptions[len(self.numbers)] = value
+                self.numbers.append(number)
+                return
+            self._to_strings()
+        self.strings.append(self.interned.setdefault(value, value))
+
+    def _to_strings(self):
+        intern = self.interned.setdefault
+        self.strings = []
+        for i, number in enumerate(self.numbers):
+            if i in self.exceptions:
+                value = self.exceptions[i]
+            elif math.isnan(number):
+                value = ''
+            else:
+                value = format_number(number)
+            self.strings.append(intern(value, value))
+        self.numbers = self.exceptions = None
+
+    @property
+    def is_numeric(self):
+        return self.strings is None
+
+    def finish(self):
+        """Return the column as a numpy array (if numpy's available)."""
+        if numpy is None:
+            return self.numbers if self.is_numeric else self.strings
+        if self.is_numeric:
+            return numpy.frombuffer(self.numbers, dtype=numpy.float64)
+        return numpy.array(self.strings, dtype=object)
+
+
+def read_columns(rows, columns=None, as_dataframe=False):
+    """Read rows, a header row first, into columns.
+
+    columns: column names giving the order of the result; defaults to the
+    header's order. A ValueError is raised for any not in the header.
+
+    Exports are UTF-8 bytes while column names from get-models are unicode,
+    so the header is decoded and names are unicode.
+
+    Returns an OrderedDict of column name to column data, or a
+    pandas.DataFrame if as_dataframe."""
+    rows = iter(rows)
+    header = [name if isinstance(name, unicode) else name.decode('utf-8')
+              for name in next(rows, [])]
+    builders = [ColumnBuilder() for _ in header]
+    appends = [builder.append for builder in builders]
+    width = len(appends)
+    for row in rows:
+        if len(row) < width:
+            # Trailing blank cells may be missing
+            row = row + [''] * (width - len(row))
+        for append, value in zip(appends, row):
+            append(value)
+    by_name = dict(zip(header, builders))
+    if columns is None:
+        columns = header
+    missing = [name for name in columns if name not in by_name]
+    if missing:
+        raise ValueError('Columns not in the export: ' +
+                         ', '.join(repr(name) for name in missing))
+    data = collections.OrderedDict(
+        (name, by_name[name].finish()) for name in columns)
+    if as_dataframe:
+        import pandas
+        return pandas.DataFrame(data, columns=list(data))
+    return data
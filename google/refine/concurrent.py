@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+Non-blocking versions of RefineServer and RefineProject.
+
+Python 2 has no asyncio, so requests are run on a bounded pool of worker
+threads shared by all the servers and projects using it, rather than one
+thread per request. Methods return immediately with an AsyncResult; call
+its get() to wait for the value (or exception), or pass callback= to have
+the value handed on as soon as it's ready.
+
+Concurrency is bounded by workers: each request in flight holds a worker
+thread, so at most workers requests run at once and the rest queue behind
+them. wait_until_idle() doesn't hold one between its polls, so waiting on
+many projects doesn't hold up other requests.
+
+    workers = concurrent.AsyncRefineServer(workers=16)
+    projects = [concurrent.AsyncRefineProject(workers, project_id)
+                for project_id in project_ids]
+    results = [p.compute_facets(facet.TextFacet('Party')) for p in projects]
+    for facets_response in concurrent.gather(results):
+        ...
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import heapq
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+from google.refine import facet
+from google.refine import refine
+
+
+def gather(results):
+    """Wait for a list of AsyncResults, returning their values in order."""
+    return [result.get() for result in results]
+
+
+class PendingResult(object):
+    """An AsyncResult for a value made by several requests, set when done."""
+
+    def __init__(self, callback=None):
+        self._callback = callback
+        self._event = threading.Event()
+        self._success = None
+        self._value = None
+
+    def ready(self):
+        return self._event.is_set()
+
+    def successful(self):
+        if not self.ready():
+            raise ValueError('%r not ready' % self)
+        return self._success
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+
+    def get(self, timeout=None):
+        self.wait(timeout)
+        if not self.ready():
+            raise multiprocessing.TimeoutError
+        if self._success:
+            return self._value
+        raise self._value
+
+    def set(self, value):
+        self._success, self._value = True, value
+        if self._callback is not None:
+            self._callback(value)
+        self._event.set()
+
+    def set_exception(self, exception):
+        self._success, self._value = False, exception
+        self._event.set()
+
+
+class AsyncRefineServer(object):
+    """A RefineServer whose requests run on a pool of worker threads."""
+
+    def __init__(self, server=None, workers=8):
+        if isinstance(server, refine.RefineServer):
+            self.server = server
+        else:
+            self.server = refine.RefineServer(server)
+        self.workers = ThreadPool(workers)
+        # functions to submit later, a heap of (time, sequence, func, args)
+        self._timers = []
+        self._timer_sequence = itertools.count()
+        self._timers_changed = threading.Condition()
+        self._timer_thread = None   # started when first needed
+        self._closed = False
+
+    def submit(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) on a worker, returning an AsyncResult.
+
+        A callback keyword argument is called with the result when it's
+        ready."""
+        callback = kwargs.pop('callback', None)
+        return self.workers.apply_async(func, args, kwargs, callback)
+
+    def submit_later(self, delay, func, *args):
+        """Submit func(*args) after delay seconds, without holding a worker
+        meanwhile. One thread waits for all such timers."""
+        with self._timers_changed:
+            heapq.heappush(self._timers, (time.time() + delay,
+                                          next(self._timer_sequence),
+                                          func, args))
+            if self._timer_thread is None:
+                self._timer_thread = threading.Thread(target=self._run_timers)
+                self._timer_thread.daemon = True
+                self._timer_thread.start()
+            self._timers_changed.notify()
+
+    def _run_timers(self):
+        with self._timers_changed:
+            while not self._closed:
+                if not self._timers:
+                    self._timers_changed.wait()
+                    continue
+                delay = self._timers[0][0] - time.time()
+                if delay > 0:
+                    self._timers_changed.wait(delay)
+                    continue
+                _, _, func, args = heapq.heappop(self._timers)
+                self.workers.apply_async(func, args)
+
+    def urlopen(self, *args, **kwargs):
+        return self.submit(self.server.urlopen, *args, **kwargs)
+
+    def urlopen_json(self, *args, **kwargs):
+        return self.submit(self.server.urlopen_json, *args, **kwargs)
+
+    def get_version(self, **kwargs):
+        return self.submit(self.server.get_version, **kwargs)
+
+    def close(self):
+        """Finish outstanding requests and stop the workers.
+
+        Requests not yet submitted by submit_later(), e.g. the polls of
+        wait_until_idle(), are dropped."""
+        with self._timers_changed:
+            self._closed = True
+            self._timers_changed.notify()
+        self.workers.close()
+        self.workers.join()
+
+
+class AsyncRefineProject(object):
+    """A RefineProject whose requests run on an AsyncRefineServer's workers.
+
+    project may be a RefineProject or a project ID (or URL) on the
+    AsyncRefineServer's server. The underlying RefineProject, with its
+    engine and sorting, is available as the project attribute.
+
+    Facets and sorting are applied, and the engine captured, on the calling
+    thread when a request is submitted, so requests in flight together each
+    use the engine as it was when they were made."""
+
+    def __init__(self, async_server, project):
+        self.async_server = async_server
+        if not isinstance(project, refine.RefineProject):
+            project = refine.RefineProject(async_server.server, project)
+        self.project = project
+
+    @property
+    def engine(self):
+        return self.project.engine
+
+    def _submit(self, method, *args, **kwargs):
+        return self.async_server.submit(getattr(self.project, method),
+                                        *args, **kwargs)
+
+    def _engine(self, facets=None):
+        """Return a copy of the project's engine, after setting facets."""
+        engine = self.project.engine
+        if facets:
+            engine.set_facets(facets)
+        return facet.Engine(list(engine.facets), mode=engine.mode)
+
+    def do_json(self, command, data=None, include_engine=True, **kwargs):
+        if include_engine:
+            data = dict(data or {})
+            data['engine'] = self.project.engine.as_json()
+        return self._submit('do_json', command, data, include_engine=False,
+                            **kwargs)
+
+    def get_models(self, **kwargs):
+        return self._submit('get_models', **kwargs)
+
+    def get_rows(self, facets=None, sort_by=None, start=0, limit=10,
+                 **kwargs):
+        engine_json = self._engine(facets).as_json()
+        if sort_by is not None:
+            self.project.sorting = facet.Sorting(sort_by)
+        return self._submit('_get_rows_page', engine_json,
+                            self.project.sorting.as_json(), start, limit,
+                            **kwargs)
+
+    def compute_facets(self, facets=None, **kwargs):
+        engine = self._engine(facets)
+        engine_json = engine.as_json()
+
+        def compute():
+            response = self.project.do_json(
+                'compute-facets', {'engine': engine_json},
+                include_engine=False)
+            return engine.facets_response(response)
+        return self.async_server.submit(compute, **kwargs)
+
+    def apply_operations(self, *args, **kwargs):
+        return self._submit('apply_operations', *args, **kwargs)
+
+    def wait_until_idle(self, polling_delay=0.5, callback=None):
+        """Return a PendingResult set once the project has no processes.
+
+        Each poll is a request of its own, so no worker is held between
+        them."""
+        result = PendingResult(callback)
+        project = self.project
+
+        def poll():
+            try:
+                response = project.do_json('get-processes',
+                                           include_engine=False)
+            except Exception as e:
+                result.set_exception(e)
+                return
+            if response.get('processes'):
+                self.async_server.submit_later(polling_delay, poll)
+            else:
+                project._history_pending = False
+                result.set(None)
+        self.async_server.submit(poll)
+        return result
+
+    def export(self, *args, **kwargs):
+        """The result is the streaming response, read it as usual."""
+        return self._submit('export', *args, **kwargs)
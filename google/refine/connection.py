@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+"""
+Pooled keep-alive HTTP connections to Refine servers.
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import httplib
+import select
+import socket
+import threading
+import time
+import urlparse
+import zlib
+
+CHUNK_SIZE = 65536
+MAX_REDIRECTS = 10
+REDIRECT_CODES = (301, 302, 303, 307)
+# Requests that can safely be sent again if the response was lost
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+def _dropped(sock):
+    """Whether an idle connection's socket has been closed by the server.
+
+    An idle socket has nothing to read unless the server hung up (or sent
+    something unasked for); either way it's unusable. poll() is used where
+    there is one, as select() can't take descriptors past FD_SETSIZE."""
+    try:
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(sock, select.POLLIN)
+            return bool(poller.poll(0))
+        return bool(select.select([sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+class ConnectionPool(object):
+    """A thread safe pool of keep-alive connections, kept per host.
+
+    At most maxsize idle connections are kept for each host; any more are
+    closed when they're released. hits counts requests that went out on an
+    already open connection, misses those that had to open a new one."""
+
+    connection_classes = {
+        'http': httplib.HTTPConnection,
+        'https': httplib.HTTPSConnection,
+    }
+
+    def __init__(self, maxsize=10, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._idle = {}     # map of (scheme, host) to idle connections
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """Return a dict of pool counters."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'idle': sum(len(idle) for idle in self._idle.values()),
+            }
+
+    def _get(self, key, reuse=True):
+        """Return (connection, reused) for a (scheme, host) key."""
+        with self._lock:
+            idle = self._idle.get(key)
+            while reuse and idle:
+                conn = idle.pop()
+                if conn.sock is not None and not _dropped(conn.sock):
+                    self.hits += 1
+                    return conn, True
+                conn.close()
+            self.misses += 1
+        scheme, host = key
+        if self.timeout is None:
+            conn = self.connection_classes[scheme](host)
+        else:
+            conn = self.connection_classes[scheme](host, timeout=self.timeout)
+        return conn, False
+
+    def _put(self, key, conn):
+        """Return a connection to the pool, or close it if the pool's full."""
+        if conn.sock is not None:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.maxsize:
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    @staticmethod
+    def _send(conn, method, selector, body, headers, trace=None):
+        """Send a request whose body may be an iterable of byte chunks.
+
+        Iterable bodies are sent with chunked transfer encoding unless a
+        Content-Length header is given."""
+        if body is None or isinstance(body, basestring):
+            conn.request(method, selector, body, headers)
+            if trace is not None and body:
+                trace.request_bytes += len(body)
+            return
+        header_names = [k.lower() for k in headers]
+        conn.putrequest(
+            method, selector,
+            skip_accept_encoding='accept-encoding' in header_names)
+        chunked = 'content-length' not in header_names
+        for k, v in headers.items():
+            conn.putheader(k, v)
+        if chunked:
+            conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+        for chunk in body:
+            if not chunk:
+                continue
+            if trace is not None:
+                trace.request_bytes += len(chunk)
+            if chunked:
+                conn.send('%x\r\n' % len(chunk))
+                conn.send(chunk)
+                conn.send('\r\n')
+            else:
+                conn.send(chunk)
+        if chunked:
+            conn.send('0\r\n\r\n')
+
+    @staticmethod
+    def _connect(conn, trace):
+        """Open a new connection, timing it if tracing."""
+        if trace is not None:
+            started = time.time()
+            conn.connect()
+            trace.connected(started)
+
+    def _request(self, key, method, selector, body, headers, trace=None,
+                 idempotent=False):
+        # A streamed body can't be sent twice so it gets a new connection
+        # rather than risk one the server has dropped
+        replayable = body is None or isinstance(body, basestring)
+        conn, reused = self._get(key, reuse=replayable)
+        sent = False
+        try:
+            if not reused:
+                self._connect(conn, trace)
+            self._send(conn, method, selector, body, headers, trace)
+            sent = True
+            return conn, conn.getresponse()
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            # Once sent, the server may have acted on a request even though
+            # no response came back, so only idempotent ones are resent
+            if not reused or (sent and not idempotent):
+                raise
+        # The server dropped an idle keep-alive connection; retry once on a
+        # fresh one.
+        conn, _ = self._get(key, reuse=False)
+        try:
+            self._connect(conn, trace)
+            self._send(conn, method, selector, body, headers, trace)
+            return conn, conn.getresponse()
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            raise
+
+    def urlopen(self, method, url, body=None, headers=None, redirect=True,
+                trace=None, idempotent=None):
+        """Issue a request on a pooled connection.
+
+        body may be a string or an iterable of byte chunks to stream.
+        Redirects are followed (with a GET, as urllib2 does) unless redirect
+        is False. trace is an optional instrument.Trace to fill in.
+        idempotent says whether the request may be sent again if a reused
+        connection fails before a response arrives; by default only for
+        IDEMPOTENT_METHODS. Returns a PooledResponse."""
+        if headers is None:
+            headers = {}
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            key = (parts.scheme, parts.netloc)
+            if key[0] not in self.connection_classes:
+                raise ValueError('Unsupported URL scheme: ' + url)
+            selector = parts.path or '/'
+            if parts.query:
+                selector += '?' + parts.query
+            conn, response = self._request(key, method, selector, body,
+                                           headers, trace, idempotent)
+            if trace is not None:
+                trace.responded(response.status)
+            response = PooledResponse(self, key, conn, response, url, trace)
+            if not redirect or response.code not in REDIRECT_CODES:
+                return response
+            response._trace = None     # the trace goes on to the next one
+            location = response.info().get('Location')
+            response.read()
+            response.close()
+            if location is None:
+                return response
+            url = urlparse.urljoin(url, location)
+            method, body, idempotent = 'GET', None, True
+            headers = dict((k, v) for k, v in headers.items()
+                           if k.lower() not in ('content-type',
+                                                'content-length'))
+        raise httplib.HTTPException('Too many redirects for ' + url)
+
+
+class PooledResponse(object):
+    """A file-like response that gives its connection back to the pool.
+
+    The connection is released as soon as the body has been read to the end,
+    so iterating over a response (e.g. an export) returns it automatically.
+    gzip encoded bodies are decompressed as they stream in. A trace is
+    finished once the body has been decoded to its end or on close()."""
+
+    def __init__(self, pool, key, conn, response, url, trace=None):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._buffer = ''
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+        self._decoder = None
+        if self.info().get('Content-Encoding') == 'gzip':
+            # 16 + MAX_WBITS: expect (and check) a gzip header and trailer
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._trace = trace
+        if trace is not None:
+            trace.gzipped = self._decoder is not None
+
+    def info(self):
+        return self._response.msg
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def _release(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            if self._response.isclosed():
+                self._pool._put(self._key, conn)
+            else:
+                conn.close()
+
+    def _finish(self):
+        if self._trace is not None:
+            trace, self._trace = self._trace, None
+            trace.finish()
+
+    def _read_body(self, amt=CHUNK_SIZE):
+        """Return the next piece of the decoded body, or '' at its end.
+
+        gzip bodies are inflated incrementally and at most amt bytes are
+        inflated at a time, so memory stays bounded however large the
+        response is."""
+        while True:
+            if self._decoder is not None and self._decoder.unconsumed_tail:
+                data = self._decoder.unconsumed_tail
+            elif self._conn is None:
+                return ''
+            else:
+                data = self._response.read(amt)
+                if self._trace is not None:
+                    self._trace.response_bytes += len(data)
+                if not data or self._response.isclosed():
+                    self._release()
+                if self._decoder is None:
+                    if self._conn is None:
+                        self._finish()
+                    return data
+            data = self._decoder.decompress(data, amt)
+            done = self._conn is None and not self._decoder.unconsumed_tail
+            if done:
+                data += self._decoder.flush()
+            if self._trace is not None:
+                self._trace.decoded_bytes += len(data)
+                if done:
+                    self._finish()
+            if data:
+                return data
+
+    def read(self, amt=None):
+        if amt is None:
+            chunks, self._buffer = [self._buffer], ''
+            while True:
+                chunk = self._read_body()
+                if not chunk:
+                    return ''.join(chunks)
+                chunks.append(chunk)
+        while len(self._buffer) < amt:
+            chunk = self._read_body()
+            if not chunk:
+                break
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def readline(self):
+        scanned = 0
+        while True:
+            end = self._buffer.find('\n', scanned)
+            if end >= 0:
+                end += 1
+                break
+            scanned = len(self._buffer)
+            chunk = self._read_body()
+            if not chunk:
+                end = len(self._buffer)
+                break
+            self._buffer += chunk
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self._buffer = ''
+        self._release()
+        self._finish()
+
+
+# The pool shared by RefineServers that aren't given one of their own
+POOL = ConnectionPool()
@@ -18,24 +18,49 @@ OpenRefine Facets, Engine, and Facet Responses.
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 
+import collections
 import json
 import re
 
 
+_camel_names = {}
+
+
 def to_camel(attr):
     """convert this_attr_name to thisAttrName."""
-    # Do lower case first letter
-    return (attr[0].lower() +
-            re.sub(r'_(.)', lambda x: x.group(1).upper(), attr[1:]))
+    try:
+        return _camel_names[attr]
+    except KeyError:
+        # Do lower case first letter
+        camel = (attr[0].lower() +
+                 re.sub(r'_(.)', lambda x: x.group(1).upper(), attr[1:]))
+        _camel_names[attr] = camel
+        return camel
+
+
+_snake_names = {}
 
 
 def from_camel(attr):
     """convert thisAttrName to this_attr_name."""
-    # Don't add an underscore for capitalized first letter
-    return re.sub(r'(?<=.)([A-Z])', lambda x: '_' + x.group(1), attr).lower()
+    try:
+        return _snake_names[attr]
+    except KeyError:
+        # Don't add an underscore for capitalized first letter
+        snake = re.sub(r'(?<=.)([A-Z])', lambda x: '_' + x.group(1),
+                       attr).lower()
+        _snake_names[attr] = snake
+        return snake
 
 
 class Facet(object):
+    """A facet, serialized from its public attributes.
+
+    Every attribute assignment bumps _version so an Engine knows when to
+    re-serialize. Changing a mutable attribute in place doesn't, so call
+    changed() after doing that."""
+    _version = 0
+
     def __init__(self, column, facet_type, **options):
         self.type = facet_type
         self.name = column
@@ -43,9 +68,18 @@ class Facet(object):
         for k, v in options.items():
             setattr(self, k, v)
 
+    def __setattr__(self, name, value):
+        super(Facet, self).__setattr__(name, value)
+        if not name.startswith('_'):
+            self.changed()
+
+    def changed(self):
+        """Mark the facet as changed."""
+        self._version += 1
+
     def as_dict(self):
         return dict([(to_camel(k), v) for k, v in self.__dict__.items()
-                     if v is not None])
+                     if v is not None and not k.startswith('_')])
 
 
 class TextFilterFacet(Facet):
@@ -69,28 +103,56 @@ class TextFacet(Facet):
             invert=invert,
             **options)
         self.expression = expression
-        self.selection = []
+        self._selection = collections.OrderedDict()    # value: choice
         if selection is None:
             selection = []
         elif not isinstance(selection, list):
             selection = [selection]
-        for value in selection:
-            self.include(value)
+        self.include_many(selection)
+
+    @property
+    def selection(self):
+        """The selected choices, as a list in the order they were included.
+
+        The list is a copy; include & exclude values to change it."""
+        return self._selection.values()
+
+    @selection.setter
+    def selection(self, selection):
+        self._selection = collections.OrderedDict()
+        self.include_many(s['v']['v'] if isinstance(s, dict) else s
+                          for s in selection)
+
+    def as_dict(self):
+        facet_dict = super(TextFacet, self).as_dict()
+        facet_dict['selection'] = self.selection
+        return facet_dict
 
     def include(self, value):
-        for s in self.selection:
-            if s['v']['v'] == value:
-                return
-        self.selection.append({'v': {'v': value, 'l': value}})
+        return self.include_many([value])
+
+    def include_many(self, values):
+        """Include each of values, keeping those already included."""
+        selection = self._selection
+        for value in values:
+            if value not in selection:
+                selection[value] = {'v': {'v': value, 'l': value}}
+        self.changed()
         return self
 
     def exclude(self, value):
-        self.selection = [s for s in self.selection
-                          if s['v']['v'] != value]
+        return self.exclude_many([value])
+
+    def exclude_many(self, values):
+        selection = self._selection
+        for value in values:
+            selection.pop(value, None)
+        self.changed()
         return self
 
     def reset(self):
-        self.selection = []
+        self._selection.clear()
+        self.changed()
         return self
 
 
@@ -155,23 +217,58 @@ class NumericFacet(Facet):
         return self
 
 
+class FacetChoice(object):
+    __slots__ = ('count', 'selected')
+
+    def __init__(self, c):
+        self.count = c['c']
+        self.selected = c['s']
+
+
+def choice_counts(facet):
+    """Return a raw facet response's choices as a dict of value: count."""
+    return dict([(choice['v']['v'], choice['c'])
+                 for choice in facet.get('choices', [])])
+
+
+class FacetChoices(collections.Mapping):
+    """Read-only mapping of choice value to FacetChoice.
+
+    FacetChoices are only made for the choices looked up."""
+    def __init__(self, choices):
+        self._raw = dict([(choice['v']['v'], choice) for choice in choices])
+        self._choices = {}
+
+    def __getitem__(self, value):
+        try:
+            return self._choices[value]
+        except KeyError:
+            choice = self._choices[value] = FacetChoice(self._raw[value])
+            return choice
+
+    def __contains__(self, value):
+        return value in self._raw
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+
 class FacetResponse(object):
     """Class for unpacking an individual facet response."""
     def __init__(self, facet):
         self.name = None
         for k, v in facet.items():
+            if k in ('choices', 'blankChoice', 'bins', 'baseBins'):
+                continue
             if isinstance(k, bool) or isinstance(k, basestring):
                 setattr(self, from_camel(k), v)
+        self._facet = facet
         self.choices = {}
-
-        class FacetChoice(object):
-            def __init__(self, c):
-                self.count = c['c']
-                self.selected = c['s']
-
         if 'choices' in facet:
-            for choice in facet['choices']:
-                self.choices[choice['v']['v']] = FacetChoice(choice)
+            self.choices = FacetChoices(facet['choices'])
             if 'blankChoice' in facet:
                 self.blank_choice = FacetChoice(facet['blankChoice'])
             else:
@@ -180,6 +277,50 @@ class FacetResponse(object):
             self.bins = facet['bins']
             self.base_bins = facet['baseBins']
 
+    def counts(self):
+        """Return the choices as a plain dict of value: count."""
+        return choice_counts(self._facet)
+
+
+class FacetResponseContainer(object):
+    """The facet responses, looked up by index or by the Engine's Facet.
+
+    Each FacetResponse is unpacked the first time it's looked up."""
+    def __init__(self, engine, facet_responses):
+        self.engine = engine
+        self._raw = facet_responses
+        self._facets = [None] * len(facet_responses)
+
+    def _index(self, index):
+        if not isinstance(index, int):
+            index = self.engine.facet_index_by_id[id(index)]
+        assert self._raw[index].get('name') == self.engine.facets[index].name
+        return index
+
+    def __getitem__(self, index):
+        index = self._index(index)
+        facet = self._facets[index]
+        if facet is None:
+            facet = self._facets[index] = FacetResponse(self._raw[index])
+        return facet
+
+    def __iter__(self):
+        for index in range(len(self._raw)):
+            yield self[index]
+
+    def __len__(self):
+        return len(self._raw)
+
+    @property
+    def facets(self):
+        return list(self)
+
+    def counts(self, index):
+        """Return a facet's choices as a dict of value: count.
+
+        A shortcut that skips unpacking the FacetResponse."""
+        return choice_counts(self._raw[self._index(index)])
+
 
 class FacetsResponse(object):
     """FacetsResponse unpacking the compute-facets response.
@@ -191,23 +332,7 @@ class FacetsResponse(object):
     by the original facet's object.
     """
     def __init__(self, engine, facets):
-        class FacetResponseContainer(object):
-            facets = None
-
-            def __init__(self, facet_responses):
-                self.facets = [FacetResponse(fr) for fr in facet_responses]
-
-            def __iter__(self):
-                for facet in self.facets:
-                    yield facet
-
-            def __getitem__(self, index):
-                if not isinstance(index, int):
-                    index = engine.facet_index_by_id[id(index)]
-                assert self.facets[index].name == engine.facets[index].name
-                return self.facets[index]
-
-        self.facets = FacetResponseContainer(facets['facets'])
+        self.facets = FacetResponseContainer(engine, facets['facets'])
         self.mode = facets['mode']
 
 
@@ -215,6 +340,8 @@ class Engine(object):
     """An Engine keeps track of Facets, and responses to facet computation."""
 
     def __init__(self, *facets, **kwargs):
+        self._json = None
+        self._json_key = None   # (mode, facet ids & versions) of _json
         self.facets = []
         self.facet_index_by_id = {}  # dict of facets by Facet object id
         self.set_facets(*facets)
@@ -223,6 +350,8 @@ class Engine(object):
     def set_facets(self, *facets):
         """facets may be a Facet or list of Facets."""
         self.remove_all()
+        if len(facets) == 1 and isinstance(facets[0], list):
+            facets = facets[0]
         for facet in facets:
             self.add_facet(facet)
 
@@ -234,21 +363,30 @@ class Engine(object):
         return len(self.facets)
 
     def as_json(self):
-        """Return a JSON string suitable for use as a POST parameter."""
-        return json.dumps({
-            'facets': [f.as_dict() for f in self.facets],  # XXX how with json?
-            'mode': self.mode,
-        })
+        """Return a JSON string suitable for use as a POST parameter.
+
+        The string is reused until a facet is added, removed or changed."""
+        key = (self.mode,
+               tuple([(id(f), f._version) for f in self.facets]))
+        if key != self._json_key:
+            self._json = json.dumps({
+                'facets': [f.as_dict() for f in self.facets],
+                'mode': self.mode,
+            })
+            self._json_key = key
+        return self._json
 
     def add_facet(self, facet):
         # Record the facet's object id so facet response can be looked up by id
         self.facet_index_by_id[id(facet)] = len(self.facets)
         self.facets.append(facet)
+        self._json_key = None
 
     def remove_all(self):
         """Remove all facets."""
         self.facet_index_by_id = {}
         self.facets = []
+        self._json_key = None
 
     def reset_all(self):
         """Reset all facets."""
@@ -0,0 +1,613 @@
+#!/usr/bin/env python
+"""
+Evaluate a subset of GREL, OpenRefine's expression language, locally.
+
+For trying out a text_transform() or add_column() expression on a sample of
+a column before sending it to the server:
+
+    preview = project.preview_expression('Name', 'value.trim().toTitlecase()')
+    preview.summary()   # {'rows': 100, 'errors': 0, 'error_rate': 0.0, ...}
+    for value, result in preview:
+        ...
+
+Supported are literals (strings, numbers, true, false, null, /regex/),
+value, the arithmetic and comparison operators, method call syntax
+(value.trim() is trim(value)), indexing & slicing, the controls if, with,
+forNonBlank, forEach & filter, and the functions in FUNCTIONS. Other
+variables (cells, row, recon...) and functions raise a GrelError when the
+expression is compiled.
+
+An expression is evaluated once per distinct value. Errors are returned as
+EvalError values, as OpenRefine puts errors in cells.
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import collections
+import math
+import operator
+import re
+
+from google.refine import clustering
+
+
+class GrelError(ValueError):
+    """An expression that can't be parsed, or uses what isn't supported."""
+
+
+class EvalError(object):
+    """The result of an expression that failed for a value."""
+    __slots__ = ('message',)
+
+    def __init__(self, message):
+        self.message = message
+
+    def __eq__(self, other):
+        return isinstance(other, EvalError) and other.message == self.message
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.message)
+
+    def __repr__(self):
+        return 'EvalError(%r)' % self.message
+
+
+class _Failure(Exception):
+    """Raised inside evaluation, becoming an EvalError."""
+
+
+# Functions. Strings given as arguments are unicode; None (null) usually
+# gives None.
+
+def _null_safe(func):
+    def wrapper(s, *args):
+        if s is None:
+            return None
+        return func(s, *args)
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+def _string(value):
+    if value is None:
+        return u''
+    if isinstance(value, bool):
+        return u'true' if value else u'false'
+    if isinstance(value, float) and value.is_integer():
+        return u'%d' % value
+    if isinstance(value, list):
+        return u'[' + u', '.join(_string(v) for v in value) + u']'
+    return unicode(value)
+
+
+def _is_blank(value):
+    return value is None or value == u''
+
+
+def _is_regex(value):
+    return hasattr(value, 'pattern')
+
+
+def to_number(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return value
+    s = _string(value).strip()
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    try:
+        return float(s)
+    except ValueError:
+        raise _Failure('Cannot parse to number')
+
+
+def _java_replacement(replacement):
+    """Convert Java's $1 group references to Python's \\g<1>."""
+    return re.sub(r'\$(\d+)', r'\\g<\1>', replacement.replace('\\', '\\\\'))
+
+
+@_null_safe
+def replace(s, find, replacement):
+    if _is_regex(find):
+        return find.sub(_java_replacement(replacement), s)
+    return s.replace(_string(find), replacement)
+
+
+@_null_safe
+def replace_chars(s, find, replacement):
+    table = dict((ord(f), r) for f, r in zip(find, replacement))
+    return s.translate(table)
+
+
+@_null_safe
+def split(s, separator):
+    if _is_regex(separator):
+        return separator.split(s)
+    return s.split(separator)
+
+
+@_null_safe
+def match(s, regex):
+    m = regex.match(s)
+    if m is None or m.end() != len(s):
+        return None
+    return list(m.groups())
+
+
+@_null_safe
+def find(s, pattern):
+    if _is_regex(pattern):
+        return [m.group(0) for m in pattern.finditer(s)]
+    return [pattern] * s.count(pattern)
+
+
+@_null_safe
+def contains(s, sub):
+    if _is_regex(sub):
+        return sub.search(s) is not None
+    return sub in s
+
+
+def _slice(s, start, end=None):
+    if s is None:
+        return None
+    return s[int(start):None if end is None else int(end)]
+
+
+def get(o, start, end=None):
+    if end is not None:
+        return _slice(o, start, end)
+    try:
+        return o[int(start)]
+    except (IndexError, TypeError):
+        return None
+
+
+def length(o):
+    return 0 if o is None else len(o)
+
+
+@_null_safe
+def to_titlecase(s):
+    return re.sub(r'\w+', lambda m: m.group(0).capitalize(), s,
+                  flags=re.UNICODE)
+
+
+@_null_safe
+def chomp(s, separator):
+    return s[:-len(separator)] if separator and s.endswith(separator) else s
+
+
+def is_numeric(value):
+    if isinstance(value, bool) or value is None:
+        return False
+    try:
+        to_number(value)
+    except _Failure:
+        return False
+    return True
+
+
+FUNCTIONS = {
+    'and': lambda *args: all(args),
+    'or': lambda *args: any(args),
+    'not': lambda b: not b,
+    'isBlank': _is_blank,
+    'isNonBlank': lambda v: not _is_blank(v),
+    'isNull': lambda v: v is None,
+    'isNotNull': lambda v: v is not None,
+    'isEmptyString': lambda v: v == u'',
+    'isNumeric': is_numeric,
+    'isError': lambda v: isinstance(v, EvalError),
+    'coalesce': lambda *args: next((a for a in args if a is not None), None),
+    'toString': _string,
+    'toNumber': to_number,
+    'length': length,
+    'toLowercase': _null_safe(lambda s: s.lower()),
+    'toUppercase': _null_safe(lambda s: s.upper()),
+    'toTitlecase': to_titlecase,
+    'trim': _null_safe(lambda s: s.strip()),
+    'strip': _null_safe(lambda s: s.strip()),
+    'chomp': chomp,
+    'substring': _slice,
+    'slice': _slice,
+    'get': get,
+    'startsWith': _null_safe(lambda s, sub: s.startswith(sub)),
+    'endsWith': _null_safe(lambda s, sub: s.endswith(sub)),
+    'contains': contains,
+    'indexOf': _null_safe(lambda s, sub: s.find(sub)),
+    'lastIndexOf': _null_safe(lambda s, sub: s.rfind(sub)),
+    'replace': replace,
+    'replaceChars': replace_chars,
+    'split': split,
+    'join': lambda items, separator: separator.join(_string(i)
+                                                    for i in items),
+    'match': match,
+    'find': find,
+    'fingerprint': _null_safe(clustering.fingerprint),
+    'ngramFingerprint': _null_safe(lambda s, size=2:
+                                   clustering.ngram_fingerprint(s, size)),
+    'abs': abs,
+    'round': lambda n: int(math.floor(n + 0.5)),
+    'floor': lambda n: int(math.floor(n)),
+    'ceil': lambda n: int(math.ceil(n)),
+    'min': min,
+    'max': max,
+}
+
+
+# Parsing
+
+TOKENS = re.compile(r'''
+    \s*(?:
+      (?P<number>\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)
+    | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+    | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<regex>/(?:[^/\\]|\\.)*/)
+    | (?P<op>==|!=|<=|>=|[-+*/%<>()\[\],.:])
+    )''', re.VERBOSE)
+ESCAPES = {'n': u'\n', 't': u'\t', 'r': u'\r'}
+# tokens after which a / is division rather than the start of a regex
+OPERANDS = ('number', 'string', 'name', 'regex')
+
+
+def _unquote(token):
+    return re.sub(r'\\(.)', lambda m: ESCAPES.get(m.group(1), m.group(1)),
+                  token[1:-1])
+
+
+def tokenize(source):
+    """Return a list of (kind, text) tokens."""
+    tokens = []
+    position = 0
+    source = source.rstrip()
+    while position < len(source):
+        m = TOKENS.match(source, position)
+        if m is None:
+            raise GrelError('Unexpected %r at %d' % (source[position:],
+                                                     position))
+        kind = m.lastgroup
+        text = m.group(kind)
+        if kind == 'regex' and tokens and (tokens[-1][0] in OPERANDS or
+                                           tokens[-1][1] in (')', ']')):
+            # division, so take just the /
+            kind, text = 'op', '/'
+            position = m.start(m.lastgroup) + 1
+        else:
+            position = m.end()
+        tokens.append((kind, text))
+    return tokens
+
+
+BINARY_OPERATORS = [
+    ('==', '!=', '<', '>', '<=', '>='),
+    ('+', '-'),
+    ('*', '/', '%'),
+]
+CONTROLS = ('if', 'with', 'forNonBlank', 'forEach', 'filter')
+VARIABLES = ('value',)
+
+
+def _add(a, b):
+    if isinstance(a, basestring) or isinstance(b, basestring):
+        return _string(a) + _string(b)
+    return a + b
+
+
+def _divide(a, b):
+    if isinstance(a, (int, long)) and isinstance(b, (int, long)):
+        # Java long division truncates
+        return int(float(a) / b)
+    return float(a) / b
+
+
+OPERATORS = {
+    '==': operator.eq, '!=': operator.ne, '<': operator.lt,
+    '>': operator.gt, '<=': operator.le, '>=': operator.ge,
+    '+': _add, '-': operator.sub, '*': operator.mul, '/': _divide,
+    '%': operator.mod,
+}
+
+
+class _Parser(object):
+    """Recursive descent parser compiling tokens into closures of env."""
+
+    def __init__(self, source):
+        self.tokens = tokenize(source)
+        self.position = 0
+        self.variables = set(VARIABLES)
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self, expected=None):
+        kind, text = self.peek()
+        if kind is None:
+            raise GrelError('Unexpected end of expression')
+        if expected is not None and text != expected:
+            raise GrelError('Expected %r but got %r' % (expected, text))
+        self.position += 1
+        return kind, text
+
+    def parse(self):
+        node = self.expression()
+        if self.peek()[0] is not None:
+            raise GrelError('Unexpected %r' % self.peek()[1])
+        return node
+
+    def expression(self, level=0):
+        if level == len(BINARY_OPERATORS):
+            return self.unary()
+        left = self.expression(level + 1)
+        while (self.peek()[0] == 'op' and
+               self.peek()[1] in BINARY_OPERATORS[level]):
+            func = OPERATORS[self.take()[1]]
+            right = self.expression(level + 1)
+            left = self._binary(func, left, right)
+        return left
+
+    @staticmethod
+    def _binary(func, left, right):
+        return lambda env: func(left(env), right(env))
+
+    def unary(self):
+        if self.peek() == ('op', '-'):
+            self.take()
+            operand = self.unary()
+            return lambda env: -operand(env)
+        return self.postfix(self.primary())
+
+    def postfix(self, node):
+        while True:
+            text = self.peek()[1]
+            if text == '.':
+                self.take()
+                name = self.take()[1]
+                if self.peek()[1] != '(':
+                    raise GrelError('Fields like .%s are not supported' % name)
+                node = self.call(name, [node])
+            elif text == '[':
+                self.take()
+                start = self.expression()
+                end = None
+                is_slice = self.peek()[1] == ':'
+                if is_slice:
+                    self.take()
+                    if self.peek()[1] != ']':
+                        end = self.expression()
+                self.take(']')
+                node = self._index(node, start, end, is_slice)
+            else:
+                return node
+
+    @staticmethod
+    def _index(node, start, end, is_slice):
+        if not is_slice:
+            return lambda env: get(node(env), start(env))
+        if end is None:
+            return lambda env: _slice(node(env), start(env))
+        return lambda env: _slice(node(env), start(env), end(env))
+
+    def arguments(self):
+        self.take('(')
+        args = []
+        if self.peek()[1] != ')':
+            args.append(self.expression())
+            while self.peek()[1] == ',':
+                self.take()
+                args.append(self.expression())
+        self.take(')')
+        return args
+
+    def call(self, name, args):
+        """Compile a call of name; args are any already parsed (the object
+        of method call syntax)."""
+        if name in CONTROLS:
+            return self.control(name, args)
+        if name not in FUNCTIONS:
+            raise GrelError('Function %s is not supported' % name)
+        args = args + self.arguments()
+        func = FUNCTIONS[name]
+
+        def call(env):
+            return func(*[arg(env) for arg in args])
+        return call
+
+    def control(self, name, args):
+        """Controls evaluate their arguments lazily, some binding a
+        variable named by their second argument."""
+        self.take('(')
+        if not args:
+            args.append(self.expression())
+            self.take(',')
+        if name == 'if':
+            condition = args[0]
+            then = self.expression()
+            self.take(',')
+            otherwise = self.expression()
+            self.take(')')
+            return lambda env: (then(env) if _true(condition(env))
+                                else otherwise(env))
+        variable = self.take()[1]
+        self.variables.add(variable)
+        self.take(',')
+        body = self.expression()
+        otherwise = None
+        if name == 'forNonBlank':
+            self.take(',')
+            otherwise = self.expression()
+        self.take(')')
+        subject = args[0]
+
+        def bind(env, value):
+            bound = dict(env)
+            bound[variable] = value
+            return bound
+
+        if name == 'with':
+            return lambda env: body(bind(env, subject(env)))
+        if name == 'forNonBlank':
+            def for_non_blank(env):
+                value = subject(env)
+                if _is_blank(value):
+                    return otherwise(env)
+                return body(bind(env, value))
+            return for_non_blank
+        if name == 'forEach':
+            return lambda env: [body(bind(env, item))
+                                for item in subject(env)]
+        return lambda env: [item for item in subject(env)
+                            if _true(body(bind(env, item)))]
+
+    def primary(self):
+        kind, text = self.take()
+        if kind == 'number':
+            if '.' in text or 'e' in text.lower():
+                value = float(text)
+            else:
+                value = int(text)
+            return lambda env: value
+        if kind == 'string':
+            value = _unquote(text)
+            return lambda env: value
+        if kind == 'regex':
+            value = re.compile(text[1:-1], re.UNICODE)
+            return lambda env: value
+        if text == '(':
+            node = self.expression()
+            self.take(')')
+            return node
+        if kind == 'name':
+            if self.peek()[1] == '(':
+                return self.call(text, [])
+            if text in ('true', 'false', 'null'):
+                value = {'true': True, 'false': False, 'null': None}[text]
+                return lambda env: value
+            if text not in self.variables:
+                raise GrelError('Variable %s is not supported' % text)
+            return lambda env: env[text]
+        raise GrelError('Unexpected %r' % text)
+
+
+def _true(value):
+    if isinstance(value, bool):
+        return value
+    return value is not None
+
+
+def _bind(value):
+    """Return a cell's value as GREL would see it."""
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    if value == u'' or (isinstance(value, float) and value != value):
+        return None     # blank, or NaN from a columnar export
+    return value
+
+
+class Expression(object):
+    """A compiled GREL expression; call it with a cell's value."""
+
+    def __init__(self, source):
+        self.source = source
+        if source.startswith('grel:'):
+            source = source[len('grel:'):]
+        self._evaluate = _Parser(source).parse()
+
+    def __call__(self, value):
+        try:
+            return self._evaluate({'value': _bind(value)})
+        except _Failure as e:
+            return EvalError(str(e))
+        except (ArithmeticError, AttributeError, LookupError, TypeError,
+                ValueError) as e:
+            return EvalError('%s: %s' % (type(e).__name__, e))
+
+    def __repr__(self):
+        return 'Expression(%r)' % self.source
+
+
+def compile(source):
+    """Compile a GREL expression, raising GrelError if unsupported."""
+    return Expression(source)
+
+
+class Preview(object):
+    """An expression's results for a sample of values, in order.
+
+    Iterating gives (value, result) pairs."""
+
+    def __init__(self, expression, values, results):
+        self.expression = expression
+        self.values = values
+        self.results = results
+
+    def __iter__(self):
+        return iter(zip(self.values, self.results))
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def errors(self):
+        """(value, EvalError) pairs of the values that failed."""
+        return [(value, result) for value, result in self
+                if isinstance(result, EvalError)]
+
+    def summary(self):
+        """Return a dict of counts of rows, errors, blank & changed results,
+        and the most common error messages."""
+        errors = self.errors
+        blank = sum(1 for result in self.results if _is_blank(result))
+        changed = sum(1 for value, result in self
+                      if not isinstance(result, EvalError) and
+                      result != _bind(value))
+        messages = collections.Counter(error.message for _, error in errors)
+        return {
+            'rows': len(self),
+            'errors': len(errors),
+            'error_rate': float(len(errors)) / len(self) if self.values else 0,
+            'blank': blank,
+            'changed': changed,
+            'messages': messages.most_common(5),
+        }
+
+
+def preview(expression, values):
+    """Evaluate expression, a string or Expression, for each of values.
+
+    Returns a Preview."""
+    if not isinstance(expression, Expression):
+        expression = compile(expression)
+    values = list(values)
+    cache = {}
+    results = []
+    for value in values:
+        try:
+            result = cache[value]
+        except KeyError:
+            result = cache[value] = expression(value)
+        except TypeError:   # unhashable
+            result = expression(value)
+        results.append(result)
+    return Preview(expression, values, results)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+Instrumentation of the requests a RefineServer makes.
+
+A RefineServer given hooks times each request it makes and, once the response
+has been read (or closed), calls each hook with the request's Trace. Metrics
+is a hook aggregating traces into histograms per command:
+
+    metrics = instrument.Metrics()
+    server = refine.RefineServer(hooks=[metrics])
+    ...
+    print(metrics.prometheus())     # Prometheus text exposition format
+    metrics.snapshot()              # or the same as a dict
+
+Without hooks no Trace is made, so servers not being instrumented pay for
+little more than an if.
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import bisect
+import threading
+import time
+
+# Upper bounds of histogram buckets. Long running commands such as
+# apply-operations on large projects can take minutes.
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+                60, 300)
+BYTE_BUCKETS = tuple(256 * 4 ** i for i in range(12))   # 256B to 1GB
+RATIO_BUCKETS = (1, 1.5, 2, 3, 5, 10, 20, 50)
+
+
+class Trace(object):
+    """Timings and sizes of one request, filled in as it progresses.
+
+    Times are in seconds: connect is that spent opening connections (0 for
+    a reused one), first_byte the time until the response's headers arrived
+    and total until its body was read or it was closed. Byte counts are of
+    bodies: request_bytes as sent, response_bytes as received and
+    decoded_bytes after gunzipping. error is None or a short description,
+    e.g. 'connection' or 'http_500'."""
+
+    def __init__(self, hooks, server, command):
+        self.hooks = hooks
+        self.server = server
+        self.command = command
+        self.start = time.time()
+        self.connect = 0.0
+        self.first_byte = None
+        self.total = None
+        self.status = None
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.decoded_bytes = 0
+        self.gzipped = False
+        self.error = None
+
+    def connected(self, started):
+        """Note a connection opened that began at time started."""
+        self.connect += time.time() - started
+
+    def responded(self, status):
+        self.first_byte = time.time() - self.start
+        self.status = status
+
+    def fail(self, error):
+        self.error = error
+
+    def finish(self):
+        """Complete the trace and pass it to the hooks, once."""
+        if self.total is not None:
+            return
+        self.total = time.time() - self.start
+        if not self.gzipped:
+            self.decoded_bytes = self.response_bytes
+        for hook in self.hooks:
+            hook(self)
+
+    @property
+    def gzip_ratio(self):
+        """Decoded bytes per byte received, or None if not gzipped."""
+        if not self.gzipped or not self.response_bytes:
+            return None
+        return float(self.decoded_bytes) / self.response_bytes
+
+
+class Histogram(object):
+    """Counts of observations at or below each bucket's upper bound."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)     # the last is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Return a list of (upper bound, count), ending with +Inf."""
+        result, total = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def snapshot(self):
+        return {'buckets': self.cumulative(), 'sum': self.sum,
+                'count': self.count}
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _labels(**labels):
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(str(value)))
+                             for name, value in sorted(labels.items()))
+
+
+class Metrics(object):
+    """A hook aggregating Traces into histograms and counters per command.
+
+    Histograms are pre-aggregated as traces arrive, so memory doesn't grow
+    with the number of requests. A Metrics may be shared by servers."""
+
+    # (metric name, Trace attribute, buckets attribute, help)
+    HISTOGRAMS = [
+        ('connect_seconds', 'connect', 'time_buckets',
+         'Time spent opening connections'),
+        ('first_byte_seconds', 'first_byte', 'time_buckets',
+         'Time until response headers arrived'),
+        ('request_seconds', 'total', 'time_buckets',
+         'Time until the response was read'),
+        ('request_bytes', 'request_bytes', 'byte_buckets',
+         'Request body bytes sent'),
+        ('response_bytes', 'response_bytes', 'byte_buckets',
+         'Response body bytes received'),
+        ('decoded_bytes', 'decoded_bytes', 'byte_buckets',
+         'Response body bytes after gunzipping'),
+        ('gzip_ratio', 'gzip_ratio', 'ratio_buckets',
+         'Decoded bytes per byte received of gzipped responses'),
+    ]
+
+    def __init__(self, time_buckets=TIME_BUCKETS, byte_buckets=BYTE_BUCKETS,
+                 ratio_buckets=RATIO_BUCKETS):
+        self.time_buckets = time_buckets
+        self.byte_buckets = byte_buckets
+        self.ratio_buckets = ratio_buckets
+        self._commands = {}     # map of command to {metric name: Histogram}
+        self._errors = {}       # map of (command, error) to count
+        self._lock = threading.Lock()
+
+    def __call__(self, trace):
+        with self._lock:
+            histograms = self._commands.get(trace.command)
+            if histograms is None:
+                histograms = self._commands[trace.command] = dict(
+                    (name, Histogram(getattr(self, buckets)))
+                    for name, _, buckets, _ in self.HISTOGRAMS)
+            for name, attr, _, _ in self.HISTOGRAMS:
+                value = getattr(trace, attr)
+                if value is not None:
+                    histograms[name].observe(value)
+            if trace.error is not None:
+                key = (trace.command, trace.error)
+                self._errors[key] = self._errors.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._commands.clear()
+            self._errors.clear()
+
+    def snapshot(self):
+        """Return a dict of command to its histograms' snapshots & errors.
+
+        {'get-rows': {'request_seconds': {'buckets': [(0.005, 3), ...],
+                                          'sum': 0.12, 'count': 10},
+                      ...
+                      'errors': {'http_500': 1}}}"""
+        with self._lock:
+            result = {}
+            for command, histograms in self._commands.items():
+                result[command] = dict(
+                    (name, histogram.snapshot())
+                    for name, histogram in histograms.items())
+                result[command]['errors'] = {}
+            for (command, error), count in self._errors.items():
+                result[command]['errors'][error] = count
+            return result
+
+    def prometheus(self, prefix='refine_client'):
+        """Return the metrics in Prometheus' text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, _, _, help_text in self.HISTOGRAMS:
+            metric = prefix + '_' + name
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s histogram' % metric)
+            for command in sorted(snapshot):
+                histogram = snapshot[command][name]
+                for bound, count in histogram['buckets']:
+                    lines.append('%s_bucket%s %d' % (
+                        metric, _labels(command=command,
+                                        le=_format_value(bound)), count))
+                labels = _labels(command=command)
+                lines.append('%s_sum%s %s' % (
+                    metric, labels, _format_value(histogram['sum'])))
+                lines.append('%s_count%s %d' % (
+                    metric, labels, histogram['count']))
+        metric = prefix + '_errors_total'
+        lines.append('# HELP %s Requests that failed' % metric)
+        lines.append('# TYPE %s counter' % metric)
+        for command in sorted(snapshot):
+            for error, count in sorted(snapshot[command]['errors'].items()):
+                lines.append('%s%s %d' % (
+                    metric, _labels(command=command, error=error), count))
+        return '\n'.join(lines) + '\n'
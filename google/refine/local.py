@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+"""
+Compute facets locally over a project's exported data.
+
+A LocalEngine holds a columnar copy of a project, as returned by
+RefineProject.export_columns(), and evaluates an Engine's facets against it
+with numpy rather than asking the server, returning the same FacetsResponse
+as RefineProject.compute_facets().
+
+    local_engine = local.LocalEngine.from_project(project)
+    response = local_engine.compute_facets(facet.TextFacet('Party Code'))
+    response.facets[0].choices['D'].count
+
+Each column is factorized once into its distinct values and an array of
+codes, so facets cost a pass over the codes rather than the strings.
+Exports don't carry types so choices are the exported strings, and only
+row-based mode is supported. Facet expressions are evaluated with grel, so
+are limited to the GREL it supports.
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import math
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from google.refine import columnar
+from google.refine import facet
+from google.refine import grel
+
+# shortcuts for common facet expressions, as functions of a value; others
+# are evaluated with grel
+EXPRESSIONS = {
+    'isBlank(value)': lambda value: value == '',
+    'isNonBlank(value)': lambda value: value != '',
+}
+
+
+def _label(value):
+    """Return the exported string a value would appear as, so values
+    and selections compare alike."""
+    if isinstance(value, bool) or isinstance(value, str) or value is None:
+        return value
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (int, long, float)):
+        return columnar.format_number(float(value))
+    return value
+
+
+def _display(label):
+    """Return a choice's label as OpenRefine shows it, e.g. true."""
+    if isinstance(label, bool):
+        return 'true' if label else 'false'
+    return _label(label)
+
+
+def _is_blank(label):
+    return label is None or label == ''
+
+
+def _is_error(label):
+    return isinstance(label, grel.EvalError)
+
+
+def factorize(values):
+    """Return (labels, codes) of a column: its distinct values as strings
+    ('' for blanks) and an int array indexing them for each row."""
+    if values.dtype.kind == 'f':
+        blank = numpy.isnan(values)
+        numbers, codes = numpy.unique(values[~blank], return_inverse=True)
+        labels = numpy.array([''] + [columnar.format_number(n)
+                                     for n in numbers], dtype=object)
+        all_codes = numpy.zeros(len(values), dtype=numpy.intp)
+        all_codes[~blank] = codes + 1
+        return labels, all_codes
+    # a dict beats sorting strings with numpy.unique
+    index = {}
+    setdefault = index.setdefault
+    codes = numpy.fromiter((setdefault(value, len(index)) for value in values),
+                           dtype=numpy.intp, count=len(values))
+    labels = numpy.empty(len(index), dtype=object)
+    for value, code in index.items():
+        labels[code] = value
+    return labels, codes
+
+
+def _refactorize(labels, codes, func):
+    """Apply func to each label, merging labels that give equal results."""
+    results = [func(label) for label in labels]
+    # arrays can't be dict keys
+    results = [tuple(r) if isinstance(r, list) else r for r in results]
+    new_labels = []
+    index = {}
+    mapping = numpy.empty(len(results), dtype=numpy.intp)
+    for i, result in enumerate(results):
+        if result not in index:
+            index[result] = len(new_labels)
+            new_labels.append(result)
+        mapping[i] = index[result]
+    return numpy.array(new_labels, dtype=object), mapping[codes]
+
+
+def _to_number(label):
+    if isinstance(label, bool):
+        return float('nan')
+    try:
+        number = float(label)
+    except (TypeError, ValueError):
+        return float('nan')
+    return number if not math.isinf(number) else float('nan')
+
+
+def bin_layout(lowest, highest):
+    """Return (min, max, step, bin count) as OpenRefine's NumericBinIndex."""
+    if lowest >= highest:
+        return lowest, lowest + 1, 1, 1
+    diff = highest - lowest
+    step = 1.0
+    if diff > 10:
+        while step * 100 < diff:
+            step *= 10
+    else:
+        while step * 100 > diff:
+            step /= 10
+    minimum = math.floor(lowest / step) * step
+    maximum = math.ceil(highest / step) * step
+    count = (maximum - minimum) / step
+    if count > 100:
+        # at most about 100 bins; max isn't rounded up to the new step
+        step *= 2
+        count = (count + 1) / 2
+    if maximum <= highest:
+        # the highest value needs a bin of its own
+        maximum += step
+        count += 1
+    return minimum, maximum, step, int(round(count))
+
+
+class LocalEngine(object):
+    """Evaluates an Engine's facets over columns of project data.
+
+    data: OrderedDict of column name to column array, e.g. from
+          RefineProject.export_columns()
+    engine: the Engine whose facets are computed, by default a new one"""
+
+    def __init__(self, data, engine=None):
+        if numpy is None:
+            raise ImportError('LocalEngine needs numpy')
+        self.data = data
+        self.engine = facet.Engine() if engine is None else engine
+        self.row_count = len(next(iter(data.values()))) if data else 0
+        self._factors = {}  # map of (column, expression) to (labels, codes)
+
+    @classmethod
+    def from_project(cls, project, engine=None):
+        """Export a project and make a LocalEngine sharing its Engine."""
+        if engine is None:
+            engine = project.engine
+        return cls(project.export_columns(), engine)
+
+    def _factor(self, column, expression='value'):
+        """Return (labels, codes) of an expression evaluated over a column."""
+        key = (column, expression)
+        if key not in self._factors:
+            func = None
+            if expression != 'value':
+                func = EXPRESSIONS.get(expression)
+                if func is None:
+                    # raises GrelError, a ValueError, if unsupported
+                    func = grel.compile(expression)
+            if column not in self.data:
+                raise KeyError('No column %r' % column)
+            if func is None:
+                self._factors[key] = factorize(self.data[column])
+            else:
+                self._factors[key] = _refactorize(
+                    *self._factor(column), func=func)
+        return self._factors[key]
+
+    def _numbers(self, column, expression):
+        """Return a column's values as floats, with masks of the blank,
+        non-numeric and error ones."""
+        values = self.data[column]
+        if expression == 'value' and values.dtype.kind == 'f':
+            blank = numpy.isnan(values)
+            none = numpy.zeros(len(values), dtype=bool)
+            return values, blank, none, none
+        labels, codes = self._factor(column, expression)
+        numbers = numpy.array([_to_number(label) for label in labels])
+        label_blank = numpy.array([_is_blank(label) for label in labels],
+                                  dtype=bool)
+        label_error = numpy.array([_is_error(label) for label in labels],
+                                  dtype=bool)
+        values = numbers[codes]
+        blank = label_blank[codes]
+        error = label_error[codes]
+        return values, blank, numpy.isnan(values) & ~blank & ~error, error
+
+    def _mask(self, f):
+        """Return a boolean array of the rows a facet selects, or None if
+        it selects every row."""
+        if f.type == 'list':
+            labels, codes = self._factor(f.column_name, f.expression)
+            selected = set(_label(s['v']['v']) for s in f.selection)
+            if not (selected or f.select_blank or f.select_error):
+                return None
+            chosen = numpy.array([
+                (f.select_blank if _is_blank(label) else
+                 f.select_error if _is_error(label) else
+                 _label(label) in selected)
+                for label in labels], dtype=bool)
+            mask = chosen[codes]
+        elif f.type == 'range':
+            if f.From is None and f.to is None and (
+                    f.select_numeric and f.select_non_numeric and
+                    f.select_blank and f.select_error):
+                return None
+            values, blank, non_numeric, error = self._numbers(f.column_name,
+                                                              f.expression)
+            numeric = ~(blank | non_numeric | error)
+            with numpy.errstate(invalid='ignore'):
+                in_range = numeric & f.select_numeric
+                if f.From is not None:
+                    in_range &= values >= f.From
+                if f.to is not None:
+                    in_range &= values < f.to
+            mask = in_range | (blank & f.select_blank)
+            mask |= non_numeric & f.select_non_numeric
+            mask |= error & f.select_error
+        elif f.type == 'text':
+            if not f.query:
+                return None
+            labels, codes = self._factor(f.column_name)
+            if getattr(f, 'mode', 'text') == 'regex':
+                pattern = re.compile(
+                    f.query, 0 if f.case_sensitive else re.IGNORECASE)
+                chosen = [pattern.search(label) is not None
+                          for label in labels]
+            elif f.case_sensitive:
+                chosen = [f.query in label for label in labels]
+            else:
+                query = f.query.lower()
+                chosen = [query in label.lower() for label in labels]
+            mask = numpy.array(chosen, dtype=bool)[codes]
+        else:
+            raise ValueError('Facet type %r not supported locally' % f.type)
+        if getattr(f, 'invert', False):
+            mask = ~mask
+        return mask
+
+    def _list_facet(self, f, rows):
+        labels, codes = self._factor(f.column_name, f.expression)
+        counts = numpy.bincount(codes[rows], minlength=len(labels))
+        selected = set(_label(s['v']['v']) for s in f.selection)
+        choices = []
+        blank_count = error_count = 0
+        for label, count in zip(labels, counts):
+            if _is_blank(label):
+                blank_count += int(count)
+            elif _is_error(label):
+                error_count += int(count)
+            elif count or _label(label) in selected:
+                choices.append({'v': {'v': label, 'l': _display(label)},
+                                'c': int(count),
+                                's': _label(label) in selected})
+        response = {'name': f.name, 'columnName': f.column_name,
+                    'expression': f.expression, 'invert': f.invert,
+                    'choices': choices}
+        if not f.omit_blank:
+            response['blankChoice'] = {'s': f.select_blank, 'c': blank_count}
+        if not f.omit_error:
+            response['errorChoice'] = {'s': f.select_error, 'c': error_count}
+        return response
+
+    def _range_facet(self, f, rows):
+        values, blank, non_numeric, error = self._numbers(f.column_name,
+                                                          f.expression)
+        numeric = ~(blank | non_numeric | error)
+        response = {'name': f.name, 'columnName': f.column_name,
+                    'expression': f.expression}
+        for name, mask in (('numericCount', numeric),
+                           ('nonNumericCount', non_numeric),
+                           ('blankCount', blank),
+                           ('errorCount', error)):
+            response[name] = int((mask & rows).sum())
+            response['base' + name[0].upper() + name[1:]] = int(mask.sum())
+        if not numeric.any():
+            return response
+        base_values = values[numeric]
+        minimum, maximum, step, count = bin_layout(base_values.min(),
+                                                   base_values.max())
+        response.update({'min': float(minimum), 'max': float(maximum),
+                         'step': step})
+        for name, bin_values in (('baseBins', base_values),
+                                 ('bins', values[numeric & rows])):
+            bins = numpy.floor((bin_values - minimum) / step).astype(int)
+            response[name] = numpy.bincount(
+                numpy.clip(bins, 0, count - 1), minlength=count).tolist()
+        response['from'] = minimum if f.From is None else f.From
+        response['to'] = maximum if f.to is None else f.to
+        return response
+
+    def _text_facet(self, f, rows):
+        return {'name': f.name, 'columnName': f.column_name,
+                'query': f.query, 'mode': getattr(f, 'mode', 'text'),
+                'caseSensitive': f.case_sensitive,
+                'invert': getattr(f, 'invert', False)}
+
+    def _masks(self):
+        if self.engine.mode != 'row-based':
+            raise ValueError('LocalEngine only supports row-based mode')
+        return [self._mask(f) for f in self.engine.facets]
+
+    def _all_rows(self):
+        return numpy.ones(self.row_count, dtype=bool)
+
+    def filter(self, facets=None):
+        """Return a boolean array of the rows selected by every facet."""
+        if facets:
+            self.engine.set_facets(facets)
+        rows = self._all_rows()
+        for mask in self._masks():
+            if mask is not None:
+                rows &= mask
+        return rows
+
+    def filtered(self, facets=None):
+        """Return the data of the rows selected, as an OrderedDict."""
+        rows = self.filter(facets)
+        return type(self.data)((name, values[rows])
+                               for name, values in self.data.items())
+
+    def compute_facets(self, facets=None):
+        """Compute facets as RefineProject.compute_facets() would.
+
+        As in OpenRefine each facet's counts are over the rows selected by
+        every other facet."""
+        if facets:
+            self.engine.set_facets(facets)
+        masks = self._masks()
+        responses = []
+        for i, f in enumerate(self.engine.facets):
+            rows = self._all_rows()
+            for j, mask in enumerate(masks):
+                if j != i and mask is not None:
+                    rows &= mask
+            if f.type == 'list':
+                responses.append(self._list_facet(f, rows))
+            elif f.type == 'range':
+                responses.append(self._range_facet(f, rows))
+            else:
+                responses.append(self._text_facet(f, rows))
+        return self.engine.facets_response({'mode': self.engine.mode,
+                                            'facets': responses})
@@ -18,24 +18,122 @@ Client library to communicate with a Refine server.
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 
+import collections
+import contextlib
 import csv
 import json
-import gzip
+import httplib
 import os
+import Queue
 import re
-import StringIO
+import socket
+import threading
 import time
 import urllib
-import urllib2_file
 import urllib2
 import urlparse
+from multiprocessing.pool import ThreadPool
 
+from google.refine import cache
+from google.refine import columnar
+from google.refine import connection
 from google.refine import facet
+from google.refine import grel
 from google.refine import history
+from google.refine import instrument
+from google.refine import shard
+from google.refine import upload
 
 REFINE_HOST = os.environ.get('OPENREFINE_HOST', os.environ.get('GOOGLE_REFINE_HOST', '127.0.0.1'))
 REFINE_PORT = os.environ.get('OPENREFINE_PORT', os.environ.get('GOOGLE_REFINE_PORT', '3333'))
 
+# Commands POSTed that only read, so can be sent again if a response is lost
+IDEMPOTENT_COMMANDS = cache.READ_ONLY_COMMANDS + ('export-rows',)
+
+
+class ProjectMetadataCache(object):
+    """Thread safe cache of project metadata, shared between servers.
+
+    Entries are kept per server URL for ttl seconds. A single project's
+    metadata is looked up with get-project-metadata rather than downloading
+    every project's. hits and misses count lookups served from the cache and
+    those that went to a server."""
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._listings = {}     # map of server URL to (time, projects)
+        self._projects = {}     # map of (server URL, project id) to (time, metadata)
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """Return a dict of cache counters."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'listings': len(self._listings),
+                    'projects': len(self._projects)}
+
+    def _fresh(self, entry):
+        if entry is not None and time.time() - entry[0] < self.ttl:
+            return entry[1]
+        return None
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def projects(self, server):
+        """Return a dict of all projects on a RefineServer indexed by id."""
+        projects = self._fresh(self._listings.get(server.server))
+        self._count(projects is not None)
+        if projects is None:
+            projects = server.urlopen_json(
+                'get-all-project-metadata')['projects']
+            self._listings[server.server] = (time.time(), projects)
+        return dict(projects)
+
+    def project(self, server, project_id):
+        """Return the metadata of one project on a RefineServer."""
+        projects = self._fresh(self._listings.get(server.server))
+        if projects is not None and project_id in projects:
+            self._count(True)
+            return projects[project_id]
+        key = (server.server, project_id)
+        metadata = self._fresh(self._projects.get(key))
+        if metadata is not None:
+            self._count(True)
+            return metadata
+        try:
+            metadata = server.urlopen_json('get-project-metadata',
+                                           params={'project': project_id})
+        except Exception:
+            # get-project-metadata is new in OpenRefine 2.6
+            metadata = self.projects(server)[project_id]
+        else:
+            self._count(False)
+        self._projects[key] = (time.time(), metadata)
+        return metadata
+
+    def invalidate(self, server=None, project_id=None):
+        """Forget a project's metadata, a server's, or everything."""
+        with self._lock:
+            if server is None:
+                self._listings.clear()
+                self._projects.clear()
+                return
+            self._listings.pop(server.server, None)
+            for key in self._projects.keys():
+                if key[0] == server.server and project_id in (None, key[1]):
+                    del self._projects[key]
+
+
+# The cache shared by RefineServers that aren't given one of their own
+METADATA_CACHE = ProjectMetadataCache()
+
 
 class RefineServer(object):
     """Communicate with a Refine server."""
@@ -48,20 +146,33 @@ class RefineServer(object):
             server += ':' + REFINE_PORT
         return server
 
-    def __init__(self, server=None):
+    def __init__(self, server=None, pool=None, metadata_cache=None,
+                 response_cache=None, hooks=None):
         if server is None:
             server = self.url()
         self.server = server[:-1] if server.endswith('/') else server
+        # Servers share the module's pool & cache unless given their own
+        self.pool = connection.POOL if pool is None else pool
+        if metadata_cache is None:
+            metadata_cache = METADATA_CACHE
+        self.metadata_cache = metadata_cache
+        # Caching project responses is opt-in, see cache.ResponseCache
+        self.response_cache = response_cache
+        # Callables given each request's instrument.Trace, e.g. a Metrics
+        self.hooks = list(hooks or [])
         self.__version = None     # see version @property below
 
-    def urlopen(self, command, data=None, params=None, project_id=None):
+    def urlopen(self, command, data=None, params=None, project_id=None,
+                progress=None):
         """Open a Refine URL and with optional query params and POST data.
 
-        data: POST data dict
+        data: POST data dict; files to upload are given as
+              {'fd': path, file object or iterable, 'filename': name}
         param: query params dict
         project_id: project ID as string
+        progress: callback for upload progress, see upload.MultipartUpload
 
-        Returns urllib2.urlopen iterable."""
+        Returns an iterable file-like response."""
         url = self.server + '/command/core/' + command
         if data is None:
             data = {}
@@ -75,23 +186,39 @@ class RefineServer(object):
                 params['project'] = project_id
         if params:
             url += '?' + urllib.urlencode(params)
-        req = urllib2.Request(url)
-        if data:
-            req.add_data(data)  # data = urllib.urlencode(data)
-        #req.add_header('Accept-Encoding', 'gzip')
+        method, body, headers = 'GET', None, {'Accept-Encoding': 'gzip'}
+        if any(upload.is_file_part(v) for v in data.values()):
+            method = 'POST'
+            body = upload.MultipartUpload(data, progress=progress)
+            headers['Content-Type'] = body.content_type
+            if body.length is not None:
+                headers['Content-Length'] = str(body.length)
+        elif data:
+            method, body = 'POST', urllib.urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        trace = None
+        if self.hooks:
+            # export-rows/<project name>.<format> is still export-rows
+            trace = instrument.Trace(self.hooks, self.server,
+                                     command.split('/')[0])
         try:
-            response = urllib2.urlopen(req)
-        except urllib2.HTTPError as e:
-            raise Exception('HTTP %d "%s" for %s\n\t%s' % (e.code, e.msg, e.geturl(), data))
-        except urllib2.URLError as e:
+            response = self.pool.urlopen(
+                method, url, body, headers, trace=trace,
+                idempotent=method == 'GET' or
+                command.split('/')[0] in IDEMPOTENT_COMMANDS)
+        except (socket.error, httplib.HTTPException) as e:
+            if trace is not None:
+                trace.fail('connection')
+                trace.finish()
             raise urllib2.URLError(
                 '%s for %s. No Refine server reachable/running; ENV set?' %
-                (e.reason, self.server))
-        if response.info().get('Content-Encoding', None) == 'gzip':
-            # Need a seekable filestream for gzip
-            gzip_fp = gzip.GzipFile(fileobj=StringIO.StringIO(response.read()))
-            # XXX Monkey patch response's filehandle. Better way?
-            urllib.addbase.__init__(response, gzip_fp)
+                (e, self.server))
+        if response.code >= 400:
+            if trace is not None:
+                trace.fail('http_%d' % response.code)
+            response.close()
+            raise Exception('HTTP %d "%s" for %s\n\t%s' % (
+                response.code, response.msg, response.geturl(), data))
         return response
 
     def urlopen_json(self, *args, **kwargs):
@@ -136,12 +263,12 @@ class Refine:
         """
         # It's tempting to add in an index by name but there can be
         # projects with the same name.
-        return self.server.urlopen_json('get-all-project-metadata')['projects']
+        return self.server.metadata_cache.projects(self.server)
 
     def get_project_name(self, project_id):
         """Returns project name given project_id."""
-        projects = self.list_projects()
-        return projects[project_id]['name']
+        return self.server.metadata_cache.project(self.server,
+                                                  project_id)['name']
 
     def open_project(self, project_id):
         """Open a Refine project."""
@@ -220,8 +347,18 @@ class Refine:
                     process_quotes=True,
                     store_blank_cells_as_nulls=True,
                     include_file_sources=False,
+                    progress=None,
+                    compress=False,
                     **opts):
+        """Create a project from a file or URL, returning a RefineProject.
 
+        project_file may be a path, a file object or an iterable of byte
+        chunks; it's streamed to the server. progress, if given, is called
+        as progress(bytes_sent, total_bytes) as the upload proceeds;
+        total_bytes is None when it can't be known in advance.
+
+        gzip and bzip2 compressed files are sent as they are for the server
+        to unpack. With compress=True other files are gzipped on the way."""
         if (project_file and project_url) or (not project_file and not project_url):
             raise ValueError('One (only) of project_file and project_url must be set')
 
@@ -258,81 +395,520 @@ class Refine:
 
         if project_url is not None:
             options['url'] = project_url
-        elif project_file is not None:
-            options['project-file'] = {
-                'fd': open(project_file),
-                'filename': project_file,
+        if isinstance(project_file, basestring):
+            filename = project_file
+        else:
+            filename = getattr(project_file, 'name', None)
+        if project_file is not None:
+            project_file, compression = upload.sniff_compression(project_file)
+            if compression is None and compress:
+                project_file = upload.gzip_source(project_file)
+                compression = upload.GZIP
+            part = {
+                'fd': project_file,
+                'filename': filename or project_name or 'New project',
             }
+            if compression is not None:
+                # The server recognises archives by name or content type
+                magic, suffix, part['content_type'] = compression
+                if not part['filename'].endswith(suffix):
+                    part['filename'] += suffix
+                if filename is not None and filename.endswith(suffix):
+                    filename = filename[:-len(suffix)]
+            options['project-file'] = part
         if project_name is None:
             # make a name for itself by stripping extension and directories
-            project_name = (project_file or 'New project').rsplit('.', 1)[0]
+            project_name = (filename or 'New project').rsplit('.', 1)[0]
             project_name = os.path.basename(project_name)
         options['project-name'] = project_name
         response = self.server.urlopen(
-            'create-project-from-upload', options, params
+            'create-project-from-upload', options, params, progress=progress
         )
+        response.close()
         # expecting a redirect to the new project containing the id in the url
         url_params = urlparse.parse_qs(
             urlparse.urlparse(response.geturl()).query)
         if 'project' in url_params:
             project_id = url_params['project'][0]
+            self.server.metadata_cache.invalidate(self.server)
             return RefineProject(self.server, project_id)
         else:
             raise Exception('Project not created')
 
+    def new_sharded_project(self, path, shards=4, workers=None,
+                            project_name=None, ignore_lines=-1,
+                            header_lines=1, skip_data_lines=0,
+                            process_quotes=True, **opts):
+        """Import an *sv file as shards, concurrently, in sibling projects.
+
+        The file is split on row boundaries (respecting quoted newlines when
+        process_quotes) and every shard gets the file's header. Up to
+        workers shards, default all of them, are uploaded at once. Other
+        options are as for new_project().
+
+        Returns a shard.ShardedProject."""
+        if upload.sniff_compression(path)[1] is not None:
+            raise ValueError("Compressed files can't be sharded")
+        header_end, ranges = shard.split_file(
+            path, shards, max(ignore_lines, 0) + header_lines, process_quotes)
+        if not ranges:
+            # no data rows; a single shard of just the header
+            ranges = [(header_end, header_end)]
+        with open(path, 'rb') as fp:
+            header = fp.read(header_end)
+        if project_name is None:
+            project_name = os.path.basename(path).rsplit('.', 1)[0]
+
+        def create(args):
+            i, (start, end) = args
+            try:
+                return True, self.new_project(
+                    project_file=shard.iter_range(path, start, end, header),
+                    project_name='%s %d/%d' % (project_name, i + 1,
+                                               len(ranges)),
+                    ignore_lines=ignore_lines, header_lines=header_lines,
+                    skip_data_lines=skip_data_lines if i == 0 else 0,
+                    process_quotes=process_quotes, **opts)
+            except Exception as e:
+                return False, e
+
+        pool = ThreadPool(workers or len(ranges))
+        try:
+            results = pool.map(create, enumerate(ranges))
+        finally:
+            pool.terminate()
+        errors = [value for ok, value in results if not ok]
+        if errors:
+            # don't leave the shards that were made behind
+            for ok, project in results:
+                if ok:
+                    try:
+                        project.delete()
+                    except Exception:
+                        pass
+            raise errors[0]
+        return shard.ShardedProject([project for _, project in results])
+
+    def new_project_from_rows(self, rows, columns=None,
+                              project_name='New project', separator=',',
+                              **opts):
+        """Create a project from an iterable of rows, without a temp file.
+
+        Rows are sequences of values, serialized as CSV while they're
+        uploaded. columns, if given, are the column names. Other options are
+        as for new_project()."""
+        if columns is not None:
+            opts.setdefault('header_lines', 1)
+        else:
+            opts.setdefault('header_lines', 0)
+        return self.new_project(
+            project_file=upload.csv_chunks(rows, columns, separator),
+            project_name=project_name, separator=separator, **opts)
+
+    def new_project_from_dataframe(self, df, project_name='New project',
+                                   index=False, **opts):
+        """Create a project from a pandas DataFrame.
+
+        With index=True the DataFrame's index is sent as the first column.
+        Other options are as for new_project()."""
+        columns = [unicode(column) for column in df.columns]
+        if index:
+            columns.insert(0, unicode(df.index.name or 'index'))
+        return self.new_project_from_rows(
+            df.itertuples(index=index), columns, project_name, **opts)
+
+
+class RefineCluster(object):
+    """Several Refine servers used as one.
+
+    New projects are placed on the least loaded server: the one whose
+    queued processes, on the projects the cluster placed there, multiplied
+    by its recent response latency, are least. Latency is a moving average
+    of the time to first byte of each server's requests, seen through a
+    hook. Queue depths are reused for depths_ttl seconds, counting each
+    project placed meanwhile as a process, so placing many projects at once
+    doesn't ask about every placed project each time.
+
+    Projects deleted through the cluster's projects are forgotten, as are
+    those a server no longer has.
+
+    Which server holds each project is remembered, so projects are opened
+    by id alone and their requests go to that server:
+
+        cluster = refine.RefineCluster(['http://refine1:3333',
+                                        'http://refine2:3333'])
+        project = cluster.new_project(project_file='data.csv')
+        ...
+        project = cluster.open_project(project_id)
+    """
+
+    def __init__(self, servers, latency_weight=0.3, depths_ttl=1.0):
+        self.servers = [server if isinstance(server, RefineServer)
+                        else RefineServer(server) for server in servers]
+        if not self.servers:
+            raise ValueError('A RefineCluster needs at least one server')
+        # weight of the latest response time in the moving average
+        self.latency_weight = latency_weight
+        self.latency = dict((server.server, None) for server in self.servers)
+        self.depths_ttl = depths_ttl
+        self._depths = None     # (time, queue_depths()) as by_load() saw
+        self._owners = {}       # map of project id to RefineServer
+        self._placed = set()    # ids of the projects new_project() made
+        self._lock = threading.Lock()
+        self._pool = None       # made when first needed
+        for server in self.servers:
+            server.hooks.append(self._observe)
+
+    def _observe(self, trace):
+        """Hook updating a server's latency from a request's trace."""
+        with self._lock:
+            if trace.first_byte is None:
+                # unreachable; don't place anything there until it responds
+                self.latency[trace.server] = float('inf')
+                return
+            previous = self.latency.get(trace.server)
+            if previous is None or previous == float('inf'):
+                self.latency[trace.server] = trace.first_byte
+            else:
+                self.latency[trace.server] = previous + self.latency_weight * (
+                    trace.first_byte - previous)
 
-def RowsResponseFactory(column_index):
-    """Factory for the parsing the output from get_rows().
+    def _queue_depth(self, args):
+        server, project_id = args
+        try:
+            response = server.urlopen_json('get-processes',
+                                           project_id=project_id)
+        except Exception as e:
+            if "Can't find project" in str(e):
+                self.forget(project_id)     # deleted by someone else
+            return 0
+        return len(response.get('processes', []))
+
+    def _map(self, func, items):
+        """Map func over items concurrently, a thread per server."""
+        items = list(items)
+        if len(items) < 2:
+            return [func(item) for item in items]
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(len(self.servers))
+            pool = self._pool
+        return pool.map(func, items)
+
+    def close(self):
+        """Stop the threads making requests to the servers."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.terminate()
+
+    def queue_depths(self):
+        """Return a dict of server URL to its placed projects' processes.
+
+        Only projects this cluster placed are asked about, not every one
+        a server holds, so placing stays a request per placed project."""
+        with self._lock:
+            placed = [(self._owners[project_id], project_id)
+                      for project_id in self._placed]
+        depths = dict((server.server, 0) for server in self.servers)
+        counts = self._map(self._queue_depth, placed)
+        for (server, _), count in zip(placed, counts):
+            depths[server.server] += count
+        return depths
+
+    def by_load(self):
+        """Return the servers, least loaded first.
+
+        Servers yet to respond are tried first, so each gets measured."""
+        with self._lock:
+            recent = self._depths
+        if recent is None or time.time() - recent[0] > self.depths_ttl:
+            depths = self.queue_depths()
+            with self._lock:
+                self._depths = (time.time(), dict(depths))
+        else:
+            depths = recent[1]
+
+        def load(indexed):
+            i, server = indexed
+            latency = self.latency[server.server] or 0
+            return ((depths[server.server] + 1) * latency,
+                    depths[server.server], i)
+        return [server for _, server in sorted(enumerate(self.servers),
+                                               key=load)]
+
+    def _own(self, project_id, server):
+        with self._lock:
+            self._owners[project_id] = server
+
+    def forget(self, project_id):
+        """Forget which server holds a project, e.g. once it's deleted."""
+        with self._lock:
+            self._owners.pop(project_id, None)
+            self._placed.discard(project_id)
 
-    Uses the project's model's row cell index so that a row can be used
-    as a dict by column name."""
-
-    class RowsResponse(object):
-        class RefineRows(object):
-            class RefineRow(object):
-                def __init__(self, row_response):
-                    self.flagged = row_response['flagged']
-                    self.starred = row_response['starred']
-                    self.index = row_response['i']
-                    self.row = [c['v'] if c else None
-                                for c in row_response['cells']]
-
-                def __getitem__(self, column):
-                    # Trailing nulls seem to be stripped from row data
-                    try:
-                        return self.row[column_index[column]]
-                    except IndexError:
-                        return None
+    def list_projects(self):
+        """Return a dict of every server's projects indexed by id."""
+        listings = self._map(lambda server: Refine(server).list_projects(),
+                             self.servers)
+        projects = {}
+        for server, listing in zip(self.servers, listings):
+            for project_id in listing:
+                self._own(project_id, server)
+            projects.update(listing)
+        return projects
+
+    def server_for(self, project_id):
+        """Return the RefineServer holding a project."""
+        with self._lock:
+            server = self._owners.get(project_id)
+        if server is None:
+            # created elsewhere, e.g. by another client, perhaps since the
+            # servers' projects were last listed; look for it
+            for server in self.servers:
+                server.metadata_cache.invalidate(server)
+            if project_id not in self.list_projects():
+                raise Exception('Project %s not found on any server' %
+                                project_id)
+            server = self._owners[project_id]
+        return server
+
+    def open_project(self, project_id):
+        """Open a project on whichever server holds it."""
+        return RefineProject(self, project_id)
+
+    def new_project(self, project_file=None, **opts):
+        """Create a project on the least loaded server.
+
+        Arguments are as for Refine.new_project(). If a server can't be
+        reached the next least loaded is tried, as long as project_file can
+        be sent again, i.e. is a path or not given."""
+        replayable = project_file is None or isinstance(project_file,
+                                                        basestring)
+        error = None
+        for server in self.by_load():
+            try:
+                project = Refine(server).new_project(
+                    project_file=project_file, **opts)
+            except urllib2.URLError as e:
+                if not replayable:
+                    raise
+                error = e
+                continue
+            self._own(project.project_id, server)
+            project.cluster = self
+            with self._lock:
+                self._placed.add(project.project_id)
+                if self._depths is not None:
+                    # load until depths are next asked for
+                    self._depths[1][server.server] += 1
+            return project
+        raise error
+
+
+class RefineRow(object):
+    """A row from get_rows(), usable as a dict by column name.
+
+    Wraps the row's decoded JSON; cell values are only picked out when
+    they're asked for."""
+    __slots__ = ('_row_response', '_column_index')
+
+    def __init__(self, row_response, column_index):
+        self._row_response = row_response
+        self._column_index = column_index
+
+    @property
+    def flagged(self):
+        return self._row_response['flagged']
+
+    @property
+    def starred(self):
+        return self._row_response['starred']
+
+    @property
+    def index(self):
+        return self._row_response['i']
+
+    @property
+    def row(self):
+        return [c['v'] if c else None for c in self._row_response['cells']]
+
+    def __getitem__(self, column):
+        # Trailing nulls seem to be stripped from row data
+        try:
+            cell = self._row_response['cells'][self._column_index[column]]
+        except IndexError:
+            return None
+        return cell['v'] if cell else None
+
+
+class RefineRows(object):
+    """Sequence of RefineRows, created as they're accessed."""
+    __slots__ = ('rows_response', 'column_index')
 
-            def __init__(self, rows_response):
-                self.rows_response = rows_response
+    def __init__(self, rows_response, column_index):
+        self.rows_response = rows_response
+        self.column_index = column_index
 
-            def __iter__(self):
-                for row_response in self.rows_response:
-                    yield self.RefineRow(row_response)
+    def __iter__(self):
+        column_index = self.column_index
+        for row_response in self.rows_response:
+            yield RefineRow(row_response, column_index)
 
-            def __getitem__(self, index):
-                return self.RefineRow(self.rows_response[index])
+    def __getitem__(self, index):
+        return RefineRow(self.rows_response[index], self.column_index)
 
-            def __len__(self):
-                return len(self.rows_response)
+    def __len__(self):
+        return len(self.rows_response)
 
-        def __init__(self, response):
-            self.mode = response['mode']
-            self.filtered = response['filtered']
-            self.start = response['start']
-            self.limit = response['limit']
-            self.total = response['total']
-            self.rows = self.RefineRows(response['rows'])
 
-    return RowsResponse
+class RowsResponse(object):
+    """Parsed get_rows() response. See RowsResponseFactory."""
+    column_index = {}
 
+    def __init__(self, response):
+        self.mode = response['mode']
+        self.filtered = response['filtered']
+        self.start = response['start']
+        self.limit = response['limit']
+        self.total = response['total']
+        self.rows = RefineRows(response['rows'], self.column_index)
+
+
+# map of column index items to RowsResponse subclasses, least recently used
+# first; column models come and go as columns are edited
+_rows_response_classes = collections.OrderedDict()
+_rows_response_classes_lock = threading.Lock()
+ROWS_RESPONSE_CLASSES_MAXSIZE = 32
+
+
+def RowsResponseFactory(column_index):
+    """Factory for the parsing the output from get_rows().
 
-class RefineProject:
+    Uses the project's model's row cell index so that a row can be used
+    as a dict by column name. One class is made per distinct column index;
+    the most recently used ROWS_RESPONSE_CLASSES_MAXSIZE are kept."""
+    key = tuple(sorted(column_index.items()))
+    with _rows_response_classes_lock:
+        rows_response_class = _rows_response_classes.pop(key, None)
+        if rows_response_class is None:
+            rows_response_class = type('RowsResponse', (RowsResponse,), {
+                'column_index': dict(column_index)})
+        _rows_response_classes[key] = rows_response_class
+        while len(_rows_response_classes) > ROWS_RESPONSE_CLASSES_MAXSIZE:
+            _rows_response_classes.popitem(last=False)
+    return rows_response_class
+
+
+class _Prefetch(object):
+    """Call func(*args) on a background thread.
+
+    A thread is started directly rather than through a ThreadPool, which on
+    Python 2 takes a tenth of a second to terminate."""
+
+    def __init__(self, func, *args):
+        self._result = Queue.Queue(1)
+        thread = threading.Thread(target=self._run, args=(func, args))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, func, args):
+        try:
+            self._result.put((True, func(*args)))
+        except Exception as e:
+            self._result.put((False, e))
+
+    def get(self):
+        """Return func's result, waiting for it, or raise its exception."""
+        ok, value = self._result.get()
+        if not ok:
+            raise value
+        return value
+
+
+def _map_threads(func, items, workers, ordered=True):
+    """Yield func(item) for each item, called by up to workers threads.
+
+    Results are yielded in the order of items if ordered, otherwise as they
+    arrive. At most 2 * workers results are being made or waiting to be
+    yielded, so a slow consumer doesn't have them pile up in memory.
+    Threads stop taking items once the generator is closed. Like _Prefetch,
+    this avoids a ThreadPool's slow terminate()."""
+    items = list(items)
+    todo = Queue.Queue()
+    for i, item in enumerate(items):
+        todo.put((i, item))
+    done = Queue.Queue()
+    stop = threading.Event()
+    # taken before each call and given back as its result is yielded
+    slots = threading.Semaphore(2 * workers)
+
+    def work():
+        while True:
+            slots.acquire()
+            if stop.is_set():
+                return
+            try:
+                i, item = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                done.put((i, True, func(item)))
+            except Exception as e:
+                done.put((i, False, e))
+
+    threads = min(workers, len(items))
+    for _ in range(threads):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+    try:
+        waiting = {}    # results that arrived ahead of their turn
+        turn = 0
+        for _ in items:
+            i, ok, value = done.get()
+            if not ok:
+                raise value
+            if not ordered:
+                slots.release()
+                yield value
+                continue
+            waiting[i] = value
+            while turn in waiting:
+                slots.release()
+                yield waiting.pop(turn)
+                turn += 1
+    finally:
+        stop.set()
+        for _ in range(threads):
+            slots.release()     # wake any threads waiting for a slot
+
+
+def _column_model_property(name):
+    """Property for column model data, fetched by get_models() on first use
+    and again after an edit has made it stale."""
+    attr = '_' + name
+
+    def get(self):
+        if self._models_stale:
+            self._fetch_models()
+        return getattr(self, attr)
+
+    def set(self, value):
+        setattr(self, attr, value)
+
+    return property(get, set)
+
+
+class RefineProject(object):
     """An OpenRefine project."""
 
     def __init__(self, server, project_id=None):
-        if not isinstance(server, RefineServer):
+        self.cluster = None     # the RefineCluster it was opened through
+        if isinstance(server, RefineCluster):
+            self.cluster = server
+            server = server.server_for(project_id)
+        elif not isinstance(server, RefineServer):
             if '/project?project=' in server:
                 server, project_id = server.split('/project?project=')
                 server = RefineServer(server)
@@ -347,16 +923,27 @@ class RefineProject:
         self.engine = facet.Engine()
         self.sorting = facet.Sorting()
         self.history_entry = None
-        # following filled in by get_models()
-        self.key_column = None
-        self.has_records = False
-        self.columns = None
-        self.column_order = {}  # map of column names to order in UI
-        self.rows_response_factory = None   # for parsing get_rows()
-        self.get_models()
+        self._history_state = None  # current history entry id, if known
+        self._history_pending = False   # whether an operation may be running
+        self._operations = None     # list of operations when batching
+        self._batch_unpatched = False   # recorded edits not in the model
+        # following filled in by get_models(), when first needed
+        self._models_stale = True
+        self._key_column = None
+        self._has_records = False
+        self._columns = None
+        self._column_order = {}  # map of column names to order in UI
+        self._column_index = {}  # map of column names to get_rows() index
+        self._rows_response_factory = None   # for parsing get_rows()
         # following filled in by get_reconciliation_services
         self.recon_services = None
 
+    key_column = _column_model_property('key_column')
+    has_records = _column_model_property('has_records')
+    columns = _column_model_property('columns')
+    column_order = _column_model_property('column_order')
+    rows_response_factory = _column_model_property('rows_response_factory')
+
     def project_name(self):
         return Refine(self.server).get_project_name(self.project_id)
 
@@ -370,11 +957,33 @@ class RefineProject:
                                    data=data)
 
     def do_json(self, command, data=None, include_engine=True):
-        """Issue a command to the server, parse & return decoded JSON."""
+        """Issue a command to the server, parse & return decoded JSON.
+
+        Inside a batch() operations are recorded instead of being sent."""
         if include_engine:
             if data is None:
                 data = {}
             data['engine'] = self.engine.as_json()
+        if self._operations is not None and command in self.command_operations:
+            self._operations.append(self._operation(command, data))
+            return {'code': 'ok'}
+        if self._operations and command not in cache.READ_ONLY_COMMANDS:
+            # can't be recorded, so must act on the batch's edits so far
+            self._apply_recorded()
+        response_cache = self.server.response_cache
+        state = None
+        if (response_cache is not None and
+                command in cache.CACHEABLE_COMMANDS):
+            state = self._get_history_state()
+        if state is not None:
+            key = cache.cache_key(self.server.server, self.project_id,
+                                  state, command, data)
+            response = response_cache.get(key)
+            if response is None:
+                response = self.server.urlopen_json(
+                    command, project_id=self.project_id, data=data)
+                response_cache.put(key, response)
+            return response
         response = self.server.urlopen_json(command,
                                             project_id=self.project_id,
                                             data=data)
@@ -383,8 +992,143 @@ class RefineProject:
             he = response['historyEntry']
             self.history_entry = history.HistoryEntry(he['id'], he['time'],
                                                       he['description'])
+            self._history_state = he['id']
+        elif command not in cache.READ_ONLY_COMMANDS:
+            # an edit still in progress, or one we can't see the result of
+            self._history_state = None
+            self._history_pending = response.get('code') == 'pending'
         return response
 
+    def _get_history_state(self):
+        """Return the id of the project's last history entry, 0 if none.
+
+        Returns None while an operation left pending is still running, as
+        the history is about to change."""
+        if self._history_state is None:
+            if self._history_pending:
+                response = self.do_json('get-processes', include_engine=False)
+                if response.get('processes'):
+                    return None
+                self._history_pending = False
+            response = self.do_json('get-history', include_engine=False)
+            past = response.get('past', [])
+            self._history_state = past[-1]['id'] if past else 0
+        return self._history_state
+
+    # map of commands to the operations they perform, for batch()
+    command_operations = {
+        'add-column': 'core/column-addition',
+        'blank-down': 'core/blank-down',
+        'fill-down': 'core/fill-down',
+        'mass-edit': 'core/mass-edit',
+        'move-column': 'core/column-move',
+        'remove-rows': 'core/row-removal',
+        'rename-column': 'core/column-rename',
+        'reorder-columns': 'core/column-reorder',
+        'reorder-rows': 'core/row-reorder',
+        'split-column': 'core/column-split',
+        'text-transform': 'core/text-transform',
+        'transpose-columns-into-rows': 'core/transpose-columns-into-rows',
+        'transpose-rows-into-columns': 'core/transpose-rows-into-columns',
+    }
+    # operations that act on the rows selected by the engine
+    engine_operations = ('core/blank-down', 'core/column-addition',
+                         'core/column-split', 'core/fill-down',
+                         'core/mass-edit', 'core/row-removal',
+                         'core/text-transform')
+
+    def _operation(self, command, data):
+        """Return the operation JSON equivalent to a command's POST data."""
+        operation = {'op': self.command_operations[command]}
+        for k, v in data.items():
+            if k == 'engine':
+                engine = json.loads(v)
+                if operation['op'] in self.engine_operations:
+                    operation['engineConfig'] = engine
+                elif operation['op'] == 'core/row-reorder':
+                    operation['mode'] = engine['mode']
+            elif k in ('edits', 'sorting'):
+                operation[k] = json.loads(v)
+            else:
+                operation[k] = v
+        return operation
+
+    @contextlib.contextmanager
+    def batch(self, wait=True):
+        """Record edits and apply them in a single apply-operations request.
+
+        with project.batch():
+            project.text_transform('name', 'value.trim()')
+            project.rename_column('name', 'Name')
+
+        Edits inside the block return {'code': 'ok'} without contacting the
+        server. On leaving the block the operations are applied; if the block
+        raises nothing more is applied. Nested batches join the outermost one.
+
+        Renames, moves and added columns are reflected in the column model as
+        they're recorded, so later edits in the batch can refer to them.
+        Other column changes (splits, transposes, ...) can't be, so the
+        edits recorded so far are applied when the column model is next
+        needed. They're also applied before any command that can't be
+        recorded, e.g. reconcile, so it sees them."""
+        if self._operations is not None:
+            yield self._operations
+            return
+        self._operations = []
+        operations = None
+        try:
+            yield self._operations
+            operations = self._operations
+        finally:
+            self._operations = None
+            self._batch_unpatched = False
+            if operations is None:
+                # the block raised; forget columns patched in for it
+                self._models_changed()
+        if operations:
+            self._apply_operations_json(json.dumps(operations), wait)
+
+    def _apply_recorded(self):
+        """Apply the operations recorded so far in a batch()."""
+        operations = list(self._operations)
+        del self._operations[:]
+        self._batch_unpatched = False
+        if operations:
+            self._apply_operations_json(json.dumps(operations))
+
+    def _models_changed(self):
+        """Mark the column model stale after an edit.
+
+        Inside a batch() the edit has only been recorded, so the model is
+        fetched after applying it, by _fetch_models()."""
+        self._models_stale = True
+        if self._operations is not None:
+            self._batch_unpatched = True
+
+    def _fetch_models(self):
+        """get_models(), first applying a batch's edits it can't show."""
+        if self._operations and self._batch_unpatched:
+            self._apply_recorded()
+        self.get_models()
+
+    def _patch_models(self):
+        """Whether to patch an edit into the column model rather than fetch
+        the model again. Call before recording the edit.
+
+        Inside a batch() the model is always patched, fetching it first if
+        need be: the server's is as it was before the batch."""
+        if self._operations is not None:
+            if self._models_stale:
+                self._fetch_models()
+            return True
+        return not self._models_stale
+
+    def _set_columns(self, columns, column_index):
+        self._columns = columns
+        self._column_order = dict((name, i) for i, name in enumerate(columns))
+        self._column_index = column_index
+        self._rows_response_factory = RowsResponseFactory(column_index)
+
     def get_models(self):
         """Fill out column metadata.
 
@@ -393,15 +1137,13 @@ class RefineProject:
         from get_rows()."""
         response = self.do_json('get-models', include_engine=False)
         column_model = response['columnModel']
-        column_index = {}   # map of column name to index into get_rows() data
-        self.columns = [column['name'] for column in column_model['columns']]
-        for i, column in enumerate(column_model['columns']):
-            name = column['name']
-            self.column_order[name] = i
-            column_index[name] = column['cellIndex']
-        self.key_column = column_model['keyColumnName']
-        self.has_records = response['recordModel'].get('hasRecords', False)
-        self.rows_response_factory = RowsResponseFactory(column_index)
+        self._set_columns(
+            [column['name'] for column in column_model['columns']],
+            dict((column['name'], column['cellIndex'])
+                 for column in column_model['columns']))
+        self._key_column = column_model['keyColumnName']
+        self._has_records = response['recordModel'].get('hasRecords', False)
+        self._models_stale = False
         # TODO: implement rest
         return response
 
@@ -417,18 +1159,24 @@ class RefineProject:
             if 'processes' in response and len(response['processes']) > 0:
                 time.sleep(polling_delay)
             else:
+                self._history_pending = False
                 return
 
     def apply_operations(self, file_path, wait=True):
         json_data = open(file_path).read()
+        return self._apply_operations_json(json_data, wait)
+
+    def _apply_operations_json(self, json_data, wait=True):
         response_json = self.do_json('apply-operations', {'operations': json_data})
+        # sent straight away, even inside a batch()
+        self._models_stale = True
         if response_json['code'] == 'pending' and wait:
             self.wait_until_idle()
             return 'ok'
         return response_json['code']  # can be 'ok' or 'pending'
 
     def export(self, export_format='tsv'):
-        """Return a fileobject of a project's data."""
+        """Return a fileobject streaming a project's data."""
         url = ('export-rows/' + urllib.quote(self.project_name()) + '.' +
                export_format)
         return self.do_raw(url, data={'format': export_format})
@@ -437,8 +1185,23 @@ class RefineProject:
         """Return an iterable of parsed rows of a project's data."""
         return csv.reader(self.export(**kwargs), dialect='excel-tab')
 
+    def export_columns(self, as_dataframe=False):
+        """Return a project's data as columns, in the project's column order.
+
+        The export is read as it streams in. Columns of numbers (and blanks)
+        become float arrays with blanks as NaN; others hold strings. Arrays
+        are numpy arrays if numpy is installed.
+
+        Returns an OrderedDict of column name to column data, or a
+        pandas.DataFrame if as_dataframe."""
+        return columnar.read_columns(self.export_rows(), self.columns,
+                                     as_dataframe=as_dataframe)
+
     def delete(self):
         response_json = self.do_json('delete-project', include_engine=False)
+        self.server.metadata_cache.invalidate(self.server, self.project_id)
+        if self.cluster is not None:
+            self.cluster.forget(self.project_id)
         return 'code' in response_json and response_json['code'] == 'ok'
 
     def compute_facets(self, facets=None):
@@ -452,6 +1215,7 @@ class RefineProject:
         name_facet = TextFacet('name')
         response = project.compute_facets(name_facet)
         response.facets[name_facet]     # same as response.facets[0]
+        response.facets.counts(name_facet)  # just {value: count, ...}
         """
         if facets:
             self.engine.set_facets(facets)
@@ -463,10 +1227,69 @@ class RefineProject:
             self.engine.set_facets(facets)
         if sort_by is not None:
             self.sorting = facet.Sorting(sort_by)
-        response = self.do_json('get-rows', {'sorting': self.sorting.as_json(),
-                                             'start': start, 'limit': limit})
+        return self._get_rows_page(self.engine.as_json(),
+                                   self.sorting.as_json(), start, limit)
+
+    def _get_rows_page(self, engine_json, sorting_json, start, limit):
+        response = self.do_json('get-rows', {
+            'engine': engine_json, 'sorting': sorting_json,
+            'start': start, 'limit': limit}, include_engine=False)
         return self.rows_response_factory(response)
 
+    def iter_rows(self, facets=None, sort_by=None, page_size=1000):
+        """Yield every row matching the engine's facets, in sorted order.
+
+        Rows are fetched page_size at a time and the next page is fetched on
+        a background thread while the current one is being consumed. The
+        engine and sorting are fixed when iteration starts."""
+        if facets:
+            self.engine.set_facets(facets)
+        if sort_by is not None:
+            self.sorting = facet.Sorting(sort_by)
+        engine_json = self.engine.as_json()
+        sorting_json = self.sorting.as_json()
+        response = self._get_rows_page(engine_json, sorting_json,
+                                       0, page_size)
+        start = page_size
+        while True:
+            prefetch = None
+            if start < response.filtered:
+                prefetch = _Prefetch(self._get_rows_page, engine_json,
+                                     sorting_json, start, page_size)
+            for row in response.rows:
+                yield row
+            if prefetch is None:
+                return
+            response = prefetch.get()
+            start += page_size
+
+    def fetch_rows_parallel(self, workers=4, page_size=1000, ordered=True,
+                            facets=None, sort_by=None):
+        """Yield every row matching the engine's facets, fetching pages
+        concurrently.
+
+        The first page gives the filtered row count; the remaining pages are
+        fetched by a pool of workers threads. With ordered=False rows are
+        yielded a page at a time as soon as each page arrives."""
+        if facets:
+            self.engine.set_facets(facets)
+        if sort_by is not None:
+            self.sorting = facet.Sorting(sort_by)
+        engine_json = self.engine.as_json()
+        sorting_json = self.sorting.as_json()
+
+        def fetch(start):
+            return self._get_rows_page(engine_json, sorting_json,
+                                       start, page_size)
+
+        response = fetch(0)
+        for row in response.rows:
+            yield row
+        starts = range(page_size, response.filtered, page_size)
+        for response in _map_threads(fetch, starts, workers, ordered):
+            for row in response.rows:
+                yield row
+
     def reorder_rows(self, sort_by=None):
         if sort_by is not None:
             self.sorting = facet.Sorting(sort_by)
@@ -489,6 +1312,16 @@ class RefineProject:
             'repeatCount': repeat_count})
         return response
 
+    def preview_expression(self, column, expression, limit=100):
+        """Evaluate a GREL expression locally over some of a column's rows.
+
+        The rows are the first limit selected by the engine. Returns a
+        grel.Preview of (value, result) pairs; its summary() has the error
+        rate. Only the GREL supported by grel can be previewed."""
+        expression = grel.compile(expression)
+        rows = self.get_rows(limit=limit).rows
+        return grel.preview(expression, [row[column] for row in rows])
+
     def edit(self, column, edit_from, edit_to):
         edits = [{'from': [edit_from], 'to': edit_to}]
         return self.mass_edit(column, edits)
@@ -518,7 +1351,9 @@ class RefineProject:
 
     def compute_clusters(self, column, clusterer_type='binning',
                          function=None, params=None):
-        """Returns a list of clusters of {'value': ..., 'count': ...}."""
+        """Returns a list of clusters of {'value': ..., 'count': ...}.
+
+        clustering.compute_clusters() does the same locally."""
         clusterer = self.clusterer_defaults[clusterer_type]
         if params is not None:
             clusterer['params'] = params
@@ -547,11 +1382,20 @@ class RefineProject:
                    column_insert_index=None, on_error='set-to-blank'):
         if column_insert_index is None:
             column_insert_index = self.column_order[column] + 1
+        patch = self._operations is not None and self._patch_models()
         response = self.do_json('add-column', {
             'baseColumnName': column, 'newColumnName': new_column,
             'expression': expression, 'columnInsertIndex': column_insert_index,
             'onError': on_error})
-        self.get_models()
+        if patch:
+            columns = list(self._columns)
+            columns.insert(column_insert_index, new_column)
+            column_index = dict(self._column_index)
+            # the server gives a new column the next cell index
+            column_index[new_column] = max(column_index.values() + [-1]) + 1
+            self._set_columns(columns, column_index)
+        else:
+            self._models_changed()
         return response
 
     def split_column(self, column, separator=',', mode='separator',
@@ -561,39 +1405,56 @@ class RefineProject:
             'columnName': column, 'separator': separator, 'mode': mode,
             'regex': regex, 'guessCellType': guess_cell_type,
             'removeOriginalColumn': remove_original_column})
-        self.get_models()
+        self._models_changed()
         return response
 
     def rename_column(self, column, new_column):
+        patch = self._patch_models()
         response = self.do_json('rename-column', {'oldColumnName': column,
                                                   'newColumnName': new_column})
-        self.get_models()
+        if patch:
+            # Patch the column model rather than fetch it again
+            column_index = dict(self._column_index)
+            column_index[new_column] = column_index.pop(column)
+            self._set_columns([new_column if name == column else name
+                               for name in self._columns], column_index)
+            if self._key_column == column:
+                self._key_column = new_column
         return response
 
     def reorder_columns(self, new_column_order):
         """Takes an array of column names in the new order."""
+        patch = self._patch_models()
         response = self.do_json('reorder-columns', {
             'columnNames': new_column_order})
-        self.get_models()
+        if patch and sorted(new_column_order) == sorted(self._columns):
+            self._set_columns(list(new_column_order), self._column_index)
+        else:
+            # Columns left out are removed, which may change the key column
+            self._models_changed()
         return response
 
     def move_column(self, column, index):
         """Move column to a new position."""
         if index == 'end':
             index = len(self.columns) - 1
+        patch = self._patch_models()
         response = self.do_json('move-column', {'columnName': column,
                                                 'index': index})
-        self.get_models()
+        if patch:
+            columns = [name for name in self._columns if name != column]
+            columns.insert(index, column)
+            self._set_columns(columns, self._column_index)
         return response
 
     def blank_down(self, column):
         response = self.do_json('blank-down', {'columnName': column})
-        self.get_models()
+        self._models_changed()
         return response
 
     def fill_down(self, column):
         response = self.do_json('fill-down', {'columnName': column})
-        self.get_models()
+        self._models_changed()
         return response
 
     def transpose_columns_into_rows(
@@ -606,13 +1467,13 @@ class RefineProject:
             'combinedColumnName': combined_column_name,
             'prependColumnName': prepend_column_name,
             'separator': separator, 'ignoreBlankCells': ignore_blank_cells})
-        self.get_models()
+        self._models_changed()
         return response
 
     def transpose_rows_into_columns(self, column, row_count):
         response = self.do_json('transpose-rows-into-columns', {
             'columnName': column, 'rowCount': row_count})
-        self.get_models()
+        self._models_changed()
         return response
 
     # Reconciliation
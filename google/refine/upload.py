@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+Streaming multipart/form-data uploads.
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import csv
+import itertools
+import mimetypes
+import os
+import StringIO
+import uuid
+import zlib
+
+CHUNK_SIZE = 65536
+
+
+def is_file_part(value):
+    """Is a POST data value a file to upload?
+
+    Files are given, as with urllib2_file, as {'fd': ..., 'filename': ...}
+    where fd is a path, file object or iterable of byte chunks."""
+    return isinstance(value, dict) and 'fd' in value
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def source_size(source):
+    """Return the number of bytes a source will yield, or None if unknown."""
+    if isinstance(source, basestring):
+        return os.path.getsize(source)
+    try:
+        return os.fstat(source.fileno()).st_size - source.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+def iter_source(source, chunk_size=CHUNK_SIZE):
+    """Yield a path's, file object's or iterable's data in byte chunks."""
+    if isinstance(source, basestring):
+        with open(source, 'rb') as fp:
+            for chunk in iter_source(fp, chunk_size):
+                yield chunk
+    elif hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        for chunk in source:
+            yield chunk
+
+
+def _csv_value(value):
+    if value is None or value != value:
+        return ''   # None or NaN, including numpy's float32 NaN and NaT
+    if isinstance(value, float):
+        return repr(value)
+    return _encode(value)
+
+
+def csv_chunks(rows, columns=None, separator=',', chunk_size=CHUNK_SIZE):
+    """Yield rows, after a header row of columns if given, as CSV.
+
+    Rows are serialized as the chunks are asked for, roughly chunk_size
+    bytes at a time. Unicode is encoded as UTF-8."""
+    buf = StringIO.StringIO()
+    writer = csv.writer(buf, delimiter=separator, lineterminator='\n')
+    if columns is not None:
+        writer.writerow([_csv_value(column) for column in columns])
+    for row in rows:
+        writer.writerow([_csv_value(value) for value in row])
+        if buf.tell() >= chunk_size:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+# (magic number, filename suffix, content type) of compressed files that
+# OpenRefine unpacks when importing
+GZIP = ('\x1f\x8b', '.gz', 'application/x-gzip')
+BZIP2 = ('BZh', '.bz2', 'application/x-bzip2')
+COMPRESSIONS = (GZIP, BZIP2)
+
+
+def sniff_compression(source):
+    """Detect a gzip or bzip2 compressed source from its first bytes.
+
+    Returns (source, compression) where compression is one of COMPRESSIONS
+    or None. Unless source is a path or seekable file, the bytes read are
+    put back by returning a new iterable in place of source."""
+    if isinstance(source, basestring):
+        with open(source, 'rb') as fp:
+            head = fp.read(3)
+    else:
+        try:
+            position = source.tell()
+            head = source.read(3)
+            source.seek(position)
+        except (AttributeError, IOError):
+            chunks = iter_source(source)
+            head = next(chunks, '')
+            source = itertools.chain([head], chunks)
+    for compression in COMPRESSIONS:
+        if head.startswith(compression[0]):
+            return source, compression
+    return source, None
+
+
+def gzip_source(source, level=6, chunk_size=CHUNK_SIZE):
+    """Yield a source's data gzip compressed, a chunk at a time."""
+    # 16 + MAX_WBITS: write a gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in iter_source(source, chunk_size):
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class MultipartUpload(object):
+    """Iterable multipart/form-data body built from POST data.
+
+    File parts are read a chunk at a time as the body is iterated over, so
+    memory use is bounded whatever their size. length is the body's size in
+    bytes if every file's size can be known up front, otherwise None and
+    the body must be sent with chunked transfer encoding.
+
+    progress, if given, is called as progress(bytes_sent, length) after
+    each chunk."""
+
+    def __init__(self, data, progress=None, chunk_size=CHUNK_SIZE):
+        self.boundary = uuid.uuid4().hex
+        self.progress = progress
+        self.chunk_size = chunk_size
+        self.fields = []
+        self.files = []
+        for name, value in data.items():
+            if is_file_part(value):
+                self.files.append((name, value))
+            else:
+                self.fields.append((name, value))
+        self.content_type = ('multipart/form-data; boundary=' +
+                             self.boundary)
+        self.length = len(self._trailer())
+        for name, value in self.fields:
+            self.length += len(self._field(name, value))
+        for name, value in self.files:
+            size = source_size(value['fd'])
+            if size is None or self.length is None:
+                self.length = None
+            else:
+                self.length += len(self._file_header(name, value)) + size + 2
+
+    def _field(self, name, value):
+        return ('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n'
+                '%s\r\n' % (self.boundary, name, _encode(value)))
+
+    def _file_header(self, name, value):
+        filename = _encode(value.get('filename') or name)
+        content_type = (value.get('content_type') or
+                        mimetypes.guess_type(filename)[0] or
+                        'application/octet-stream')
+        return ('--%s\r\nContent-Disposition: form-data; name="%s"; '
+                'filename="%s"\r\nContent-Type: %s\r\n\r\n' %
+                (self.boundary, name, filename, content_type))
+
+    def _trailer(self):
+        return '--%s--\r\n' % self.boundary
+
+    def _chunks(self):
+        for name, value in self.fields:
+            yield self._field(name, value)
+        for name, value in self.files:
+            yield self._file_header(name, value)
+            for chunk in iter_source(value['fd'], self.chunk_size):
+                yield chunk
+            yield '\r\n'
+        yield self._trailer()
+
+    def __iter__(self):
+        sent = 0
+        for chunk in self._chunks():
+            if not chunk:
+                continue
+            yield chunk
+            sent += len(chunk)
+            if self.progress is not None:
+                self.progress(sent, self.length)
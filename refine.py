@@ -8,6 +8,7 @@ refine --list    # show list of Refine projects, ID: name
 refine --export 1234... > project.tsv
 refine --export --output=project.xls 1234...
 refine --apply trim.json 1234...
+refine --stats --profile=export.prof --export 1234... > project.tsv
 """
 
 # Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
@@ -26,13 +27,18 @@ refine --apply trim.json 1234...
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 
 
+import contextlib
+import cProfile
 import optparse
 import os
 import sys
 import time
 
+from google.refine import instrument
 from google.refine import refine
 
+CHUNK_SIZE = 65536
+
 
 PARSER = optparse.OptionParser(
     usage='usage: %prog [--help | OPTIONS] [project ID/URL]')
@@ -49,11 +55,81 @@ PARSER.add_option('-E', '--export', dest='export', action='store_true',
                   help='Export project')
 PARSER.add_option('-f', '--apply', dest='apply',
                   help='Apply a JSON commands file to a project')
-
-
-def list_projects():
+# Diagnosing slow runs
+PARSER.add_option('--stats', dest='stats', action='store_true',
+                  help='Print where the time went to stderr when finished')
+PARSER.add_option('--profile', dest='profile', metavar='FILE',
+                  help='Save a cProfile of the run to FILE')
+
+
+def _size(n):
+    """Format a byte count, e.g. 1.5MB."""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024 or unit == 'GB':
+            break
+        n /= 1024.0
+    return ('%d%s' if unit == 'B' else '%.1f%s') % (n, unit)
+
+
+class Stats(object):
+    """Where the time of a run went: HTTP requests per command, from an
+    instrument.Metrics hook, and named local timings."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.metrics = instrument.Metrics()
+        self.seconds = {}
+
+    @contextlib.contextmanager
+    def timing(self, name):
+        """Add the time spent in a with block to name's."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.seconds[name] = (self.seconds.get(name, 0) +
+                                  time.time() - start)
+
+    def timed(self, name, func):
+        """Wrap func so that calls to it are timed as name."""
+        def wrapper(*args, **kwargs):
+            with self.timing(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def report(self, output):
+        snapshot = self.metrics.snapshot()
+        output.write('%-24s %6s %9s %9s %9s %10s\n' % (
+            'command', 'calls', 'seconds', 'sent', 'received', 'decoded/s'))
+        http_seconds = 0
+        for command in sorted(snapshot):
+            metrics = snapshot[command]
+            seconds = metrics['request_seconds']['sum']
+            http_seconds += seconds
+            decoded = metrics['decoded_bytes']['sum']
+            errors = sum(metrics['errors'].values())
+            output.write('%-24s %6d %9.3f %9s %9s %10s%s\n' % (
+                command, metrics['request_seconds']['count'], seconds,
+                _size(metrics['request_bytes']['sum']),
+                _size(metrics['response_bytes']['sum']),
+                _size(decoded / seconds if seconds else 0),
+                '  %d errors' % errors if errors else ''))
+        output.write('\n%-24s %16.3f\n' % ('HTTP', http_seconds))
+        for name, label in (('wait', 'waiting for processes'),
+                            ('write', 'writing output')):
+            if name in self.seconds:
+                output.write('%-24s %16.3f\n' % (label, self.seconds[name]))
+        output.write('%-24s %16.3f\n' % ('total',
+                                          time.time() - self.start))
+        if 'write' in self.seconds and 'export-rows' in snapshot:
+            output.write('(export-rows streams while output is written so '
+                         'its time includes writing)\n')
+
+
+def list_projects(hooks=None):
     """Query the Refine server and list projects by ID: name."""
-    projects = refine.Refine(refine.RefineServer()).list_projects().items()
+    server = refine.RefineServer(hooks=hooks)
+    projects = refine.Refine(server).list_projects().items()
 
     def date_to_epoch(json_dt):
         """Convert a JSON date time into seconds-since-epoch."""
@@ -63,7 +139,7 @@ def list_projects():
         print('{0:>14}: {1}'.format(project_id, project_info['name']))
 
 
-def export_project(project, options):
+def export_project(project, options, stats=None):
     """Dump a project to stdout or options.output file."""
     export_format = 'tsv'
     if options.output:
@@ -73,10 +149,40 @@ def export_project(project, options):
         output = open(options.output, 'wb')
     else:
         output = sys.stdout
-    output.writelines(project.export(export_format=export_format))
+    write = output.write
+    if stats is not None:
+        write = stats.timed('write', write)
+    response = project.export(export_format=export_format)
+    while True:
+        chunk = response.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        write(chunk)
     output.close()
 
 
+def run(options, args, stats=None):
+    """Carry out the commands given by options on the project in args."""
+    hooks = [] if stats is None else [stats.metrics]
+    if options.list:
+        list_projects(hooks)
+    if args:
+        project = refine.RefineProject(args[0])
+        project.server.hooks.extend(hooks)
+        if stats is not None:
+            project.wait_until_idle = stats.timed('wait',
+                                                  project.wait_until_idle)
+        if options.apply:
+            response = project.apply_operations(options.apply)
+            if response != 'ok':
+                print >>sys.stderr, 'Failed to apply %s: %s' % (options.apply,
+                                                                response)
+        if options.export:
+            export_project(project, options, stats)
+
+        return project
+
+
 #noinspection PyPep8Naming
 def main():
     """Main."""
@@ -89,19 +195,20 @@ def main():
 
     if not options.list and len(args) != 1:
         PARSER.print_usage()
-    if options.list:
-        list_projects()
-    if args:
-        project = refine.RefineProject(args[0])
-        if options.apply:
-            response = project.apply_operations(options.apply)
-            if response != 'ok':
-                print >>sys.stderr, 'Failed to apply %s: %s' % (options.apply,
-                                                                response)
-        if options.export:
-            export_project(project, options)
-
-        return project
+    stats = Stats() if options.stats else None
+    profile = cProfile.Profile() if options.profile else None
+    if profile is not None:
+        profile.enable()
+    try:
+        return run(options, args, stats)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(options.profile)
+            print >>sys.stderr, 'Profile saved, see python -m pstats %s' % (
+                options.profile)
+        if stats is not None:
+            stats.report(sys.stderr)
 
 if __name__ == '__main__':
     # return project so that it's available interactively, python -i refine.py
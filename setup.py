@@ -32,8 +32,11 @@ setup(name='refine-client',
       author='Paul Makepeace',
       author_email='paulm@paulm.com',
       url='https://github.com/PaulMakepeace/refine-client-py',
-      packages=find_packages(exclude=['tests']),
-      install_requires=['urllib2_file'],
+      packages=find_packages(exclude=['tests', 'benchmarks']),
+      extras_require={
+          'numpy': ['numpy'],
+          'pandas': ['numpy', 'pandas'],
+      },
       platforms=['Any'],
       classifiers = [
           'Development Status :: 3 - Alpha',
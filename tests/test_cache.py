@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+test_cache.py
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from google.refine import cache
+from google.refine import refine
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_key(self):
+        key = cache.cache_key('http://x', '1', 5, 'compute-facets',
+                              {'engine': '{"facets": [], "mode": "row-based"}'})
+        self.assertEqual(key, cache.cache_key(
+            'http://x', 1, 5, 'compute-facets',
+            {'engine': '{"mode": "row-based", "facets": []}'}))
+        self.assertNotEqual(key, cache.cache_key(
+            'http://x', '1', 6, 'compute-facets',
+            {'engine': '{"facets": [], "mode": "row-based"}'}))
+
+    def test_memory_lru(self):
+        response_cache = cache.ResponseCache(maxsize=2)
+        response_cache.put('a', {'n': 1})
+        response_cache.put('b', {'n': 2})
+        self.assertEqual(response_cache.get('a'), {'n': 1})
+        response_cache.put('c', {'n': 3})    # drops b, least recently used
+        self.assertEqual(response_cache.get('b'), None)
+        self.assertEqual(response_cache.get('a'), {'n': 1})
+        self.assertEqual(response_cache.stats(), {
+            'hits': 2, 'misses': 1, 'memory': 2, 'disk_bytes': 0})
+
+    def test_disk(self):
+        response_cache = cache.ResponseCache(
+            maxsize=1, directory=self.tmp_dir, max_disk_bytes=30)
+        response_cache.put('a', {'n': 'a' * 10})
+        response_cache.put('b', {'n': 'b' * 10})
+        self.assertEqual(len(os.listdir(self.tmp_dir)), 1)  # a evicted
+        response_cache = cache.ResponseCache(directory=self.tmp_dir)
+        self.assertEqual(response_cache.get('b'), {'n': 'b' * 10})
+        self.assertEqual(response_cache.get('a'), None)
+        response_cache.clear()
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+
+class CachedProjectTest(unittest.TestCase):
+    def test_project_cache(self):
+        server = refine.RefineServer('http://refine.example',
+                                     response_cache=cache.ResponseCache())
+        requests = []
+        history = [{'id': 1}]
+
+        def urlopen_json(command, **kwargs):
+            requests.append(command)
+            if command == 'get-history':
+                return {'past': history, 'future': []}
+            if command == 'text-transform':
+                return {'code': 'ok', 'historyEntry': {
+                    'id': 2, 'time': '', 'description': ''}}
+            if command == 'apply-operations':
+                return {'code': 'pending'}
+            return {'count': len(requests)}
+        server.urlopen_json = urlopen_json
+        project = refine.RefineProject(server, '1')
+        first = project.do_json('compute-facets')
+        self.assertEqual(project.do_json('compute-facets'), first)
+        self.assertEqual(requests, ['get-history', 'compute-facets'])
+        project.text_transform('name', 'value.trim()')
+        self.assertNotEqual(project.do_json('compute-facets'), first)
+        self.assertEqual(requests[-2:], ['text-transform', 'compute-facets'])
+        project.do_json('apply-operations', {'operations': '[]'})
+        history.append({'id': 3})
+        project.do_json('compute-facets')
+        self.assertEqual(requests[-4:], ['apply-operations', 'get-processes',
+                                         'get-history', 'compute-facets'])
+
+    def test_pending_operation(self):
+        server = refine.RefineServer('http://refine.example',
+                                     response_cache=cache.ResponseCache())
+        requests = []
+        history = [{'id': 1}]
+        processes = [{'status': 'running'}]
+
+        def urlopen_json(command, **kwargs):
+            requests.append(command)
+            if command == 'get-history':
+                return {'past': history, 'future': []}
+            if command == 'get-processes':
+                return {'processes': processes}
+            if command == 'reconcile':
+                return {'code': 'pending'}
+            return {'history': history[-1]['id']}
+        server.urlopen_json = urlopen_json
+        project = refine.RefineProject(server, '1')
+        project.reconcile('name', None, reconciliation_config={})
+        # not cached while the reconciliation runs
+        self.assertEqual(project.do_json('compute-facets')['history'], 1)
+        self.assertEqual(requests[-2:], ['get-processes', 'compute-facets'])
+        history.append({'id': 2})
+        del processes[:]
+        self.assertEqual(project.do_json('compute-facets')['history'], 2)
+        self.assertEqual(requests[-3:], ['get-processes', 'get-history',
+                                         'compute-facets'])
+        self.assertEqual(project.do_json('compute-facets')['history'], 2)
+        self.assertEqual(len(requests), 6)     # served from the cache
+
+
+if __name__ == '__main__':
+    unittest.main()
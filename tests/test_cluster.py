@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+test_cluster.py
+
+Runs against stand-in Refine servers on localhost, so no Refine server is
+needed.
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+import os
+import socket
+import tempfile
+import unittest
+
+from benchmarks import standin
+from google.refine import connection
+from google.refine import instrument
+from google.refine import refine
+
+
+class BusyStandIn(standin.StandInRefine):
+    """A stand-in with processes queued on every project."""
+    queued = 3
+
+    def get_processes(self, params):
+        self._project(params)
+        return {'processes': [{'status': 'pending'}] * self.queued}
+
+
+class RefineClusterTest(unittest.TestCase):
+    def setUp(self):
+        self.httpds = [standin.serve(BusyStandIn(first_id=1000)),
+                       standin.serve(standin.StandInRefine(first_id=2000))]
+        self.busy, self.idle = [httpd.app for httpd in self.httpds]
+        self.pool = connection.ConnectionPool()
+        self.cluster = refine.RefineCluster(
+            [refine.RefineServer(httpd.url, pool=self.pool)
+             for httpd in self.httpds], latency_weight=0, depths_ttl=0)
+        fd, self.path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write('a,b\n1,2\n')
+
+    def tearDown(self):
+        os.remove(self.path)
+        self.cluster.close()
+        self.pool.clear()
+        for httpd in self.httpds:
+            httpd.shutdown()
+            httpd.server_close()
+
+    def set_latency(self, *latencies):
+        for server, latency in zip(self.cluster.servers, latencies):
+            self.cluster.latency[server.server] = latency
+
+    def test_placed_by_queue_depth(self):
+        self.set_latency(0.01, 0.02)
+        project = self.cluster.new_project(project_file=self.path)
+        self.assertTrue(project.project_id in self.busy.projects)
+        self.assertEqual(self.cluster.queue_depths(), {
+            self.httpds[0].url: 3, self.httpds[1].url: 0})
+        project = self.cluster.new_project(project_file=self.path)
+        self.assertTrue(project.project_id in self.idle.projects)
+        self.assertTrue(project.server is self.cluster.servers[1])
+
+    def test_only_placed_projects_queried(self):
+        for _ in range(5):
+            self.busy.add_synthetic_project(10)
+        self.cluster.list_projects()
+        traces = []
+        self.cluster.servers[0].hooks.append(traces.append)
+        self.assertEqual(self.cluster.queue_depths(), {
+            self.httpds[0].url: 0, self.httpds[1].url: 0})
+        self.assertEqual(traces, [])
+
+    def test_placed_by_latency(self):
+        self.set_latency(0.05, 0.01)
+        self.assertEqual(self.cluster.by_load(),
+                         self.cluster.servers[::-1])
+        self.set_latency(0.01, 0.05)
+        project = self.cluster.new_project(project_file=self.path)
+        self.assertTrue(project.project_id in self.busy.projects)
+
+    def test_deleted_projects_forgotten(self):
+        first = self.cluster.new_project(project_file=self.path)
+        second = self.cluster.new_project(project_file=self.path)
+        self.assertTrue(first.delete())
+        self.assertEqual(self.cluster._placed, set([second.project_id]))
+        # deleted by another client
+        refine.RefineProject(second.server, second.project_id).delete()
+        self.cluster.queue_depths()
+        self.assertEqual(self.cluster._placed, set())
+
+    def test_depths_reused(self):
+        self.cluster.depths_ttl = 60
+        self.set_latency(0.01, 0.01)
+        projects = [self.cluster.new_project(project_file=self.path)
+                    for _ in range(4)]
+        traces = []
+        for server in self.cluster.servers:
+            server.hooks.append(traces.append)
+        self.cluster.by_load()
+        self.assertEqual([trace.command for trace in traces], [])
+        # each placed project counted as load, so they're spread out
+        self.assertEqual(sorted(p.server is self.cluster.servers[0]
+                                for p in projects), [False, False, True, True])
+
+    def test_latency_average(self):
+        cluster = refine.RefineCluster(['http://refine'], latency_weight=0.5)
+        for first_byte in (1.0, 2.0, 4.0):
+            trace = instrument.Trace([], 'http://refine', 'get-rows')
+            trace.first_byte = first_byte
+            cluster._observe(trace)
+        self.assertEqual(cluster.latency['http://refine'], 2.75)
+
+    def test_routing(self):
+        project_id = self.idle.add_synthetic_project(10)
+        project = self.cluster.open_project(project_id)
+        self.assertTrue(project.server is self.cluster.servers[1])
+        self.assertEqual(project.get_rows(limit=5).total, 10)
+        project = refine.RefineProject(self.cluster, project_id)
+        self.assertTrue(project.server is self.cluster.servers[1])
+        self.assertRaises(Exception, self.cluster.open_project, '999')
+
+    def test_project_made_elsewhere(self):
+        self.cluster.list_projects()    # cached for all the TTL
+        project_id = self.busy.add_synthetic_project(10)
+        project = self.cluster.open_project(project_id)
+        self.assertTrue(project.server is self.cluster.servers[0])
+
+    def test_unreachable_server(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()    # nothing is listening on port now
+        dead = 'http://127.0.0.1:%d' % port
+        cluster = refine.RefineCluster(
+            [refine.RefineServer(dead, pool=self.pool),
+             refine.RefineServer(self.httpds[1].url, pool=self.pool)])
+        project = cluster.new_project(project_file=self.path)
+        self.assertTrue(project.project_id in self.idle.projects)
+        self.assertEqual(cluster.latency[dead], float('inf'))
+        self.assertEqual(cluster.by_load()[0], cluster.servers[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+test_clustering.py
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+import hashlib
+import unittest
+
+from google.refine import clustering
+
+
+class KeyerTest(unittest.TestCase):
+    def test_fingerprint(self):
+        self.assertEqual(clustering.fingerprint('  Tom  Cruise, Jr. '),
+                         u'cruise jr tom')
+        self.assertEqual(clustering.fingerprint(u'Caf\xe9 caf\xe9'), u'cafe')
+
+    def test_ngram_fingerprint(self):
+        self.assertEqual(clustering.ngram_fingerprint('Paris'),
+                         u'arispari')
+        self.assertEqual(clustering.ngram_fingerprint('P aris', 1),
+                         u'aiprs')
+
+    def test_metaphone(self):
+        for word, code in [('Thomas', '0MS'), ('knight', 'NT'),
+                           ('Schmidt', 'SKMTT'), ('Smith', 'SM0'),
+                           ('Smyth', 'SM0'), ('judge', 'JJ'),
+                           ('Xavier', 'SFR'), ('wright', 'RT')]:
+            self.assertEqual(clustering.metaphone(word), code)
+
+    def test_levenshtein(self):
+        self.assertEqual(clustering.levenshtein('kitten', 'sitting'), 3)
+        self.assertEqual(clustering.levenshtein('', 'abc'), 3)
+        self.assertEqual(clustering.levenshtein('kitten', 'sitting', 1), 2)
+
+
+class ComputeClustersTest(unittest.TestCase):
+    values = (['New York'] * 3 + ['new york'] * 2 + ['York, New'] +
+              ['Boston', 'boston', 'Bostn', ''])
+
+    def test_binning(self):
+        clusters = clustering.compute_clusters(self.values)
+        self.assertEqual(clusters[0], [
+            {'value': 'New York', 'count': 3},
+            {'value': 'new york', 'count': 2},
+            {'value': 'York, New', 'count': 1}])
+        self.assertEqual(clusters[1], [
+            {'value': 'Boston', 'count': 1},
+            {'value': 'boston', 'count': 1}])
+        self.assertEqual(len(clusters), 2)
+
+    def test_knn(self):
+        clusters = clustering.compute_clusters(
+            self.values, 'knn', params={'radius': 1,
+                                        'blocking-ngram-size': 2})
+        values = sorted(sorted(c['value'] for c in cluster)
+                        for cluster in clusters)
+        # Boston is within 1 of both the others, which aren't of each other
+        self.assertEqual(values, [['Bostn', 'Boston'],
+                                  ['Bostn', 'Boston', 'boston'],
+                                  ['Boston', 'boston']])
+
+    def test_workers(self):
+        values = ['value %d' % (i // 2) for i in range(3000)]
+        values += ['Value %d' % i for i in range(0, 1500, 100)]
+        clusters = clustering.compute_clusters(values, workers=2)
+        self.assertEqual(clusters, clustering.compute_clusters(values,
+                                                               workers=1))
+        self.assertEqual(len(clusters), 15)
+        values = [hashlib.md5(str(i)).hexdigest() for i in range(2000)]
+        values += [value[:-1] + '_' for value in values[:20]]
+        clusters = clustering.compute_clusters(values, 'knn', workers=2)
+        self.assertEqual(len(clusters), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
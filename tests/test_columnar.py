@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+test_columnar.py
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+import math
+import unittest
+
+from google.refine import columnar
+from google.refine import refine
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+
+class ReadColumnsTest(unittest.TestCase):
+    rows = [
+        ['id', 'name', 'score', 'code'],
+        ['1', 'Ann', '1.5', '7'],
+        ['2', 'Bob', '', '007'],
+        ['3', 'Ann', '-2', 'x'],
+        ['4', 'Cy'],
+    ]
+
+    def test_read_columns(self):
+        columns = columnar.read_columns(self.rows, ['name', 'id', 'score',
+                                                   'code'])
+        self.assertEqual(list(columns), ['name', 'id', 'score', 'code'])
+        self.assertEqual(list(columns['id']), [1, 2, 3, 4])
+        self.assertEqual(list(columns['name']), ['Ann', 'Bob', 'Ann', 'Cy'])
+        self.assertEqual(columns['score'][0], 1.5)
+        self.assertTrue(math.isnan(columns['score'][1]))
+        self.assertTrue(math.isnan(columns['score'][3]))
+        # numeric until 'x', and '007' survives the round trip
+        self.assertEqual(list(columns['code']), ['7', '007', 'x', ''])
+
+    def test_column_names(self):
+        rows = [['name', 'caf\xc3\xa9'], ['Ann', '1']]
+        columns = columnar.read_columns(rows, [u'caf\xe9', u'name'])
+        self.assertEqual(list(columns), [u'caf\xe9', u'name'])
+        self.assertEqual(list(columns[u'caf\xe9']), [1])
+        self.assertEqual(list(columnar.read_columns(rows)),
+                         [u'name', u'caf\xe9'])
+        self.assertRaises(ValueError, columnar.read_columns, rows,
+                          [u'name', u'cafe'])
+
+    def test_interned(self):
+        columns = columnar.read_columns(self.rows)
+        self.assertTrue(columns['name'][0] is columns['name'][2])
+
+    def test_numpy(self):
+        if columnar.numpy is None:
+            return
+        columns = columnar.read_columns(self.rows)
+        self.assertEqual(columns['id'].dtype, columnar.numpy.float64)
+        self.assertEqual(columns['name'].dtype, object)
+
+
+    @unittest.skipUnless(pandas, 'needs pandas')
+    def test_dataframe(self):
+        df = columnar.read_columns(self.rows, ['name', 'id', 'score', 'code'],
+                                   as_dataframe=True)
+        self.assertTrue(isinstance(df, pandas.DataFrame))
+        self.assertEqual(list(df.columns), ['name', 'id', 'score', 'code'])
+        self.assertEqual(df['id'].tolist(), [1, 2, 3, 4])
+        self.assertEqual(df['name'].tolist(), ['Ann', 'Bob', 'Ann', 'Cy'])
+        self.assertEqual(df['score'].isnull().tolist(),
+                         [False, True, False, True])
+        self.assertEqual(df['code'].tolist(), ['7', '007', 'x', ''])
+
+
+class ExportColumnsTest(unittest.TestCase):
+    @unittest.skipUnless(pandas, 'needs pandas')
+    def test_export_columns_dataframe(self):
+        project = refine.RefineProject('1658955153749')
+        project.columns = [u'name', u'id', u'score', u'code']
+        project._models_stale = False
+        project.export_rows = lambda: iter(ReadColumnsTest.rows)
+        df = project.export_columns(as_dataframe=True)
+        self.assertEqual(list(df.columns), [u'name', u'id', u'score',
+                                            u'code'])
+        self.assertEqual(len(df), 4)
+        self.assertEqual(df[u'id'].sum(), 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+test_concurrent.py
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+import json
+import threading
+import time
+import unittest
+
+from google.refine import concurrent
+from google.refine import facet
+from google.refine import refine
+
+
+class AsyncRefineProjectTest(unittest.TestCase):
+    def setUp(self):
+        # Mock out get_models so it doesn't attempt to connect to a server
+        self._get_models = refine.RefineProject.get_models
+        refine.RefineProject.get_models = lambda me: me
+        self.async_server = concurrent.AsyncRefineServer(
+            'http://127.0.0.1:3333', workers=4)
+        self.threads = set()
+        self.polls = []
+
+    def tearDown(self):
+        self.async_server.close()
+        refine.RefineProject.get_models = self._get_models
+
+    def async_project(self, project_id):
+        project = concurrent.AsyncRefineProject(self.async_server,
+                                                project_id)
+
+        def do_json(command, data=None, include_engine=True):
+            self.threads.add(threading.current_thread())
+            if command == 'fail':
+                raise Exception('server error: ' + project_id)
+            if command == 'compute-facets':
+                time.sleep(0.01)    # while the next request is made
+                facets = json.loads(data['engine'])['facets']
+                return {'mode': 'row-based', 'facets': [
+                    {'name': f['name'], 'expression': f['expression'],
+                     'columnName': f['columnName'],
+                     'choices': [{'v': {'v': 'x', 'l': 'x'}, 'c': 1,
+                                  's': False}]}
+                    for f in facets]}
+            if command == 'get-processes':
+                self.polls.append(project_id)
+                busy = self.polls.count(project_id) <= 3
+                return {'processes': [{'status': 'pending'}] if busy else []}
+            return {'code': 'ok', 'command': command, 'project': project_id}
+        project.project.do_json = do_json
+        return project
+
+    def test_gather(self):
+        projects = [self.async_project(str(i)) for i in range(20)]
+        results = [p.do_json('get-models') for p in projects]
+        responses = concurrent.gather(results)
+        self.assertEqual([r['project'] for r in responses],
+                         [str(i) for i in range(20)])
+        self.assertFalse(threading.current_thread() in self.threads)
+        self.assertTrue(len(self.threads) <= 4)
+
+    def test_callback_and_errors(self):
+        project = self.async_project('1')
+        called = []
+        project.do_json('get-rows', callback=called.append).wait()
+        self.assertEqual(called[0]['command'], 'get-rows')
+        result = project.do_json('fail')
+        self.assertRaises(Exception, result.get)
+
+    def test_engine_captured(self):
+        project = self.async_project('1')
+        a, b = facet.TextFacet('A'), facet.TextFacet('B')
+        results = [project.compute_facets(a), project.compute_facets(b)]
+        a.include('x')      # changes after submitting don't count either
+        first, second = concurrent.gather(results)
+        self.assertEqual(first.facets[a].choices['x'].count, 1)
+        self.assertEqual(second.facets[b].choices['x'].count, 1)
+        self.assertEqual(project.engine.facets, [b])
+        self.assertEqual(project.do_json('get-rows').get()['code'], 'ok')
+
+
+    def test_wait_until_idle(self):
+        projects = [self.async_project(str(i)) for i in range(10)]
+        waits = [p.wait_until_idle(polling_delay=0.05) for p in projects]
+        time.sleep(0.01)
+        # polling holds no worker, so other requests still go through
+        started = time.time()
+        self.assertEqual(projects[0].do_json('get-rows').get()['code'], 'ok')
+        self.assertTrue(time.time() - started < 0.05)
+        self.assertFalse(any(wait.ready() for wait in waits))
+        self.assertEqual(concurrent.gather(waits), [None] * 10)
+        self.assertEqual(len(self.polls), 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
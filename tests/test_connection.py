@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""
+test_connection.py
+
+Runs against a throwaway HTTP server on localhost, so no Refine server is
+needed.
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+import BaseHTTPServer
+import gzip
+import httplib
+import json
+import os
+import resource
+import socket
+import SocketServer
+import StringIO
+import threading
+import time
+import unittest
+
+from google.refine import connection
+from google.refine import refine
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/command/core/get-version')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path == '/lines':
+            body = 'one\ntwo\nthree'
+        elif self.path.startswith('/command/core/export-rows'):
+            body = ''.join('row %d\n' % i for i in range(100000))
+        else:
+            body = json.dumps({'version': '2.5', 'path': self.path})
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO.StringIO()
+            gzip_fp = gzip.GzipFile(fileobj=buf, mode='wb')
+            gzip_fp.write(body)
+            gzip_fp.close()
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers['Content-Length']))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline(), 16)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+            if not size:
+                return ''.join(chunks)
+
+    def do_POST(self):
+        body = json.dumps({'code': 'ok', 'data': self.read_body()})
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass    # clients hanging up early is expected
+
+
+class DroppingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Reads a connection's second request but hangs up without answering,
+    as a server does when it drops a keep-alive connection mid-request.
+    After /close it hangs up straight away."""
+    protocol_version = 'HTTP/1.1'
+    received = []
+
+    def respond(self):
+        if self.headers.get('Content-Length'):
+            self.rfile.read(int(self.headers['Content-Length']))
+        self.received.append((self.command, self.path))
+        self.handled = getattr(self, 'handled', 0) + 1
+        if self.handled == 2:
+            self.close_connection = 1
+            return
+        body = 'ok'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == '/close':
+            # hang up an idle keep-alive connection, without saying so
+            self.close_connection = 1
+
+    do_GET = do_POST = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd = ThreadedHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_port
+        self.pool = connection.ConnectionPool(maxsize=2)
+
+    def tearDown(self):
+        self.pool.clear()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_reuse(self):
+        server = refine.RefineServer(self.url, pool=self.pool)
+        for _ in range(3):
+            self.assertEqual(server.get_version()['version'], '2.5')
+        response = server.urlopen_json('do-it', data={'a': 'b'})
+        self.assertEqual(response['data'], 'a=b')
+        self.assertEqual(self.pool.stats(),
+                         {'hits': 3, 'misses': 1, 'idle': 1})
+
+    def test_streamed_body(self):
+        server = refine.RefineServer(self.url, pool=self.pool)
+        server.get_version()
+        response = server.urlopen_json('upload', data={
+            'f': {'fd': iter(['a,b\n', '1,2\n']), 'filename': 'f.csv'}})
+        self.assertTrue('a,b\n1,2\n' in response['data'])
+        self.assertEqual(self.pool.stats(),
+                         {'hits': 0, 'misses': 2, 'idle': 2})
+
+    def test_unread_response_not_reused(self):
+        response = self.pool.urlopen('GET', self.url + '/lines')
+        response.close()
+        self.pool.urlopen('GET', self.url + '/lines').read()
+        self.assertEqual(self.pool.stats()['misses'], 2)
+
+    def test_lines(self):
+        response = self.pool.urlopen('GET', self.url + '/lines')
+        self.assertEqual(response.readline(), 'one\n')
+        self.assertEqual(list(response), ['two\n', 'three'])
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+    def test_gzip(self):
+        server = refine.RefineServer(self.url, pool=self.pool)
+        response = server.urlopen('export-rows/project.tsv')
+        self.assertEqual(response.info().get('Content-Encoding'), 'gzip')
+        self.assertEqual(response.readline(), 'row 0\n')
+        self.assertEqual(response.read(6), 'row 1\n')
+        lines = list(response)
+        self.assertEqual(len(lines), 99998)
+        self.assertEqual(lines[-1], 'row 99999\n')
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+    def test_redirect(self):
+        response = self.pool.urlopen('GET', self.url + '/redirect')
+        self.assertEqual(response.geturl(),
+                         self.url + '/command/core/get-version')
+        self.assertEqual(json.loads(response.read())['version'], '2.5')
+        response = self.pool.urlopen('GET', self.url + '/redirect',
+                                     redirect=False)
+        self.assertEqual(response.code, 302)
+
+
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        DroppingHandler.received = []
+        self.httpd = ThreadedHTTPServer(('127.0.0.1', 0), DroppingHandler)
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_port
+        self.pool = connection.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.clear()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_get_retried(self):
+        self.pool.urlopen('GET', self.url + '/a').read()
+        self.assertEqual(self.pool.urlopen('GET', self.url + '/b').read(),
+                         'ok')
+        self.assertEqual([path for _, path in DroppingHandler.received],
+                         ['/a', '/b', '/b'])
+
+    def test_post_not_resent(self):
+        self.pool.urlopen('GET', self.url + '/a').read()
+        self.assertRaises(httplib.HTTPException, self.pool.urlopen,
+                          'POST', self.url + '/apply', 'operations=[]')
+        self.assertEqual([path for _, path in DroppingHandler.received],
+                         ['/a', '/apply'])
+        # unless the caller knows it only reads
+        self.pool.urlopen('GET', self.url + '/a').read()
+        self.assertEqual(self.pool.urlopen('POST', self.url + '/rows', 'x',
+                                           idempotent=True).read(), 'ok')
+
+    def test_closed_idle_connection_not_reused(self):
+        self.pool.urlopen('GET', self.url + '/close').read()
+        time.sleep(0.1)     # for the server's hang up to arrive
+        self.assertEqual(self.pool.urlopen('POST', self.url + '/apply',
+                                           'operations=[]').read(), 'ok')
+        self.assertEqual([path for _, path in DroppingHandler.received],
+                         ['/close', '/apply'])
+        self.assertEqual(self.pool.stats()['misses'], 2)
+
+
+class Descriptor(object):
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+
+class DroppedTest(unittest.TestCase):
+    @unittest.skipUnless(
+        resource.getrlimit(resource.RLIMIT_NOFILE)[0] > 2000,
+        'needs over 2000 file descriptors')
+    def test_high_descriptor(self):
+        # select() can't take descriptors past FD_SETSIZE, 1024 on Linux
+        ours, theirs = socket.socketpair()
+        os.dup2(ours.fileno(), 2000)
+        try:
+            self.assertFalse(connection._dropped(Descriptor(2000)))
+            theirs.close()
+            self.assertTrue(connection._dropped(Descriptor(2000)))
+        finally:
+            os.close(2000)
+            ours.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
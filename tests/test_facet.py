@@ -65,6 +65,18 @@ class FacetTest(unittest.TestCase):
         facet.include('element').include('element 2')
         self.assertEqual(len(facet.selection), 2)
 
+    def test_bulk_selections(self):
+        facet = TextFacet('column name', selection=['b', 'a'])
+        facet.include_many(['c', 'a', 'd'])
+        self.assertEqual([s['v']['v'] for s in facet.selection],
+                         ['b', 'a', 'c', 'd'])
+        facet.exclude_many(['a', 'd', 'missing'])
+        self.assertEqual(facet.as_dict()['selection'],
+                         [{'v': {'v': 'b', 'l': 'b'}},
+                          {'v': {'v': 'c', 'l': 'c'}}])
+        facet.selection = [{'v': {'v': 'x', 'l': 'x'}}, 'y']
+        self.assertEqual([s['v']['v'] for s in facet.selection], ['x', 'y'])
+
 
 class EngineTest(unittest.TestCase):
     def test_init(self):
@@ -86,6 +98,33 @@ class EngineTest(unittest.TestCase):
         facet = NumericFacet(column='column', From=1, to=5)
         self.assertEqual(facet.as_dict(), {'from': 1, 'to': 5, 'selectBlank': True, 'name': 'column', 'selectError': True, 'expression': 'value',  'selectNumeric': True, 'columnName': 'column', 'selectNonNumeric': True, 'type': 'range'})
 
+    def test_serialize_cached(self):
+        facet = TextFacet('column')
+        engine = Engine(facet)
+        engine_json = engine.as_json()
+        self.assertTrue(engine.as_json() is engine_json)
+        facet.include('element')
+        self.assertTrue('"element"' in engine.as_json())
+        facet.exclude('element')
+        self.assertFalse('"element"' in engine.as_json())
+        facet.invert = True
+        self.assertTrue('"invert": true' in engine.as_json())
+        facet.selection = ['x']
+        self.assertTrue('"x"' in engine.as_json())
+        custom = Facet('custom', 'custom', values=[])
+        engine.add_facet(custom)
+        engine.as_json()
+        custom.values.append('y')
+        custom.changed()
+        self.assertTrue('"y"' in engine.as_json())
+        engine.mode = 'record-based'
+        self.assertTrue('record-based' in engine.as_json())
+        engine.add_facet(NumericFacet('number'))
+        self.assertTrue('"number"' in engine.as_json())
+        engine.remove_all()
+        self.assertEqual(engine.as_json(),
+                         '{"facets": [], "mode": "record-based"}')
+
     def test_add_facet(self):
         facet = TextFacet(column='Party Code')
         engine = Engine(facet)
@@ -142,6 +181,23 @@ class FacetsResponseTest(unittest.TestCase):
         # test iteration
         facet = [f for f in facets][0]
         self.assertEqual(facet, facets[0])
+        self.assertEqual(len(facets), 1)
+
+    def test_facet_response_lazy(self):
+        party_code_facet = TextFacet('Party Code')
+        engine = Engine(party_code_facet)
+        facets = engine.facets_response(json.loads(self.response)).facets
+        self.assertEqual(facets.counts(party_code_facet),
+                         {'D': 3700, 'R': 1613, 'N': 15, 'O': 184})
+        self.assertEqual(facets[0].counts(), facets.counts(0))
+        choices = facets[0].choices
+        self.assertEqual(sorted(choices), ['D', 'N', 'O', 'R'])
+        self.assertTrue('N' in choices)
+        self.assertFalse('X' in choices)
+        self.assertTrue(choices['N'] is choices['N'])
+        self.assertEqual(choices['N'].selected, False)
+        self.assertEqual(facets[0].column_name, 'Party Code')
+        self.assertRaises(KeyError, lambda: choices['X'])
 
 
 if __name__ == '__main__':
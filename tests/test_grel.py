@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+test_grel.py
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+import unittest
+
+from google.refine import grel
+
+
+def evaluate(source, value=None):
+    return grel.compile(source)(value)
+
+
+class GrelTest(unittest.TestCase):
+    def test_strings(self):
+        self.assertEqual(evaluate('value.trim().toUppercase()', ' ab '),
+                         u'AB')
+        self.assertEqual(evaluate('toTitlecase(value)', 'new york'),
+                         u'New York')
+        self.assertEqual(evaluate('value.length()', 'abc'), 3)
+        self.assertEqual(evaluate('value.substring(1, 3)', 'abcd'), u'bc')
+        self.assertEqual(evaluate('value[1]', 'abcd'), u'b')
+        self.assertEqual(evaluate('value[-2:]', 'abcd'), u'cd')
+        self.assertEqual(evaluate('value + "-" + 1', 'a'), u'a-1')
+        self.assertEqual(evaluate("'it\\'s'"), u"it's")
+        self.assertEqual(evaluate('value.split(",").join("|")', 'a,b'),
+                         u'a|b')
+        self.assertEqual(evaluate('fingerprint(value)', 'B a, a'), u'a b')
+
+    def test_regex(self):
+        self.assertEqual(evaluate('value.replace(/(\\d+)-(\\d+)/, "$2-$1")',
+                                  '12-34'), u'34-12')
+        self.assertEqual(evaluate('value.replace("-", "/")', '1-2-3'),
+                         u'1/2/3')
+        self.assertEqual(evaluate('value.match(/(\\w+)@(.*)/)', 'me@x.com'),
+                         [u'me', u'x.com'])
+        self.assertEqual(evaluate('value.match(/\\d+/)', 'a1'), None)
+        self.assertEqual(evaluate('value.find(/\\d/)', 'a1b2'), [u'1', u'2'])
+        self.assertEqual(evaluate('contains(value, /^a/)', 'ab'), True)
+        self.assertEqual(evaluate('10 / 4 / 2'), 1)     # long division
+
+    def test_numbers(self):
+        self.assertEqual(evaluate('value.toNumber() * 2', '21'), 42)
+        self.assertEqual(evaluate('value.toNumber() + 0.5', '1'), 1.5)
+        self.assertEqual(evaluate('-value.toNumber() % 3', '4'), 2)
+        self.assertEqual(evaluate('value.toNumber() >= 3', '3'), True)
+        self.assertEqual(evaluate('round(2.5)'), 3)
+        self.assertEqual(evaluate('isNumeric(value)', '1e3'), True)
+
+    def test_controls(self):
+        self.assertEqual(evaluate('if(isBlank(value), "none", value)', ''),
+                         u'none')
+        self.assertEqual(evaluate('if(value == "a", 1, 2)', 'a'), 1)
+        self.assertEqual(
+            evaluate('forNonBlank(value, v, v.toLowercase(), "-")', 'A'),
+            u'a')
+        self.assertEqual(
+            evaluate('forNonBlank(value, v, v.toLowercase(), "-")', ''),
+            u'-')
+        self.assertEqual(evaluate('with(value.split(" "), w, w[0])', 'a b'),
+                         u'a')
+        self.assertEqual(
+            evaluate('forEach(value.split(","), x, x.trim())', 'a, b'),
+            [u'a', u'b'])
+        self.assertEqual(
+            evaluate('filter(value.split(","), x, x != "b")', 'a,b,c'),
+            [u'a', u'c'])
+        self.assertEqual(evaluate('and(true, not(false))'), True)
+
+    def test_errors(self):
+        self.assertEqual(evaluate('value.toNumber()', 'x'),
+                         grel.EvalError('Cannot parse to number'))
+        self.assertTrue(isinstance(evaluate('1 / value.toNumber()', '0'),
+                                   grel.EvalError))
+        self.assertEqual(evaluate('value.trim()', ''), None)
+        for source in ('cells["a"].value', 'value.foo()', 'value.length',
+                       'value +', 'nope(1)', '"unterminated'):
+            self.assertRaises(grel.GrelError, grel.compile, source)
+        self.assertEqual(evaluate('grel:value', 'a'), u'a')
+
+    def test_preview(self):
+        preview = grel.preview('value.toNumber()', ['1', '2', 'x', '1', ''])
+        self.assertEqual(preview.results[:2], [1, 2])
+        self.assertEqual([value for value, _ in preview.errors], ['x'])
+        summary = preview.summary()
+        self.assertEqual(summary['rows'], 5)
+        self.assertEqual(summary['errors'], 1)
+        self.assertEqual(summary['error_rate'], 0.2)
+        self.assertEqual(summary['blank'], 1)
+        self.assertEqual(summary['changed'], 3)
+        self.assertEqual(summary['messages'], [('Cannot parse to number', 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
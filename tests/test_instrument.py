@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+test_instrument.py
+
+Runs against a throwaway HTTP server on localhost, so no Refine server is
+needed.
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+import socket
+import threading
+import unittest
+import urllib2
+
+from google.refine import connection
+from google.refine import instrument
+from google.refine import refine
+from tests.test_connection import KeepAliveHandler, ThreadedHTTPServer
+
+
+class HistogramTest(unittest.TestCase):
+    def test_observe(self):
+        histogram = instrument.Histogram([1, 10])
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+        self.assertEqual(histogram.cumulative(),
+                         [(1, 2), (10, 3), (float('inf'), 4)])
+        self.assertEqual(histogram.sum, 56.5)
+        self.assertEqual(histogram.count, 4)
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = instrument.Metrics(time_buckets=(0.1, 1))
+
+    def test_snapshot(self):
+        for command in ('get-rows', 'get-rows', 'get-models'):
+            trace = instrument.Trace([], 'http://refine', command)
+            trace.finish()
+            self.metrics(trace)
+        failed = instrument.Trace([], 'http://refine', 'get-rows')
+        failed.fail('http_500')
+        failed.finish()
+        self.metrics(failed)
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(sorted(snapshot), ['get-models', 'get-rows'])
+        rows = snapshot['get-rows']
+        self.assertEqual(rows['request_seconds']['count'], 3)
+        self.assertEqual(rows['request_seconds']['buckets'][0], (0.1, 3))
+        self.assertEqual(rows['errors'], {'http_500': 1})
+        # no gzipped responses so no ratios
+        self.assertEqual(rows['gzip_ratio']['count'], 0)
+        self.metrics.clear()
+        self.assertEqual(self.metrics.snapshot(), {})
+
+    def test_prometheus(self):
+        trace = instrument.Trace([], 'http://refine', 'get-rows')
+        trace.fail('connection')
+        trace.finish()
+        self.metrics(trace)
+        text = self.metrics.prometheus()
+        self.assertTrue('# TYPE refine_client_request_seconds histogram\n'
+                        in text)
+        self.assertTrue('refine_client_request_seconds_bucket'
+                        '{command="get-rows",le="+Inf"} 1\n' in text)
+        self.assertTrue('refine_client_request_seconds_count'
+                        '{command="get-rows"} 1\n' in text)
+        self.assertTrue('refine_client_errors_total'
+                        '{command="get-rows",error="connection"} 1\n' in text)
+
+
+class RefineServerHooksTest(unittest.TestCase):
+    def setUp(self):
+        self.httpd = ThreadedHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_port
+        self.pool = connection.ConnectionPool()
+        self.traces = []
+        self.server = refine.RefineServer(self.url, pool=self.pool,
+                                          hooks=[self.traces.append])
+
+    def tearDown(self):
+        self.pool.clear()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_traces(self):
+        self.server.get_version()
+        self.server.get_version()
+        self.server.urlopen_json('do-it', data={'a': 'b'})
+        first, second, post = self.traces
+        self.assertEqual(first.command, 'get-version')
+        self.assertEqual(first.status, 200)
+        self.assertTrue(first.connect > 0)
+        self.assertEqual(second.connect, 0)     # a reused connection
+        self.assertTrue(0 < first.first_byte <= first.total)
+        self.assertTrue(first.gzipped)
+        self.assertEqual(post.request_bytes, len('a=b'))
+        self.assertEqual(post.response_bytes, post.decoded_bytes)
+        self.assertEqual(post.gzip_ratio, None)
+
+    def test_gzip(self):
+        response = self.server.urlopen('export-rows/My%20project.tsv')
+        self.assertEqual(self.traces, [])   # not until it's been read
+        self.assertEqual(len(list(response)), 100000)
+        trace, = self.traces
+        self.assertEqual(trace.command, 'export-rows')
+        self.assertEqual(trace.decoded_bytes,
+                         sum(len('row %d\n' % i) for i in range(100000)))
+        self.assertTrue(trace.gzip_ratio > 2)
+
+    def test_closed_early(self):
+        response = self.server.urlopen('export-rows/project.tsv')
+        response.readline()
+        response.close()
+        self.assertEqual(len(self.traces), 1)
+
+    def test_connection_error(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()    # nothing is listening on port now
+        server = refine.RefineServer('http://127.0.0.1:%d' % port,
+                                     pool=self.pool,
+                                     hooks=[self.traces.append])
+        self.assertRaises(urllib2.URLError, server.get_version)
+        trace, = self.traces
+        self.assertEqual(trace.error, 'connection')
+
+    def test_metrics(self):
+        metrics = instrument.Metrics()
+        self.server.hooks.append(metrics)
+        self.server.get_version()
+        self.server.urlopen('export-rows/project.tsv').read()
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['get-version']['request_seconds']['count'],
+                         1)
+        self.assertEqual(snapshot['export-rows']['gzip_ratio']['count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+test_local.py
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+import unittest
+
+from google.refine import columnar
+from google.refine import facet
+from google.refine import local
+
+ROWS = [
+    ['party', 'age', 'name'],
+    ['D', '30', 'Alice Smith'],
+    ['R', '45', 'bob jones'],
+    ['D', '', 'Carol Smith'],
+    ['', '61', 'Dan Brown'],
+    ['D', 'n/a', 'Eve Smithers'],
+]
+
+
+class LocalEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.data = columnar.read_columns(ROWS)
+
+    def test_text_facet(self):
+        party = facet.TextFacet('party')
+        local_engine = local.LocalEngine(self.data)
+        facets = local_engine.compute_facets(party).facets
+        self.assertEqual(facets.counts(party), {'D': 3, 'R': 1})
+        self.assertEqual(facets[party].blank_choice.count, 1)
+        party.include('R')
+        self.assertEqual(local_engine.filter().tolist(),
+                         [False, True, False, False, False])
+        party.select_blank = True
+        self.assertEqual(local_engine.filtered()['name'].tolist(),
+                         ['bob jones', 'Dan Brown'])
+        party.invert = True
+        self.assertEqual(local_engine.filter().sum(), 3)
+
+    def test_other_facets_filter(self):
+        party = facet.TextFacet('party', 'D')
+        name = facet.TextFilterFacet('name', 'SMITH')
+        local_engine = local.LocalEngine(self.data,
+                                         facet.Engine(party, name))
+        facets = local_engine.compute_facets().facets
+        # party's counts aren't filtered by party itself
+        self.assertEqual(facets.counts(party), {'D': 3})
+        self.assertEqual(facets[party].choices['D'].selected, True)
+        self.assertEqual(facets[party].blank_choice.count, 0)
+        self.assertEqual(local_engine.filter().sum(), 3)
+        name.case_sensitive = True
+        self.assertEqual(local_engine.filter().sum(), 0)
+
+    def test_blank_facet(self):
+        blank = facet.BlankFacet('age', True)
+        local_engine = local.LocalEngine(self.data)
+        facets = local_engine.compute_facets(blank).facets
+        self.assertEqual(facets.counts(0), {True: 1, False: 4})
+        self.assertEqual(local_engine.filtered()['name'].tolist(),
+                         ['Carol Smith'])
+
+    def test_numeric_facet(self):
+        age = facet.NumericFacet('age')
+        local_engine = local.LocalEngine(self.data)
+        response = local_engine.compute_facets(age).facets[0]
+        self.assertEqual((response.min, response.max, response.step),
+                         (30, 62, 1))
+        self.assertEqual(len(response.bins), 32)
+        self.assertEqual(sum(response.base_bins), 3)
+        self.assertEqual(response.numeric_count, 3)
+        self.assertEqual(response.non_numeric_count, 1)
+        self.assertEqual(response.blank_count, 1)
+        age.From, age.to = 40, 50
+        age.select_non_numeric = False
+        self.assertEqual(local_engine.filtered()['name'].tolist(),
+                         ['bob jones', 'Carol Smith'])
+        party = facet.TextFacet('party', 'D')
+        local_engine.engine.add_facet(party)
+        response = local_engine.compute_facets().facets[0]
+        self.assertEqual(sum(response.bins), 1)
+        self.assertEqual(sum(response.base_bins), 3)
+        self.assertEqual(response.blank_count, 1)
+
+    def test_expressions(self):
+        surname = facet.TextFacet(
+            'name', expression='value.split(" ")[1].toLowercase()')
+        age = facet.TextFacet('age', expression='value.toNumber()')
+        length = facet.NumericFacet('name', expression='value.length()')
+        local_engine = local.LocalEngine(self.data)
+        facets = local_engine.compute_facets([surname, age, length]).facets
+        self.assertEqual(facets.counts(surname), {
+            u'smith': 2, u'jones': 1, u'brown': 1, u'smithers': 1})
+        self.assertEqual(facets.counts(age), {30: 1, 45: 1, 61: 1})
+        self.assertEqual(facets[age].error_choice['c'], 1)
+        self.assertEqual(facets[age].blank_choice.count, 1)
+        self.assertEqual(facets[length].numeric_count, 5)
+        age.include(30)
+        age.select_error = True
+        self.assertEqual(local_engine.filtered()['name'].tolist(),
+                         ['Alice Smith', 'Eve Smithers'])
+
+    def test_bin_layout(self):
+        self.assertEqual(local.bin_layout(1, 50), (1, 51, 1, 50))
+        self.assertEqual(local.bin_layout(0, 1000), (0, 1010, 10, 101))
+        self.assertEqual(local.bin_layout(5, 5), (5, 6, 1, 1))
+        # over 100 bins and the step doubles
+        self.assertEqual(local.bin_layout(50, 10050), (0, 10100, 200, 51))
+
+    def test_unsupported(self):
+        local_engine = local.LocalEngine(self.data)
+        self.assertRaises(ValueError, local_engine.compute_facets,
+                          facet.StarredFacet(True))
+
+
+if __name__ == '__main__':
+    unittest.main()
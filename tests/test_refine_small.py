@@ -5,10 +5,19 @@ test_refine_small.py
 
 # Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
 
+import json
+import os
+import tempfile
+import time
 import unittest
 
 from google.refine import refine
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class RefineRowsTest(unittest.TestCase):
     def test_rows_response(self):
@@ -40,7 +49,167 @@ class RefineRowsTest(unittest.TestCase):
         self.assertEqual(rows[0]['name'], 'Danny Baron')
         # test indexing
         self.assertEqual(response.rows[0]['name'], 'Danny Baron')
+        self.assertEqual(response.rows[0].row[2], 'CA')
+        self.assertEqual(response.rows[0].index, 0)
+        self.assertFalse(hasattr(response.rows[0], '__dict__'))
+
+    def test_rows_response_factory_cached(self):
+        rr = refine.RowsResponseFactory({u'email': 0, u'name': 1})
+        self.assertTrue(rr is refine.RowsResponseFactory({u'name': 1,
+                                                          u'email': 0}))
+        self.assertFalse(rr is refine.RowsResponseFactory({u'name': 0}))
+        for i in range(refine.ROWS_RESPONSE_CLASSES_MAXSIZE * 2):
+            refine.RowsResponseFactory({u'column %d' % i: 0})
+        self.assertEqual(len(refine._rows_response_classes),
+                         refine.ROWS_RESPONSE_CLASSES_MAXSIZE)
+
+
+class FakeServer(object):
+    server = 'http://refine.example'
+
+    def __init__(self):
+        self.requests = []
+
+    def urlopen_json(self, command, params=None):
+        self.requests.append(command)
+        if command == 'get-project-metadata':
+            return {u'name': u'p' + params['project']}
+        return {u'projects': {u'1': {u'name': u'p1'}, u'2': {u'name': u'p2'}}}
+
+
+class ProjectMetadataCacheTest(unittest.TestCase):
+    def test_cache(self):
+        cache = refine.ProjectMetadataCache(ttl=60)
+        server = FakeServer()
+        self.assertEqual(cache.project(server, u'3')['name'], 'p3')
+        self.assertEqual(cache.project(server, u'3')['name'], 'p3')
+        self.assertEqual(server.requests, ['get-project-metadata'])
+        self.assertEqual(len(cache.projects(server)), 2)
+        self.assertEqual(cache.project(server, u'2')['name'], 'p2')
+        cache.projects(server)
+        self.assertEqual(server.requests, ['get-project-metadata',
+                                           'get-all-project-metadata'])
+        self.assertEqual(cache.stats()['hits'], 3)
+        self.assertEqual(cache.stats()['misses'], 2)
+        cache.invalidate(server, u'3')
+        cache.project(server, u'3')
+        cache.projects(server)
+        self.assertEqual(len(server.requests), 4)
+
+    def test_ttl(self):
+        cache = refine.ProjectMetadataCache(ttl=0)
+        server = FakeServer()
+        cache.projects(server)
+        cache.projects(server)
+        self.assertEqual(len(server.requests), 2)
+
+
+class FakeDataFrame(object):
+    """Just what new_project_from_dataframe() needs of a pandas.DataFrame.
 
+    rows are tuples of the index value then the row's values."""
+    def __init__(self, columns, index_name, rows):
+        self.columns = columns
+        self.index = FakeIndex(index_name)
+        self.rows = rows
+
+    def itertuples(self, index=True):
+        for row in self.rows:
+            yield row if index else row[1:]
+
+
+class FakeIndex(object):
+    def __init__(self, name):
+        self.name = name
+
+class NewProjectFromRowsTest(unittest.TestCase):
+    def test_new_project_from_rows(self):
+        r = refine.Refine('http://refine.example')
+        calls = []
+
+        def new_project(project_file=None, **opts):
+            calls.append((''.join(project_file), opts))
+        r.new_project = new_project
+        r.new_project_from_rows(iter([(1, 'a'), (2, 'b')]), ['n', 'v'],
+                                project_name='rows', separator='\t')
+        data, opts = calls[0]
+        self.assertEqual(data, 'n\tv\n1\ta\n2\tb\n')
+        self.assertEqual(opts, {'project_name': 'rows', 'separator': '\t',
+                                'header_lines': 1})
+        r.new_project_from_rows([(1, 'a')], guess_cell_value_types=False)
+        data, opts = calls[1]
+        self.assertEqual(data, '1,a\n')
+        self.assertEqual(opts['header_lines'], 0)
+        self.assertEqual(opts['guess_cell_value_types'], False)
+
+    def test_new_project_from_dataframe(self):
+        r = refine.Refine('http://refine.example')
+        calls = []
+
+        def new_project(project_file=None, **opts):
+            calls.append((''.join(project_file), opts))
+        r.new_project = new_project
+        rows = [(u'r1', 1, 1.5, u'caf\xe9'), (u'r2', 2, float('nan'), None)]
+        if numpy is not None:
+            rows.append((u'r3', numpy.int64(3), numpy.float32('nan'),
+                         numpy.float64(0.25)))
+        df = FakeDataFrame([u'n', 1.0, u'v'], 'key', rows)
+        r.new_project_from_dataframe(df, project_name='df')
+        data, opts = calls[0]
+        lines = data.splitlines()
+        self.assertEqual(lines[:3], ['n,1.0,v', '1,1.5,caf\xc3\xa9', '2,,'])
+        if numpy is not None:
+            self.assertEqual(lines[3], '3,,0.25')
+        self.assertEqual(opts, {'project_name': 'df', 'separator': ',',
+                                'header_lines': 1})
+        r.new_project_from_dataframe(df, index=True)
+        data, _ = calls[1]
+        self.assertEqual(data.splitlines()[:2],
+                         ['key,n,1.0,v', 'r1,1,1.5,caf\xc3\xa9'])
+        df.index.name = None
+        r.new_project_from_dataframe(df, index=True)
+        self.assertTrue(calls[2][0].startswith('index,n,'))
+
+
+class NewShardedProjectTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        self.refine = refine.Refine('http://refine.example')
+        self.uploads = []
+        self.deleted = []
+        self.refine.new_project = self.new_project
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def new_project(self, project_file=None, project_name=None, **opts):
+        data = ''.join(project_file)
+        if 'fail' in data:
+            raise IOError('upload failed')
+        self.uploads.append(data)
+        project = refine.RefineProject(self.refine.server, str(len(
+            self.uploads)))
+        project.delete = lambda: self.deleted.append(project.project_id)
+        return project
+
+    def write(self, data):
+        with open(self.path, 'wb') as fp:
+            fp.write(data)
+
+    def test_header_only(self):
+        self.write('a,b\n')
+        project = self.refine.new_sharded_project(self.path, shards=4)
+        self.assertEqual(len(project.projects), 1)
+        self.assertEqual(self.uploads, ['a,b\n'])
+
+    def test_failed_shard(self):
+        self.write('a,b\n1,2\n3,4\nfail,5\n')
+        self.assertRaises(IOError, self.refine.new_sharded_project,
+                          self.path, shards=3)
+        # every shard that was made is deleted
+        self.assertTrue(self.uploads)
+        self.assertEqual(len(self.deleted), len(self.uploads))
 
 class RefineProjectTest(unittest.TestCase):
     def setUp(self):
@@ -70,6 +239,222 @@ class RefineProjectTest(unittest.TestCase):
         p = RP('1658955153749')
         self.assertEqual(p.server.server, 'http://10.0.0.1')
 
+    def fake_get_rows(self, project, total):
+        """Have project answer get-rows from total made-up rows."""
+        project.rows_response_factory = refine.RowsResponseFactory(
+            {u'n': 0})
+        project.requests = []
+
+        def do_json(command, data=None, include_engine=True):
+            project.requests.append(data)
+            rows = [{u'i': i, u'cells': [{u'v': i}], u'starred': False,
+                     u'flagged': False}
+                    for i in range(data['start'],
+                                   min(data['start'] + data['limit'], total))]
+            return {u'rows': rows, u'start': data['start'],
+                    u'limit': data['limit'], u'mode': u'row-based',
+                    u'filtered': total, u'total': total}
+        project.do_json = do_json
+
+    def test_iter_rows(self):
+        p = refine.RefineProject('1658955153749')
+        self.fake_get_rows(p, 25)
+        rows = p.iter_rows(page_size=10, sort_by='n')
+        self.assertEqual(p.requests, [])    # nothing fetched until iterated
+        self.assertEqual([row['n'] for row in rows], range(25))
+        self.assertEqual([r['start'] for r in p.requests], [0, 10, 20])
+        self.assertTrue('"column": "n"' in p.requests[-1]['sorting'])
+        self.assertEqual(p.requests[0]['engine'], p.engine.as_json())
+        self.fake_get_rows(p, 0)
+        self.assertEqual(list(p.iter_rows()), [])
+
+    def test_fetch_rows_parallel(self):
+        p = refine.RefineProject('1658955153749')
+        self.fake_get_rows(p, 95)
+        rows = p.fetch_rows_parallel(workers=3, page_size=10)
+        self.assertEqual([row['n'] for row in rows], range(95))
+        self.assertEqual(sorted(r['start'] for r in p.requests),
+                         range(0, 95, 10))
+        rows = p.fetch_rows_parallel(page_size=10, ordered=False)
+        self.assertEqual(sorted(row['n'] for row in rows), range(95))
+        self.fake_get_rows(p, 5)
+        self.assertEqual(len(list(p.fetch_rows_parallel(page_size=10))), 5)
+        self.assertEqual(len(p.requests), 1)
+
+    def test_fetch_rows_parallel_bounded(self):
+        p = refine.RefineProject('1658955153749')
+        self.fake_get_rows(p, 1000)
+        rows = p.fetch_rows_parallel(workers=2, page_size=10)
+        for _ in range(11):     # into the second page
+            next(rows)
+        time.sleep(0.05)
+        # the first page, the one being read & at most 4 more
+        self.assertTrue(len(p.requests) <= 6)
+        rows.close()
+
+    def test_page_errors_raised(self):
+        p = refine.RefineProject('1658955153749')
+        self.fake_get_rows(p, 25)
+        fake_do_json = p.do_json
+
+        def do_json(command, data=None, include_engine=True):
+            if data['start'] == 20:
+                raise IOError('lost')
+            return fake_do_json(command, data, include_engine)
+        p.do_json = do_json
+        rows = p.iter_rows(page_size=10)
+        self.assertRaises(IOError, list, rows)
+        rows = p.fetch_rows_parallel(workers=2, page_size=10)
+        self.assertRaises(IOError, list, rows)
+
+    def test_preview_expression(self):
+        p = refine.RefineProject('1658955153749')
+        self.fake_get_rows(p, 25)
+        preview = p.preview_expression('n', 'value * 2', limit=5)
+        self.assertEqual(preview.results, [0, 2, 4, 6, 8])
+        self.assertEqual(p.requests[0]['limit'], 5)
+        self.assertEqual(preview.summary()['errors'], 0)
+
+    def test_batch(self):
+        p = refine.RefineProject('1658955153749')
+        requests = []
+        models = [[u'name', u'email'],
+                  # as the server has it once the split's been applied
+                  [u'Name', u'Name 2', u'Name 3', u'email 1', u'email 2']]
+        p.server.urlopen_json = lambda command, **kwargs: (
+            requests.append((command, kwargs['data'])) or {'code': 'ok'})
+
+        def get_models():
+            columns = models.pop(0) if len(models) > 1 else models[0]
+            p._set_columns(columns, dict((name, i)
+                                         for i, name in enumerate(columns)))
+            p._models_stale = False
+        p.get_models = get_models
+        with p.batch():
+            p.text_transform('name', 'value.trim()')
+            p.mass_edit('name', [{'from': ['a'], 'to': 'A'}])
+            with p.batch():
+                p.rename_column('name', 'Name')
+            # columns added in the batch can be built on
+            p.add_column('Name', 'Name 2')
+            p.add_column('Name 2', 'Name 3')
+            self.assertEqual(p.columns,
+                             [u'Name', u'Name 2', u'Name 3', u'email'])
+            self.assertEqual(p._column_index[u'Name 3'], 3)
+            p.split_column('email', '@')
+            self.assertEqual(requests, [])
+            # the split can't be patched in, so the edits so far are applied
+            # and the model fetched when it's next needed
+            p.move_column('Name', 'end')
+            self.assertEqual(len(requests), 1)
+            self.assertEqual(p.columns, [u'Name 2', u'Name 3', u'email 1',
+                                         u'email 2', u'Name'])
+        self.assertTrue(p._models_stale)
+        self.assertEqual(len(requests), 2)
+        self.assertEqual([command for command, _ in requests],
+                         ['apply-operations', 'apply-operations'])
+        operations = json.loads(requests[0][1]['operations'])
+        self.assertEqual([o['op'] for o in operations], [
+            'core/text-transform', 'core/mass-edit', 'core/column-rename',
+            'core/column-addition', 'core/column-addition',
+            'core/column-split'])
+        self.assertEqual(operations[0]['expression'], 'value.trim()')
+        self.assertEqual(operations[0]['engineConfig']['mode'], 'row-based')
+        self.assertEqual(operations[1]['edits'][0]['to'], 'A')
+        self.assertFalse('engineConfig' in operations[2])
+        self.assertEqual(operations[4]['columnInsertIndex'], 2)
+        operation, = json.loads(requests[1][1]['operations'])
+        self.assertEqual(operation['op'], 'core/column-move')
+        self.assertEqual(operation['index'], 4)
+        # nothing applied if the block raises, and patches are forgotten
+        models[:] = [[u'name', u'email']]
+        p.columns
+        try:
+            with p.batch():
+                p.rename_column('name', 'Name')
+                p.fill_down('Name')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(len(requests), 2)
+        self.assertTrue(p._models_stale)
+        self.assertEqual(p.columns, [u'name', u'email'])
+
+    def test_batch_unpatched(self):
+        p = refine.RefineProject('1658955153749')
+        requests = []
+        models = [[u'a', u'b'], [u'a 1', u'a 2', u'b']]
+        p.server.urlopen_json = lambda command, **kwargs: (
+            requests.append((command, kwargs['data'])) or {'code': 'ok'})
+
+        def get_models():
+            columns = models.pop(0)
+            p._set_columns(columns, dict((name, i)
+                                         for i, name in enumerate(columns)))
+            p._models_stale = False
+        p.get_models = get_models
+        p.columns
+        with p.batch():
+            p.split_column('a', ',')
+            p.move_column('b', 'end')
+            p.add_column('b', 'c')
+            p.rename_column('a 1', 'x')
+        self.assertEqual(p._columns, [u'x', u'a 2', u'b', u'c'])
+        operations = json.loads(requests[1][1]['operations'])
+        self.assertEqual(operations[0]['index'], 2)
+        self.assertEqual(operations[1]['columnInsertIndex'], 3)
+        self.assertEqual(operations[2]['oldColumnName'], 'a 1')
+        # commands that can't be recorded see the edits recorded before them
+        with p.batch():
+            p.text_transform('x', 'value.trim()')
+            p.reconcile('x', None, reconciliation_config={})
+        self.assertEqual([command for command, _ in requests[2:]],
+                         ['apply-operations', 'reconcile'])
+
+    def test_lazy_models(self):
+        p = refine.RefineProject('1658955153749')
+        p.get_models = lambda: self._get_models(p)
+        requests = []
+
+        def do_json(command, data=None, include_engine=True):
+            requests.append(command)
+            if command != 'get-models':
+                return {'code': 'ok'}
+            return {
+                u'columnModel': {u'keyColumnName': u'email', u'columns': [
+                    {u'name': u'email', u'cellIndex': 0},
+                    {u'name': u'name', u'cellIndex': 2},
+                    {u'name': u'state', u'cellIndex': 1}]},
+                u'recordModel': {u'hasRecords': False}}
+        p.do_json = do_json
+        self.assertEqual(requests, [])
+        self.assertEqual(p.key_column, 'email')
+        self.assertEqual(p.column_order['name'], 1)
+        self.assertEqual(requests, ['get-models'])
+        # renames, moves & reorders are patched in locally
+        p.rename_column('email', 'e-mail')
+        p.move_column('e-mail', 'end')
+        self.assertEqual(p.columns, ['name', 'state', 'e-mail'])
+        self.assertEqual(p.key_column, 'e-mail')
+        p.reorder_columns(['state', 'e-mail', 'name'])
+        self.assertEqual(p.column_order, {'state': 0, 'e-mail': 1,
+                                          'name': 2})
+        rows = p.rows_response_factory({
+            u'rows': [{u'i': 0, u'cells': [{u'v': 'a@b.c'}, {u'v': 'CA'}],
+                       u'starred': False, u'flagged': False}],
+            u'start': 0, u'limit': 1, u'mode': u'row-based',
+            u'filtered': 1, u'total': 1}).rows
+        self.assertEqual(rows[0]['e-mail'], 'a@b.c')
+        self.assertEqual(rows[0]['state'], 'CA')
+        self.assertEqual(requests, ['get-models', 'rename-column',
+                                    'move-column', 'reorder-columns'])
+        # other edits make the model stale, fetched again when next used
+        p.fill_down('name')
+        p.fill_down('state')
+        self.assertEqual(requests[-1], 'fill-down')
+        self.assertEqual(p.key_column, 'email')
+        self.assertEqual(requests[-1], 'get-models')
+
     def tearDown(self):
         # Restore mocked get_models
         refine.RefineProject.get_models = self._get_models
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+test_shard.py
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+import csv
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+from google.refine import facet
+from google.refine import shard
+
+PATH_TO_TEST_DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+
+class SplitFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'quoted.csv')
+        with open(self.path, 'wb') as fp:
+            fp.write('id,note\n')
+            for i in range(200):
+                fp.write('%d,"line one\nline ""two"" of %d"\n' % (i, i))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_shards(self, path, shards, **kwargs):
+        header_end, ranges = shard.split_file(path, shards, **kwargs)
+        with open(path, 'rb') as fp:
+            header = fp.read(header_end)
+        return [''.join(shard.iter_range(path, start, end, header))
+                for start, end in ranges]
+
+    def test_quoted_newlines(self):
+        shards = self.read_shards(self.path, 7)
+        self.assertEqual(len(shards), 7)
+        ids = []
+        for data in shards:
+            rows = list(csv.reader(StringIO.StringIO(data)))
+            self.assertEqual(rows[0], ['id', 'note'])
+            for row in rows[1:]:
+                self.assertEqual(row[1], 'line one\nline "two" of ' + row[0])
+                ids.append(int(row[0]))
+        self.assertEqual(ids, range(200))
+
+    def test_unquoted(self):
+        path = os.path.join(PATH_TO_TEST_DATA, 'duplicates.csv')
+        shards = self.read_shards(path, 3, process_quotes=False)
+        lines = open(path, 'rb').read().splitlines(True)
+        self.assertEqual(len(shards), 3)
+        self.assertEqual(''.join(s.split('\n', 1)[1] for s in shards),
+                         ''.join(lines[1:]))
+
+    def test_more_shards_than_rows(self):
+        path = os.path.join(self.tmp_dir, 'small.csv')
+        with open(path, 'wb') as fp:
+            fp.write('a\n1\n2\n')
+        self.assertEqual(len(self.read_shards(path, 10)), 2)
+
+
+class MergeFacetsTest(unittest.TestCase):
+    def test_merge_facets(self):
+        def response(d, r, blank, bins, step=1):
+            return {'mode': 'row-based', 'facets': [
+                {'name': 'Party', 'choices': [
+                    {'v': {'v': 'D', 'l': 'D'}, 'c': d, 's': False},
+                    {'v': {'v': 'R', 'l': 'R'}, 'c': r, 's': True}],
+                 'blankChoice': {'c': blank, 's': False}},
+                {'name': 'Age', 'min': 0, 'max': 30, 'step': step,
+                 'bins': bins, 'baseBins': bins, 'numericCount': sum(bins)},
+            ]}
+        merged = shard.merge_facets([response(1, 2, 3, [1, 2, 3]),
+                                     response(10, 20, 30, [4, 5, 6])])
+        engine = facet.Engine(facet.TextFacet('Party'),
+                              facet.NumericFacet('Age'))
+        facets = engine.facets_response(merged).facets
+        self.assertEqual(facets[0].choices['D'].count, 11)
+        self.assertEqual(facets[0].choices['R'].selected, True)
+        self.assertEqual(facets[0].blank_choice.count, 33)
+        self.assertEqual(facets[1].bins, [5, 7, 9])
+        self.assertEqual(facets[1].numeric_count, 21)
+        merged = shard.merge_facets([response(1, 2, 3, [1, 2, 3]),
+                                     response(1, 2, 3, [1, 2, 3], step=10)])
+        self.assertFalse('bins' in merged['facets'][1])
+
+
+class FakeShard(object):
+    """Stands in for a RefineProject holding some rows."""
+    def __init__(self, rows):
+        self.rows = rows
+        self.engine = None
+
+    def get_rows(self, start=0, limit=10):
+        return shard.ShardedRowsResponse(
+            [self], start, limit, self.rows[start:start + limit])
+
+    @property
+    def mode(self):
+        return 'row-based'
+
+    @property
+    def filtered(self):
+        return len(self.rows)
+
+    total = filtered
+
+    def delete(self):
+        return True
+
+
+class ShardedProjectTest(unittest.TestCase):
+    def test_get_rows(self):
+        project = shard.ShardedProject([FakeShard(range(0, 5)),
+                                        FakeShard(range(5, 8)),
+                                        FakeShard(range(8, 20))])
+        response = project.get_rows(start=3, limit=6)
+        self.assertEqual(response.rows, [3, 4, 5, 6, 7, 8])
+        self.assertEqual(response.filtered, 20)
+        pool = project._pool
+        self.assertEqual(project.get_rows(start=18).rows, [18, 19])
+        self.assertTrue(project._pool is pool)  # threads are kept
+        self.assertTrue(project.delete())
+        self.assertEqual(project._pool, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
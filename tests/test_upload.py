@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+test_upload.py
+"""
+
+# Copyright (c) 2011 Paul Makepeace, Real Programmers. All rights reserved.
+
+import cgi
+import gzip
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+import zlib
+
+from google.refine import upload
+
+PATH_TO_TEST_DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+
+class MultipartUploadTest(unittest.TestCase):
+    path = os.path.join(PATH_TO_TEST_DATA, 'duplicates.csv')
+
+    def parse(self, body):
+        fp = StringIO.StringIO(''.join(body))
+        return cgi.parse_multipart(fp, {'boundary': body.boundary})
+
+    def test_path(self):
+        progress = []
+        body = upload.MultipartUpload({
+            'project-name': u'caf\xe9',
+            'project-file': {'fd': self.path, 'filename': 'duplicates.csv'},
+        }, progress=lambda sent, total: progress.append((sent, total)),
+            chunk_size=100)
+        data = ''.join(body)
+        self.assertEqual(len(data), body.length)
+        self.assertEqual(progress[-1], (body.length, body.length))
+        self.assertTrue(len(progress) > 3)
+        parts = self.parse(body)
+        self.assertEqual(parts['project-name'], ['caf\xc3\xa9'])
+        self.assertEqual(parts['project-file'], [open(self.path).read()])
+
+    def test_file_object(self):
+        with open(self.path, 'rb') as fp:
+            fp.readline()   # only what's left is sent
+            body = upload.MultipartUpload({'f': {'fd': fp,
+                                                 'filename': 'x.csv'}})
+            self.assertEqual(len(''.join(body)), body.length)
+
+    def test_iterable(self):
+        chunks = ('a,b\n', '1,2\n')
+        body = upload.MultipartUpload({'f': {'fd': iter(chunks),
+                                             'filename': 'x.csv'}})
+        self.assertEqual(body.length, None)
+        self.assertEqual(self.parse(body)['f'], ['a,b\n1,2\n'])
+
+
+
+class CSVChunksTest(unittest.TestCase):
+    def test_csv_chunks(self):
+        rows = ([i, u'caf\xe9', 'a,"b"', None, float('nan'), 0.1]
+                for i in range(1000))
+        chunks = list(upload.csv_chunks(rows, ['n', 'name', 'q', 'x', 'y',
+                                               'z'], chunk_size=1000))
+        self.assertTrue(len(chunks) > 10)
+        lines = ''.join(chunks).splitlines()
+        self.assertEqual(len(lines), 1001)
+        self.assertEqual(lines[0], 'n,name,q,x,y,z')
+        self.assertEqual(lines[1], '0,caf\xc3\xa9,"a,""b""",,,0.1')
+        tsv = ''.join(upload.csv_chunks([[1, 2]], separator='\t'))
+        self.assertEqual(tsv, '1\t2\n')
+
+
+class CompressionTest(unittest.TestCase):
+    path = os.path.join(PATH_TO_TEST_DATA, 'duplicates.csv')
+
+    def test_sniff_compression(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            gz_path = os.path.join(tmp_dir, 'duplicates.csv.gz')
+            with open(self.path, 'rb') as src:
+                gz_fp = gzip.open(gz_path, 'wb')
+                shutil.copyfileobj(src, gz_fp)
+                gz_fp.close()
+            source, compression = upload.sniff_compression(gz_path)
+            self.assertEqual((source, compression), (gz_path, upload.GZIP))
+            with open(gz_path, 'rb') as fp:
+                source, compression = upload.sniff_compression(fp)
+                self.assertEqual(compression, upload.GZIP)
+                self.assertEqual(fp.tell(), 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(upload.sniff_compression(self.path)[1], None)
+        source, compression = upload.sniff_compression(iter(['BZh9', 'x']))
+        self.assertEqual(compression, upload.BZIP2)
+        self.assertEqual(''.join(source), 'BZh9x')
+
+    def test_gzip_source(self):
+        compressed = ''.join(upload.gzip_source(self.path, chunk_size=100))
+        self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS),
+                         open(self.path, 'rb').read())
+
+
+if __name__ == '__main__':
+    unittest.main()